@@ -39,6 +39,18 @@ parser.add_argument('-d', '--debug-mode',
                     action='store_true',
                     help='run in debug mode if set')
 
+parser.add_argument('-r', '--resume',
+                    dest = 'resume',
+                    action='store_true',
+                    help='resume a previous run with the same output directory, '
+                    'skipping completed stages and chunks')
+
+parser.add_argument('-s', '--skip-checks',
+                    dest = 'skip_checks',
+                    action='store_true',
+                    help='skip the pre-flight checks of the input files, columns '
+                    'and samples')
+
 parser.add_argument('-v', '--version',
                     ## metavar = '',
                     action = 'version', version='%(prog)s ' + version,
@@ -75,35 +87,115 @@ log_dir = os.path.join(outdir, 'logs')
 Path(log_dir).mkdir(parents=True, exist_ok=True)
 
 
+## == pre-flight checks ==
+
+## samples to remove written by the checks, see below
+remove_file = None
+
+## checking the inputs before anything is submitted, instead of
+## bolt-lmm failing on them after the queue wait and the core SNP set
+if not args.skip_checks:
+
+    print('\n== pre-flight checks ==')
+
+    if 'chr-list' in cfg:
+        chr_list = str(cfg['chr-list']).replace(" ", "").split(',')
+    else:
+        chr_list = [*range(1, 23, 1)]
+
+    missing_files = bolt.missing_inputs(cfg, chr_list)
+
+    if missing_files:
+        sys.exit('\nmissing input file(s):\n' + '\n'.join(missing_files))
+
+    print('\ninput files of ' + str(len(chr_list)) + ' chromosome(s): found')
+
+    model_problems = bolt.check_model_columns(cfg['pheno-file'], bolt.model_list(cfg))
+
+    if model_problems:
+        sys.exit('\nphenotype file:\n' + '\n'.join(model_problems))
+
+    print('phenotype and covariate columns: found, numeric')
+
+    overlap = bolt.sample_overlap(cfg['fam-file'], sample_file, cfg['pheno-file'],
+                                  cfg.get('remove-samples-list'))
+
+    print('\nsamples in fam file: ' + str(overlap['fam']))
+    print('samples in sample file: ' + str(overlap['sample']))
+    print('samples in phenotype file: ' + str(overlap['pheno']))
+    print('samples to remove: ' + str(overlap['remove']))
+    print('samples in fam and sample file: ' + str(overlap['fam-sample']))
+    print('samples in fam and phenotype file (core SNP set): ' + str(overlap['fam-pheno']))
+    print('samples analysed by bolt-lmm: ' + str(overlap['analysis']))
+
+    if overlap['fam-sample'] < 0.5 * overlap['fam']:
+        print('\nwarning: overlap of sample file and fam file < 50%')
+
+    if overlap['analysis'] == 0:
+        sys.exit('\nno samples to analyse')
+
+    ## samples bolt-lmm would stop on, removed with the given ones; the
+    ## pipeline runs with the configuration as it is, and this file in
+    ## place of its remove-samples-list
+    if len(overlap['missing']):
+
+        remove_file = os.path.join(outdir, 'remove-samples.txt')
+
+        removed = overlap['missing']
+
+        if cfg.get('remove-samples-list'):
+            removed = bolt.read_sample_ids(cfg['remove-samples-list']).append(removed)
+
+        bolt.write_sample_ids(removed, remove_file)
+
+        print('\n' + str(len(overlap['missing'])) + ' sample(s) of the core SNP set missing in the sample file, ' +
+              'written with the samples to remove to ' + remove_file)
+
+
 init_command = 'python3 ' + os.path.join(bindir, 'main.py') + ' --config-file ' + yaml_file
 
-echo_command = 'echo -e "%s"' % init_command
+if remove_file is not None:
+    init_command = init_command + ' --remove-samples-list ' + remove_file
 
-## maybe take the qsub variables from config file
-## qsub_var = cfg['qsub-var'] 
+if args.resume:
+    init_command = init_command + ' --resume'
 
-## 72 hours is the maximum walltime in the throughput node
+executor = cfg.get('executor', 'pbs')
 
-qsub_command = 'qsub -S /bin/bash -o ' + log_dir + ' -e ' + log_dir + ' -V -N main -lselect=1:ncpus=1:mem=64gb -lwalltime=72:00:00'
+if executor == 'local':
 
-## I am not using shell=True, so need to use shlex to parse the string
-## for subprocess.Popen
-cmd = echo_command + " | " + qsub_command
+    ## running the whole pipeline on this node, main.py runs the
+    ## array jobs in a local process pool
+    print('\nrunning main.py on the local node')
 
-print('\nrunning main.py on the pbs queue')
+    print('\ninitialisation command: ' + init_command)
 
-print('\ninitialisation command: ' + init_command)
+    main_log = os.path.join(log_dir, 'main.log')
 
-print('\nqsub command: ' + str(qsub_command))
+    print('\nlog file: ' + main_log)
 
-print('\ncommand: ' + cmd)
+    with open(main_log, 'w') as log_fh:
+        main_out = subprocess.run(shlex.split(init_command), stdout=log_fh,
+                                  stderr=subprocess.STDOUT)
 
-p1 = subprocess.Popen(shlex.split(echo_command), stdout=subprocess.PIPE)
-p2 = subprocess.Popen(shlex.split(qsub_command), stdin=p1.stdout, stdout=subprocess.PIPE)
-## Allow p1 to receive a SIGPIPE if p2 exits
-p1.stdout.close()
+    print('\nbolt-lmm pipeline finished with exit status: ' + str(main_out.returncode))
+
+    sys.exit(main_out.returncode)
+
+
+## maybe take the qsub variables from config file
+## qsub_var = cfg['qsub-var'] 
+
+## 72 hours is the maximum walltime in the throughput node. main.py
+## merges the bolt-lmm output chunks streaming, so it needs little
+## memory. With plink-executor local, the plink filters run in a job
+## of their own (see run-coreset.py), not in the main job
+
+main_resources = {'ncpus': 1, 'mem': 8, 'walltime': 72}
+
+print('\nrunning main.py on the pbs queue')
 
-job_id = p2.communicate()[0].decode('UTF-8').replace('.pbs', '').rstrip()
+job_id = bolt.submit_qsub(init_command, 'main', log_dir, main_resources)
 
 print('\nbolt-lmm pipeline initialised with job-id: ' + job_id)
 
@@ -6,11 +6,14 @@ import socket
 import sys
 import time
 import uuid
+import hashlib
 import json
 import re
 import shutil
 import shlex
-import pandas as pd
+import atexit
+import threading
+import concurrent.futures
 from datetime import datetime
 from pathlib import Path
 
@@ -59,6 +62,18 @@ parser.add_argument('-d', '--debug-mode',
                     action='store_true',
                     help='run in debug mode if set')
 
+parser.add_argument('-r', '--resume',
+                    dest = 'resume',
+                    action='store_true',
+                    help='resume a previous run with the same output directory, '
+                    'skipping completed stages and chunks')
+
+parser.add_argument('--remove-samples-list',
+                    dest = 'remove_samples_list',
+                    help = 'samples to remove, in place of the remove-samples-list of the '
+                    'configuration (e.g. the one written by the pre-flight checks)',
+                    type = lambda x: bolt.is_valid_file(parser, x))
+
 parser.add_argument('-v', '--version',
                     ## metavar = '',
                     action = 'version', version='%(prog)s ' + version,
@@ -92,9 +107,93 @@ temp_parent = os.path.expandvars(cfg['tempdir'])
 
 temp_delete = cfg['temp-delete']
 
+## models: pheno-1/cov-1, pheno-2/cov-2, ...
+model_list = bolt.model_list(cfg)
+
+print('\nmodels: ' + str(model_list))
+
+## resubmission of failed array subjobs with more memory or wall time
+retry = {'max': cfg.get('retry-max', 2),
+         'mem-factor': cfg.get('retry-mem-factor', 2),
+         'walltime-factor': cfg.get('retry-walltime-factor', 2),
+         'mem-max': cfg.get('retry-mem-max', 256),
+         'walltime-max': cfg.get('retry-walltime-max', 72)}
+
+## history of the resources used by earlier tasks, to size the
+## resources of new ones, none if not set
+history_file = cfg.get('resource-history')
+if history_file:
+    history_file = os.path.expandvars(history_file)
+history_margin = cfg.get('resource-margin', 1.5)
+history_min_records = cfg.get('resource-min-records', 3)
+
+## cache of core SNP sets shared by runs with the same samples,
+## genotype files and filtering thresholds, none if not set
+coreset_cache_dir = cfg.get('coreset-cache-dir')
+if coreset_cache_dir:
+    coreset_cache_dir = os.path.expandvars(coreset_cache_dir)
+
+### filtering parameters for the selection of core SNPs
+fam_file = cfg['fam-file']
+pheno_file = cfg['pheno-file']
+remove_samples_list = args.remove_samples_list or cfg.get('remove-samples-list')
+thr_maf = cfg['thr-maf']
+thr_geno = cfg['thr-geno']
+thr_hwe = cfg['thr-hwe']
+
+## spans of the stages and tasks are written to trace.json in the
+## output directory
+trace = cfg.get('trace', True)
+
+## filters and size of the table of top hits written with the merged
+## results
+hits_filters = {'p-column': cfg.get('hits-p-column', 'P_BOLT_LMM'),
+                'max-p': float(cfg.get('hits-max-p', 5e-8)),
+                'min-maf': cfg.get('hits-min-maf', 0.01),
+                'min-info': cfg.get('hits-min-info', 0.8)}
+hits_max = cfg.get('hits-max', 1000)
+
+## additional output formats of the merged results
+output_bgzip = cfg.get('output-bgzip', False)
+output_parquet = cfg.get('output-parquet', False)
+merge_keep_chromosomes = cfg.get('merge-keep-chromosomes', False)
+
+## lambda GC, variants per chromosome, QQ and Manhattan plots
+diagnostics_enabled = cfg.get('diagnostics', True)
+
 chunksize = cfg['chunksize']
+chunk_mode = cfg.get('chunk-mode', 'fixed')
+
+## 'pipe' streams the bgen chunks to bolt-lmm, they are not extracted
+## beforehand
+bgen_access = cfg.get('bgen-access', 'extract')
+
+## chunks tested by one bolt-lmm run, which fits the model once
+chunks_per_task = int(cfg.get('chunks-per-task', 1))
+chunk_walltime = cfg.get('chunk-walltime', 24)
 ncpus = str(cfg['ncpus'])
 
+## 'pbs' submits array jobs to the queue, 'local' runs them in a
+## process pool on this node
+executor = cfg.get('executor', 'pbs')
+local_cores = cfg.get('local-cores')
+local_mem = cfg.get('local-mem')
+
+## the plink filters of the core SNP set are short, in a local process
+## pool inside one job of plink-cores and plink-mem (see
+## run-coreset.py) they do not wait in the queue as an array job. The
+## main job keeps its small resources
+plink_executor = (cfg.get('plink-executor') or executor)
+
+plink_pooled = plink_executor == 'local' and executor != 'local'
+
+if plink_pooled:
+    plink_cores = cfg.get('plink-cores', 8)
+    plink_mem = cfg.get('plink-mem', 128)
+else:
+    plink_cores = local_cores
+    plink_mem = local_mem
+
 
 ## == modules ==
 
@@ -104,26 +203,33 @@ print("using environment modules")
 module_init = cfg['module-init']
 module_list = cfg['module-list']
 
-## to get module environment working
-exec(open(module_init).read())
+## without environment modules (e.g. a laptop with the local
+## executor) the software has to be in the search path already
+if os.path.exists(module_init):
 
-## setting the modules library
-## module('use', '-a', module_lib)
-   
-print('removing loaded modules....')
-module('purge')
+    ## to get module environment working
+    exec(open(module_init).read())
 
-## necessary to remove all white space here
-module_list = module_list.replace(" ", "")
-module_list = module_list.split(',')
+    ## setting the modules library
+    ## module('use', '-a', module_lib)
 
-print("now loading modules....")
+    print('removing loaded modules....')
+    module('purge')
 
-for mod in module_list:
-    module('load', mod)
-    
-## write to log file
-module('list')
+    ## necessary to remove all white space here
+    module_list = module_list.replace(" ", "")
+    module_list = module_list.split(',')
+
+    print("now loading modules....")
+
+    for mod in module_list:
+        module('load', mod)
+
+    ## write to log file
+    module('list')
+
+else:
+    print('module init file ' + module_init + ' not found, not loading modules')
 
 
 ## == output, log and temporary directories ==
@@ -139,11 +245,34 @@ Path(plink_dir).mkdir(parents=True, exist_ok=True)
 bolt_dir = os.path.join(outdir, 'bolt')
 Path(bolt_dir).mkdir(parents=True, exist_ok=True)
 
-tempdir = os.path.join(temp_parent, ('tempdir_' +  uuid.uuid4().hex))
+## samples of the core SNP set and phenotype files of the models
+sample_dir = os.path.join(outdir, 'samples')
+Path(sample_dir).mkdir(parents=True, exist_ok=True)
+
+## the temporary directory is named after the output directory, so
+## that a resumed run finds the files of the previous one
+tempdir = os.path.join(temp_parent, ('tempdir_' + hashlib.sha1(os.path.realpath(outdir).encode('UTF-8')).hexdigest()[:16]))
+
+## the manifest records completed stages and chunks
+manifest_file = os.path.join(outdir, 'manifest.json')
+
+if args.resume:
+    print('\nresuming run, manifest ' + manifest_file)
+    manifest = bolt.load_manifest(manifest_file)
+else:
+    if os.path.exists(tempdir):
+        print('\ndeleting temporary directory of previous run ' + tempdir)
+        shutil.rmtree(tempdir)
+    manifest = {'stages': {}, 'chunks': {}}
+    bolt.save_manifest(manifest, manifest_file)
+
+## stages running at the same time update the manifest under this lock
+manifest_lock = threading.Lock()
+
 print('\ncreating temporary directory ' + tempdir)
 Path(tempdir).mkdir(parents=True, exist_ok=True)
 
-## temporary directory for the reformatted bim files, bed and fam files per chromosome
+## temporary directory for the reformatted bim files per chromosome
 bed_tempdir = os.path.join(tempdir, 'temp-bed')
 Path(bed_tempdir).mkdir(parents=True, exist_ok=True)
 
@@ -155,6 +284,51 @@ Path(plink_tempdir).mkdir(parents=True, exist_ok=True)
 bolt_tempdir = os.path.join(tempdir, 'temp-bolt')
 Path(bolt_tempdir).mkdir(parents=True, exist_ok=True)
 
+
+## == tracing ==
+
+## main.py and each task write their spans to their own file in the
+## trace directory, combined into one trace at the end of the run,
+## also if the run fails
+trace_file = os.path.join(outdir, 'trace.json')
+
+if trace:
+    trace_dir = os.path.join(tempdir, 'trace')
+    bolt.set_trace_file(os.path.join(trace_dir, 'main.jsonl'))
+else:
+    trace_dir = None
+
+
+def write_trace():
+
+    """ Combines the trace files of main.py and the tasks """
+
+    if trace_dir is not None and os.path.isdir(trace_dir):
+        print('\nwritten ' + str(bolt.combine_traces(trace_dir, trace_file)) +
+              ' span(s) to trace ' + trace_file)
+
+atexit.register(write_trace)
+
+
+def trace_attempts(job_name, attempts):
+
+    """ Traces the queue wait and run time of each task attempt, one
+    track per task """
+
+    for attempt in attempts:
+
+        track = job_name + ' ' + str(attempt['task'])
+
+        if attempt['queue-time'] is not None and attempt['start-time'] is not None:
+            bolt.trace_event('queue wait', 'queue', attempt['queue-time'], attempt['start-time'],
+                             track = track, attempt = attempt['attempt'])
+
+        if attempt['start-time'] is not None and attempt['walltime-used'] is not None:
+            bolt.trace_event(job_name, 'task', attempt['start-time'],
+                             attempt['start-time'] + attempt['walltime-used'] * 3600,
+                             track = track, attempt = attempt['attempt'],
+                             resources = attempt['resources'], failure = attempt['failure'])
+
     
 ## == chromosomes, list of input files ==
 
@@ -183,190 +357,827 @@ if n_chr != n_gen_base:
     sys.exit('number of chromosomes ' + n_chr +  ' and number of basenames ' + n_gen_base + ' do not match.')
 
 
-## == serialising data for run-plink.py ==
+## == resource history ==
 
-json_file_plink = os.path.join(tempdir, ('data_file_' + uuid.uuid4().hex + '.json'))
+history = bolt.load_history(history_file)
 
-serial_data = {'chr-list': chr_list,
-               'gen-list': gen_base_list,
-               'imp-list': imp_base_list,
-               'tempdir': tempdir,
-               'plink-tempdir': plink_tempdir,
-               'bed-tempdir': bed_tempdir}
+print('\nresource history: ' + str(history_file) + ', ' + str(len(history)) + ' record(s)')
 
-with open(json_file_plink, "w" ) as fh:
-    json.dump(serial_data, fh )
 
+def task_resources(job_name, resources, features):
+
+    """ Predicts the resources of each task from the resource history,
+    see bolt.predict_resources """
+
+    return([bolt.predict_resources(history, job_name, task_features, resources,
+                                   history_margin, history_min_records, retry)
+            for task_features in features])
 
-## == running plink ==
-    
-pipeline_command = 'python3 ' + os.path.join(bindir, 'run-plink.py') + ' --config-file ' + yaml_file + ' --data-file ' + json_file_plink
 
-echo_command = 'echo -e "%s"' % pipeline_command
+def record_history(job_name, tasks, features, attempts):
 
-## maybe take the qsub variables from config file
-## qsub_var = cfg['qsub-var'] 
+    """ Appends the resources used by each attempt of the tasks to the
+    resource history """
 
-qsub_command = 'qsub  -S /bin/bash -o ' + log_dir + ' -e ' + log_dir + ' -V -N run-plink -J ' +  ('1-' + str(n_gen_base)) + ' -lselect=1:ncpus=1:mem=16gb -l walltime=04:00:00'
+    if not history_file:
+        return
 
-cmd =  echo_command + " | " + qsub_command
+    task_features = dict(zip(tasks, features))
 
-print('\nrunning run-plink.py on the pbs queue')
+    bolt.append_history(history_file,
+                        [{'job': job_name,
+                          'time': attempt['time'],
+                          'features': task_features[attempt['task']],
+                          'resources': attempt['resources'],
+                          'mem-used': attempt['mem-used'],
+                          ## bolt-lmm reports its wall time if pbs does not
+                          'walltime-used': attempt['walltime-used'] or bolt.log_walltime(attempt['stdout']),
+                          'failure': attempt['failure']}
+                         for attempt in attempts])
 
-print('\npipeline command: ' + pipeline_command)
-      
-print('\nqsub command: ' + str(qsub_command))
 
-print('\ncommand: ' + cmd)
+## == analysis samples ==
 
-p1 = subprocess.Popen(shlex.split(echo_command), stdout=subprocess.PIPE)
-p2 = subprocess.Popen(shlex.split(qsub_command), stdin=p1.stdout, stdout=subprocess.PIPE)
-## Allow p1 to receive a SIGPIPE if p2 exits
-p1.stdout.close()
+## the samples are intersected once, not by plink and each bolt-lmm
+## task: the core SNP set keeps the samples of all models, each model
+## reads a phenotype file of its columns and complete cases and
+## removes the samples of the other models
+keep_file = os.path.join(sample_dir, 'keep.txt')
 
-job_id = p2.communicate()[0].decode('UTF-8').replace('.pbs', '').rstrip()
 
-print("\nrunning script run-plink.py as job-id: " + job_id)
+def samples_stage():
 
+    """ Writes the keep file of the core SNP set and the phenotype and
+    remove files of the models """
 
-## == monitoring the qsub processes ==
+    with bolt.trace_span('analysis samples', 'stage') as span:
 
-bolt.monitor_qsub(job_id)
+        overlap = bolt.sample_overlap(fam_file, sample_file, pheno_file, remove_samples_list)
+        model_samples = bolt.write_model_samples(pheno_file, model_list, overlap['samples'], sample_dir)
 
+        span['samples'] = overlap['analysis']
 
-## == merging core SNP sets ==
+    print('\n' + str(overlap['analysis']) + ' sample(s) in the fam, sample and phenotype file, ' +
+          str(bolt.count_lines(keep_file)) + ' of them analysed, in ' + keep_file)
 
-print('\nmerging core SNP sets.')
+    for model in model_list:
 
-coreset_list_file = os.path.join(plink_tempdir, 'basename.list')
+        model.update(model_samples[model['name']])
 
-ch = open(coreset_list_file, "w")
+        print(model['name'] + ': ' + str(model['samples']) + ' sample(s) in ' + model['pheno-file'])
 
-for gb in gen_base_list:
-   gb_path = os.path.join(plink_tempdir, (gb + '.coreset'))
-   ch.write(gb_path + '\n')
+        if model['samples'] == 0:
+            sys.exit('no complete cases of ' + model['name'] + ' in ' + pheno_file)
 
-ch.close()
+
+## == core SNP set ==
 
 coreset_path = os.path.join(plink_dir, 'coreset')
 
-## merging the per chromosome core snp files 
-plink_cmd = 'plink --merge-list ' + coreset_list_file + ' --make-bed --out ' + coreset_path
 
-print('\nplink commamd: ' + plink_cmd)
+def coreset_job(plink_data, resources):
 
-plink_out = subprocess.run(shlex.split(plink_cmd), capture_output = True)
+    """ Runs the plink filters of all chromosomes in a process pool
+    inside one pbs job of plink-cores and plink-mem (see
+    run-coreset.py), returns their results and attempts as
+    bolt.run_tasks does """
 
-## don't need it right now
-## plink_out = plink_out.stdout.decode('UTF-8')
+    results_file = os.path.join(tempdir, 'coreset-results.json')
 
+    if os.path.exists(results_file):
+        os.remove(results_file)
 
+    def coreset_command(tasks, attempt):
 
-## == creating subsets of bgen files in chunk size bins ==
+        """ Writes the data file for run-coreset.py, returns the
+        pipeline command """
 
+        json_file_coreset = os.path.join(tempdir, ('data_file_coreset_' + str(attempt) + '.json'))
 
-chunk_list = []
+        serial_data = {'plink-data': plink_data,
+                       'gen-list': gen_base_list,
+                       'resources': resources,
+                       'retry': retry,
+                       'cores': plink_cores,
+                       'mem': plink_mem,
+                       'log-dir': log_dir,
+                       'results-file': results_file}
 
-for idx, chr in enumerate(chr_list):
+        with open(json_file_coreset, "w" ) as fh:
+            json.dump(serial_data, fh )
 
-    bgen_file = os.path.join(data_dir, (imp_base + str(chr) + '.bgen'))
-    snps_file = os.path.join(data_dir, (imp_base + str(chr) + '.bim'))
+        return('python3 ' + os.path.join(bindir, 'run-coreset.py') + ' --config-file ' + yaml_file + ' --data-file ' + json_file_coreset)
 
-    ## reading in bim file from ukb_imp_chr* file and putting positions in array
+    ## the chromosomes run in waves of as many as fit into the pool,
+    ## each wave possibly again for the retries of its filters
+    slots = max(1, min(plink_cores // max(r['ncpus'] for r in resources),
+                       plink_mem // max(r['mem'] for r in resources)))
 
-    f = open(snps_file, 'r')
-    snp_array = f.readlines()
+    coreset_resources = {'ncpus': plink_cores, 'mem': plink_mem,
+                         'walltime': min(retry['walltime-max'],
+                                         max(r['walltime'] for r in resources) *
+                                         -(-len(resources) // slots) * (1 + retry['max']))}
+
+    ## the plink filters escalate their resources inside the job (see
+    ## run-coreset.py), the job itself is not escalated: with its
+    ## resources as the maximum, it is resubmitted only if pbs fails it,
+    ## not for running out of memory or wall time
+    coreset_retry = dict(retry, **{'mem-max': coreset_resources['mem'],
+                                   'walltime-max': coreset_resources['walltime']})
+
+    coreset_results, coreset_attempts = bolt.run_tasks('pbs', 'run-coreset', log_dir, coreset_resources,
+                                                       ['coreset'], coreset_command, coreset_retry)
+
+    trace_attempts('run-coreset', coreset_attempts)
+
+    with manifest_lock:
+        manifest.setdefault('attempts', {})['run-coreset'] = coreset_attempts
+        bolt.save_manifest(manifest, manifest_file)
+
+    if coreset_results[0]['failure'] or not os.path.exists(results_file):
+        sys.exit('run-coreset failed (' + str(coreset_results[0]['failure']) + '), see logs in ' + log_dir)
+
+    with open(results_file, 'r') as fh:
+        coreset_output = json.load(fh)
+
+    return(coreset_output['results'], coreset_output['attempts'])
+
+
+def coreset_stage():
+
+    """ Filters the genotyped snps of each chromosome with plink and
+    merges them into the core SNP set, unless it is complete from a
+    previous run or in the core set cache """
+
+    coreset_samples = bolt.sample_checksum(keep_file)
+    coreset_record = manifest['stages'].get('coreset')
+
+    ## the core SNP set of a previous run is used if it is unchanged
+    ## and has the same samples
+    if bolt.output_valid(coreset_record) and coreset_record.get('samples') == coreset_samples:
+
+        print('\ncore SNP set ' + coreset_path + ' completed in previous run, skipping plink')
+
+    else:
+
+        ## the core SNP set depends only on the samples, genotype files
+        ## and filtering thresholds, so that runs with the same inputs
+        ## share it through the core set cache
+        coreset_cached = False
+
+        if coreset_cache_dir:
+
+            coreset_inputs = bolt.coreset_inputs(fam_file, keep_file,
+                                                 {'thr-maf': thr_maf, 'thr-geno': thr_geno, 'thr-hwe': thr_hwe},
+                                                 chr_list,
+                                                 [os.path.join(data_dir, (gb + ext))
+                                                  for gb in gen_base_list for ext in ('.bed', '.bim')])
+
+            coreset_key = bolt.coreset_cache_key(coreset_inputs)
+
+            coreset_cached = bolt.fetch_coreset(coreset_cache_dir, coreset_key, coreset_path)
+
+        if coreset_cached:
+
+            print('\ncore SNP set from cache ' + os.path.join(coreset_cache_dir, coreset_key) + ', skipping plink')
+
+        else:
+
+            ## core SNP set files of a previous run may be links to the
+            ## cache, plink must not write through them
+            for ext in ('.bed', '.bim', '.fam'):
+                if os.path.lexists(coreset_path + ext):
+                    os.remove(coreset_path + ext)
+
+            ## == serialising data for run-plink.py ==
+
+            plink_data = {'chr-list': chr_list,
+                          'imp-list': imp_base_list,
+                          'keep-file': keep_file,
+                          'tempdir': tempdir,
+                          'plink-tempdir': plink_tempdir,
+                          'bed-tempdir': bed_tempdir,
+                          'trace-dir': trace_dir}
+
+            def plink_command(gen_bases, attempt):
+
+                """ Writes the data file for run-plink.py running the given
+                chromosomes, returns the pipeline command """
+
+                json_file_plink = os.path.join(tempdir, ('data_file_plink_' + str(attempt) + '.json'))
+
+                serial_data = dict(plink_data, **{'gen-list': gen_bases})
+
+                with open(json_file_plink, "w" ) as fh:
+                    json.dump(serial_data, fh )
+
+                return('python3 ' + os.path.join(bindir, 'run-plink.py') + ' --config-file ' + yaml_file + ' --data-file ' + json_file_plink)
+
+
+            ## == running plink ==
+
+            ## maybe take the qsub variables from config file
+            ## qsub_var = cfg['qsub-var'] 
+
+            plink_resources = {'ncpus': 1, 'mem': 16, 'walltime': 4}
+
+            n_fam_samples = bolt.count_lines(fam_file)
+
+            plink_features = [{'samples': n_fam_samples,
+                               'variants': bolt.count_lines(os.path.join(data_dir, (gb + '.bim')))}
+                              for gb in gen_base_list]
+
+            if plink_pooled:
+                plink_results, plink_attempts = coreset_job(plink_data,
+                                                            task_resources('run-plink', plink_resources, plink_features))
+            else:
+                plink_results, plink_attempts = bolt.run_tasks(plink_executor, 'run-plink', log_dir,
+                                                               task_resources('run-plink', plink_resources, plink_features),
+                                                               gen_base_list, plink_command, retry,
+                                                               cores = plink_cores, mem = plink_mem)
+
+            record_history('run-plink', gen_base_list, plink_features, plink_attempts)
+            trace_attempts('run-plink', plink_attempts)
+
+            with manifest_lock:
+                manifest.setdefault('attempts', {})['run-plink'] = plink_attempts
+                bolt.save_manifest(manifest, manifest_file)
+
+            plink_failed = [chr_list[i] for i, result in enumerate(plink_results) if result['failure']]
+
+            if plink_failed:
+                sys.exit('run-plink failed for chromosome(s) ' + str(plink_failed) +
+                         ', see logs in ' + log_dir)
+
+
+            ## == merging core SNP sets ==
+
+            print('\nmerging core SNP sets.')
+
+            merge_start = time.time()
+
+            coreset_list_file = os.path.join(plink_tempdir, 'basename.list')
+
+            ch = open(coreset_list_file, "w")
+
+            for gb in gen_base_list:
+               gb_path = os.path.join(plink_tempdir, (gb + '.coreset'))
+               ch.write(gb_path + '\n')
+
+            ch.close()
+
+            ## merging the per chromosome core snp files 
+            plink_cmd = 'plink --merge-list ' + coreset_list_file + ' --make-bed --out ' + coreset_path
+
+            print('\nplink commamd: ' + plink_cmd)
+
+            plink_out = subprocess.run(shlex.split(plink_cmd), capture_output = True)
+
+            ## don't need it right now
+            ## plink_out = plink_out.stdout.decode('UTF-8')
+
+            bolt.trace_event('merge core SNP sets', 'stage', merge_start, time.time())
+
+            if plink_out.returncode != 0:
+                sys.exit('merging core SNP sets failed, see ' + coreset_path + '.log')
+
+            ## a cache this user may not write to is skipped, the core
+            ## SNP set of this run is complete without it
+            if coreset_cache_dir:
+                coreset_entry = bolt.store_coreset(coreset_cache_dir, coreset_key, coreset_path, coreset_inputs)
+                if coreset_entry is not None:
+                    print('\nstored core SNP set in cache ' + coreset_entry)
+
+
+        ## chunks and merged results of a previous run used another core
+        ## SNP set
+        with manifest_lock:
+            attempts = manifest.get('attempts', {})
+            manifest.clear()
+            manifest.update({'stages': {'coreset': dict(bolt.record_output([coreset_path + ext for ext in ('.bed', '.bim', '.fam')]),
+                                                        samples = coreset_samples)},
+                             'chunks': {},
+                             'attempts': attempts})
+            bolt.save_manifest(manifest, manifest_file)
+
+
+## == planning chunks of imputed snps ==
+
+
+## chunk plans are cached next to the data if that directory is
+## writable, otherwise in the output directory
+if cfg.get('chunk-cache-dir'):
+    chunk_cache_dir = os.path.expandvars(cfg['chunk-cache-dir'])
+elif os.access(data_dir, os.W_OK):
+    chunk_cache_dir = data_dir
+else:
+    chunk_cache_dir = os.path.join(outdir, 'chunk-plans')
+
+## 'fixed' divides the chromosomes into chunks of chunksize snps,
+## 'cost' into chunks of about the same bolt-lmm wall time
+if chunk_mode == 'cost':
+    cost_model = {'target': chunk_walltime * 3600,
+                  'fixed': cfg.get('cost-fixed', 3600),
+                  'per-variant': cfg.get('cost-per-variant', 0.01),
+                  'min-maf': cfg['min-maf'],
+                  'min-info': cfg['min-info'],
+                  'mfi-file': cfg.get('mfi-file')}
+else:
+    cost_model = None
+
+def plan_chunks_stage():
+
+    """ Plans the chunks of imputed snps of all chromosomes """
+
+    global chunk_list
+
+    print('\nplanning chunks (' + chunk_mode + ' mode), chunk plan cache in ' + chunk_cache_dir)
 
-    ## only need snp position, i.e. 4th column
-    snp_array = list(map(lambda snp: snp.split('\t')[3], snp_array))
-    
     ## list of tuples
     ## ((chr1, (chunk1, chunk2)), (chr1, (chunk3, chunk4)), (chr2, (chunk1, chunk2)))
+    with bolt.trace_span('plan chunks', 'stage', mode = chunk_mode) as span:
+        with plan_pool:
+            chunk_list = bolt.plan_chunks(chr_list, data_dir, imp_base, chunksize, chunk_cache_dir,
+                                          cost_model = cost_model, pool = plan_pool)
+        span['chunks'] = len(chunk_list)
+
+
+    print('\nlist of chunks:\n', chunk_list)
+
+
+## == pending chunks ==
 
-    chr_chunks = bolt.snp_chunks(snp_array, chr, chunksize)
+def bolt_chunk_file(chunk, model):
 
-    chunk_list.extend(chr_chunks)
+    """ Path of the bolt-lmm output of a chunk and model """
 
+    return(os.path.join(bolt_tempdir, (bolt.chunk_name(imp_base, chunk) + '.' +
+                                       model['name'] + '.bolt')))
 
-print('\nlist of chunks:\n', chunk_list)
+
+## == merging chromosomes ==
+
+## the chunks of a chromosome are merged as soon as the last of them
+## has finished, while the chunks of other chromosomes are still
+## running, so that the end of the run only joins the chromosomes
+
+def chromosome_file(chr, model):
+
+    """ Path of the merged bolt-lmm output of a chromosome and model """
+
+    return(os.path.join(bolt_dir, (model['name'] + '.chr' + str(chr) + '.bolt.txt')))
+
+
+def merge_chromosome(chr, model):
+
+    """ Merges the chunks of a chromosome if all of them are complete,
+    returns True if the chromosome is merged """
+
+    chr_chunk_files = [bolt_chunk_file(chunk, model) for chunk in chunk_list
+                       if str(chunk[0]) == str(chr)]
+
+    stage = 'merge-' + model['name'] + '-chr' + str(chr)
+    merge_record = manifest['stages'].get(stage)
+
+    if bolt.output_valid(merge_record) and merge_record['chunks'] == chr_chunk_files:
+        return(True)
+
+    if not all(bolt.output_valid(manifest['chunks'].get(f)) for f in chr_chunk_files):
+        return(False)
+
+    chr_file = chromosome_file(chr, model)
+
+    with bolt.trace_span('merge chromosome', 'stage', model = model['name'], chr = str(chr)) as span:
+        merge_stats = bolt.merge_bolt_chunks(chr_chunk_files, chr_file)
+        span.update(merge_stats)
+
+    print('\nmerged chromosome ' + str(chr) + ' of ' + model['name'] + ': ' +
+          str(merge_stats['variants']) + ' variants in ' + chr_file)
+
+    with manifest_lock:
+        manifest['stages'][stage] = dict(bolt.record_output([chr_file]), chunks = chr_chunk_files,
+                                         duplicates = merge_stats['duplicates'])
+        bolt.save_manifest(manifest, manifest_file)
+
+    return(True)
+
+
+## chromosomes are merged in a thread of their own, one after the
+## other, so that a merge does not hold up the monitoring of the
+## running tasks (and the resubmission of failed ones), see
+## bolt.monitor_qsub; run_bolt_stage waits for them
+merge_pool = concurrent.futures.ThreadPoolExecutor(max_workers = 1)
+merge_futures = []
+
+
+def chunk_finished(task, result):
+
+    """ Records the output of the chunks of a finished task and hands
+    the merge of their chromosomes to the merge thread, which merges
+    them if those were the last chunks missing """
+
+    model = model_list[task[1]]
+
+    ## run-bolt.py writes the output files of the chunks only if
+    ## bolt-lmm has finished successfully
+    if result['exit_status'] != 0:
+        return
+
+    task_chrs = []
+
+    for chunk_index in task[0]:
+
+        chunk = chunk_list[chunk_index]
+        chunk_file = bolt_chunk_file(chunk, model)
+
+        if not os.path.exists(chunk_file):
+            return
+
+        record = bolt.record_output([chunk_file])
+
+        with manifest_lock:
+            manifest['chunks'][chunk_file] = record
+            bolt.save_manifest(manifest, manifest_file)
+
+        if chunk[0] not in task_chrs:
+            task_chrs.append(chunk[0])
+
+    for chr in task_chrs:
+        merge_futures.append(merge_pool.submit(merge_chromosome, chr, model))
+
+
+## == pending chunks and models ==
+
+## models merged in a previous run from the same chunks are done
+merge_done = {}
+
+
+def pending_tasks():
+
+    """ Lists the chunk and model pairs not completed in a previous
+    run, all of them if the core SNP set is not complete (yet) """
+
+    ## the core SNP set stage resets the manifest at the same time
+    with manifest_lock:
+
+        coreset_done = bolt.output_valid(manifest['stages'].get('coreset'))
+
+        for model in model_list:
+            merge_record = manifest['stages'].get('merge-' + model['name'])
+            merge_done[model['name']] = (coreset_done and bolt.output_valid(merge_record) and
+                                         merge_record['chunks'] == [bolt_chunk_file(c, model) for c in chunk_list])
+
+        ## one per chunk and model, the chunk and model pairs of a chunk
+        ## next to each other as they share its bgen extraction
+        return([(chunk_index, model_index)
+                for chunk_index in range(len(chunk_list))
+                for model_index in range(len(model_list))
+                if not merge_done[model_list[model_index]['name']]
+                and not (coreset_done and bolt.output_valid(manifest['chunks'].get(
+                    bolt_chunk_file(chunk_list[chunk_index], model_list[model_index]))))])
+
+
+def chunk_variants(chunk):
+
+    """ Number of variants of a chunk, from the bgen index if there is
+    one """
+
+    n_variants = bolt.bgen_range_variants(os.path.join(data_dir, (imp_base + str(chunk[0]) + '.bgen')),
+                                          chunk[1])
+
+    return(chunksize if n_variants is None else n_variants)
+
+
+def pack_tasks(pending):
+
+    """ Groups the pending chunks of each model into run-bolt tasks of
+    chunks_per_task consecutive chunks, returns the tasks as tuples
+    (chunk indices, model index) """
+
+    tasks = []
+
+    for model_index in range(len(model_list)):
+        model_chunks = [chunk_index for chunk_index, index in pending if index == model_index]
+        tasks.extend((tuple(model_chunks[i:i + chunks_per_task]), model_index)
+                     for i in range(0, len(model_chunks), chunks_per_task))
+
+    ## the tasks of the same chunks next to each other
+    return(sorted(tasks, key = lambda task: (task[0][0], task[1])))
+
+
+## == extracting bgen chunks ==
+
+## the bgen chunks are extracted by tasks of their own, with 1 core
+## and little memory, before and independent of the core SNP set, so
+## that the bolt-lmm tasks use their cores from the start. run-bolt.py
+## extracts a chunk itself if it is missing, e.g. after a failed
+## extraction
+
+def extract_command(tasks, attempt):
+
+    """ Writes the data file for run-extract.py extracting the given
+    chunks, returns the pipeline command """
+
+    json_file_extract = os.path.join(tempdir, ('data_file_extract_' + str(attempt) + '.json'))
+
+    serial_data = {'chunk-list': chunk_list,
+                   'task-list': tasks,
+                   'tempdir': tempdir,
+                   'trace-dir': trace_dir}
+
+    with open(json_file_extract, "w" ) as fh:
+        json.dump(serial_data, fh )
+
+    return('python3 ' + os.path.join(bindir, 'run-extract.py') + ' --config-file ' + yaml_file + ' --data-file ' + json_file_extract)
+
+
+extract_resources = {'ncpus': 1, 'mem': 4, 'walltime': 4}
+
+
+def extract_stage():
+
+    """ Extracts the bgen chunks of the pending tasks """
+
+    if bgen_access == 'pipe':
+        print('\nbgen chunks are streamed to bolt-lmm, not extracting them')
+        return
+
+    chr_chunks = {}
+
+    for chunk in chunk_list:
+        chr_chunks[chunk[0]] = chr_chunks.get(chunk[0], 0) + 1
+
+    ## a chunk that is a whole chromosome is read from the bgen file
+    extract_list = sorted({chunk_index for chunk_index, model_index in pending_tasks()
+                           if chr_chunks[chunk_list[chunk_index][0]] > 1})
+
+    print('\n' + str(len(extract_list)) + ' bgen chunk(s) to extract')
+
+    if not extract_list:
+        return
+
+    extract_features = [{'variants': chunk_variants(chunk_list[chunk_index])}
+                        for chunk_index in extract_list]
+
+    extract_results, extract_attempts = bolt.run_tasks(executor, 'run-extract', log_dir,
+                                                       task_resources('run-extract', extract_resources,
+                                                                      extract_features),
+                                                       extract_list, extract_command, retry,
+                                                       cores = local_cores, mem = local_mem)
+
+    record_history('run-extract', extract_list, extract_features, extract_attempts)
+    trace_attempts('run-extract', extract_attempts)
+
+    with manifest_lock:
+        manifest.setdefault('attempts', {}).setdefault('run-extract', []).extend(extract_attempts)
+        bolt.save_manifest(manifest, manifest_file)
+
+    extract_failed = [chunk_list[chunk_index] for chunk_index, result in zip(extract_list, extract_results)
+                      if result['failure']]
+
+    if extract_failed:
+        print('\nrun-extract failed for chunk(s) ' + str(extract_failed) + ', see logs in ' +
+              log_dir + '. The run-bolt tasks extract them')
 
 
 ## == serialising data for run-bolt.py ==
 
-json_file_bolt = os.path.join(tempdir, ('data_file_' + uuid.uuid4().hex + '.json'))
+def bolt_command(tasks, attempt):
 
-serial_data = {'chr-list': chr_list,
-               'chunk-list': chunk_list,
-               'imp-list': imp_base_list,
-               'tempdir': tempdir,
-               'plink-dir': plink_dir,
-               'bolt-dir': bolt_dir,
-               'bolt-tempdir': bolt_tempdir,
-               'coreset-path': coreset_path}
+    """ Writes the data file for run-bolt.py running the given tasks,
+    returns the pipeline command """
 
-with open(json_file_bolt, "w" ) as fh:
-    json.dump(serial_data, fh )
+    json_file_bolt = os.path.join(tempdir, ('data_file_bolt_' + str(attempt) + '.json'))
+
+    serial_data = {'chr-list': chr_list,
+                   'chunk-list': chunk_list,
+                   'model-list': model_list,
+                   'task-list': tasks,
+                   'imp-list': imp_base_list,
+                   'tempdir': tempdir,
+                   'plink-dir': plink_dir,
+                   'bolt-dir': bolt_dir,
+                   'bolt-tempdir': bolt_tempdir,
+                   'coreset-path': coreset_path,
+                   'remove-samples-list': remove_samples_list,
+                   'trace-dir': trace_dir}
+
+    with open(json_file_bolt, "w" ) as fh:
+        json.dump(serial_data, fh )
+
+    return('python3 ' + os.path.join(bindir, 'run-bolt.py') + ' --config-file ' + yaml_file + ' --data-file ' + json_file_bolt)
 
 
 ## == running bolt ==
 
-pipeline_command_1 = 'python3 ' + os.path.join(bindir, 'run-bolt.py') + ' --config-file ' + yaml_file + ' --data-file ' + json_file_bolt
+## with chunks sized to a target wall time, ask for that wall time
+## with a safety margin, up to the 72 hours maximum of the throughput
+## node. Tasks of several chunks fit the model once
+if chunk_mode == 'cost':
+    bolt_walltime = min(72, 1.5 * (chunk_walltime * chunks_per_task -
+                                   (chunks_per_task - 1) * cost_model['fixed'] / 3600))
+else:
+    bolt_walltime = 72
+
+bolt_resources = {'ncpus': int(ncpus), 'mem': 48, 'walltime': bolt_walltime}
+
+
+def run_bolt_stage():
+
+    """ Runs bolt-lmm on the chunks and models not completed in a
+    previous run, merging each chromosome as it completes """
+
+    pending = pending_tasks()
+
+    print('\n' + str(len(pending)) + ' of ' + str(len(chunk_list) * len(model_list)) +
+          ' chunk(s) to run')
+
+    task_list = pack_tasks(pending)
+
+    if chunks_per_task > 1:
+        print('\n' + str(len(task_list)) + ' run-bolt task(s) of up to ' + str(chunks_per_task) +
+              ' chunks')
+
+    ## chromosomes whose chunks have all completed in a previous run
+    for model in model_list:
+        if not merge_done[model['name']]:
+            for chr in chr_list:
+                merge_chromosome(chr, model)
+
+
+    if task_list:
+
+        n_coreset_snps = bolt.count_lines(coreset_path + '.bim')
+
+        bolt_features = [{'samples': model_list[model_index]['samples'],
+                          'coreset-snps': n_coreset_snps,
+                          'variants': sum(chunk_variants(chunk_list[chunk_index])
+                                          for chunk_index in chunk_indices)}
+                         for chunk_indices, model_index in task_list]
+
+        with bolt.trace_span('run-bolt', 'stage', tasks = len(task_list)):
+            bolt_results, bolt_attempts = bolt.run_tasks(executor, 'run-bolt', log_dir,
+                                                         task_resources('run-bolt', bolt_resources, bolt_features),
+                                                         task_list, bolt_command, retry,
+                                                         cores = local_cores, mem = local_mem,
+                                                         on_finished = chunk_finished)
+
+        ## the chromosomes completed while the tasks ran are merged
+        ## before a failure ends the run, so that a resumed run keeps
+        ## them
+        for future in concurrent.futures.as_completed(merge_futures):
+            future.result()
+
+        record_history('run-bolt', task_list, bolt_features, bolt_attempts)
+        trace_attempts('run-bolt', bolt_attempts)
+
+        with manifest_lock:
+            manifest.setdefault('attempts', {}).setdefault('run-bolt', []).extend(bolt_attempts)
+            bolt.save_manifest(manifest, manifest_file)
+
+        bolt_failed = [([chunk_list[i] for i in task[0]], model_list[task[1]]['name'], result['failure'])
+                       for task, result in zip(task_list, bolt_results) if result['failure']]
+
+        if bolt_failed:
+            sys.exit('run-bolt failed for chunk(s) and model(s) ' + str(bolt_failed) +
+                     ', see logs in ' + log_dir + '. Run again with --resume to rerun the failed chunks')
+
+
+## == joining chromosomes ==
+
+def join_stage(model):
+
+    """ Joins the chromosomes of a model into its results, with the
+    top hits, diagnostics and further output formats """
+
+    bolt_outfile = os.path.join(bolt_dir, (model['name'] + '.bolt.txt'))
+
+    if merge_done[model['name']]:
+        print('\n' + bolt_outfile + ' completed in previous run')
+        return
+
+    print('\njoining chromosomes of ' + model['name'] + ' and writing to file ' + bolt_outfile)
+
+    bolt_tempfile_list = [bolt_chunk_file(chunk, model) for chunk in chunk_list]
+
+    missing = [f for f in bolt_tempfile_list if not bolt.output_valid(manifest['chunks'].get(f))]
+
+    if missing:
+        sys.exit('missing or changed bolt-lmm output chunk(s) ' + str(missing) +
+                 '. Run again with --resume to rerun them')
+
+    ## chromosomes in the order of the chunks, all of them merged by
+    ## now unless the chunks were completed but not merged before
+    model_chr_list = []
+
+    for chunk in chunk_list:
+        if chunk[0] not in model_chr_list:
+            model_chr_list.append(chunk[0])
+            merge_chromosome(chunk[0], model)
+
+    chr_files = [chromosome_file(chr, model) for chr in model_chr_list]
+
+    ## the top hits and diagnostics are collected in the same pass
+    hits = bolt.hit_table(hits_filters, hits_max)
+    diagnostics = bolt.diagnostics_table() if diagnostics_enabled else None
+
+    with bolt.trace_span('merge', 'stage', model = model['name']) as span:
+        merge_stats = bolt.merge_bolt_chunks(chr_files, bolt_outfile, hits = hits,
+                                             diagnostics = diagnostics)
+        span.update(merge_stats)
+
+    n_duplicates = sum(manifest['stages']['merge-' + model['name'] + '-chr' + str(chr)]['duplicates']
+                       for chr in model_chr_list)
+
+    print('\nwritten ' + str(merge_stats['variants']) + ' variants, removed ' +
+          str(n_duplicates) + ' duplicate(s) at chunk boundaries')
 
-echo_command_1 = 'echo -e "%s"' % pipeline_command_1
+    hits_file = os.path.join(bolt_dir, (model['name'] + '.hits.tsv'))
 
-qsub_command_1 = 'qsub -S /bin/bash -o ' + log_dir + ' -e ' + log_dir + ' -V -N run-bolt -J ' + ('1-' + str(len(chunk_list))) + ' -lselect=1:ncpus=' + ncpus + ':mem=48gb' + ' -lwalltime=72:00:00'
+    print('\n' + str(hits['passed']) + ' variant(s) passing the hit filters, written ' +
+          str(bolt.write_hits(hits, hits_file)) + ' top hit(s) to ' + hits_file)
 
-cmd_1 = echo_command_1 + " | " + qsub_command_1
+    merge_files = [bolt_outfile, hits_file]
 
-print('\nrunning run-bolt.py on the pbs queue')
+    if diagnostics is not None:
 
-print('\npipeline command: ' + pipeline_command_1)
-      
-print('\nqsub command: ' + str(qsub_command_1))
+        diagnostics_file = os.path.join(bolt_dir, (model['name'] + '.diagnostics.json'))
 
-print('\ncommand: ' + cmd_1)
+        summary = bolt.write_diagnostics(diagnostics, diagnostics_file)
+        merge_files.append(diagnostics_file)
 
-p1_1 = subprocess.Popen(shlex.split(echo_command_1), stdout=subprocess.PIPE)
-p2_1 = subprocess.Popen(shlex.split(qsub_command_1), stdin=p1_1.stdout, stdout=subprocess.PIPE)
-## Allow p1 to receive a SIGPIPE if p2 exits
-p1_1.stdout.close()
+        print('\nvariants per chromosome: ' +
+              ', '.join(chr + ': ' + str(n) for chr, n in summary['chromosomes'].items()))
+        print('lambda GC: ' + ', '.join(column + ' ' + ('%.3f' % value if value is not None else 'NA')
+                                        for column, value in summary['lambda-gc'].items()))
 
-job_id_1 = p2_1.communicate()[0].decode('UTF-8').replace('.pbs', '').rstrip()
+        plot_files = bolt.plot_diagnostics(summary,
+                                           os.path.join(bolt_dir, (model['name'] + '.qq.png')),
+                                           os.path.join(bolt_dir, (model['name'] + '.manhattan.png')))
+        if plot_files is not None:
+            merge_files.extend(plot_files)
 
-print("\nrunning script run-bolt.py as job-id: " + job_id_1)
+    ## compressed and indexed copy for region lookups
+    if output_bgzip:
+        with bolt.trace_span('bgzip', 'stage', model = model['name']):
+            bolt.bgzip_tabix(bolt_outfile, threads = int(ncpus))
+        merge_files.extend([bolt_outfile + '.gz', bolt_outfile + '.gz.tbi'])
 
+    ## columnar copy, partitioned by chromosome
+    if output_parquet:
+        with bolt.trace_span('parquet', 'stage', model = model['name']):
+            bolt.write_parquet(bolt_outfile, os.path.join(bolt_dir, (model['name'] + '.parquet')))
 
-## == monitoring the qsub processes ==
+    merge_record = dict(bolt.record_output(merge_files), chunks = bolt_tempfile_list)
 
-bolt.monitor_qsub(job_id_1)
+    with manifest_lock:
 
-## == concatenating bolt chunks ==
+        manifest['stages']['merge-' + model['name']] = merge_record
 
-bolt_outfile = os.path.join(bolt_dir, 'model_1.bolt.txt')
+        if not merge_keep_chromosomes:
+            for chr in model_chr_list:
+                os.remove(chromosome_file(chr, model))
+                del manifest['stages']['merge-' + model['name'] + '-chr' + str(chr)]
 
-print('\nconcatenating bolt-lmm output chunks and writing to file ' + bolt_outfile)
+        bolt.save_manifest(manifest, manifest_file)
 
-bolt_tempfile_list = []
 
-for chunk in chunk_list:
+## == running the stages ==
 
-    ## print('chunk: ' + str(chunk))
-    chr = chunk[0]
-    ## print('chr: ' + chr)
-    interval = chunk[1]
+## the stages run as soon as the stages they depend on are complete:
+## the core SNP set at the same time as chunk planning and bgen
+## extraction, the models are joined at the same time. The bolt-lmm
+## tasks wait for the extraction of their chunks, so that the jobs
+## with many cores do not extract chunks themselves (only chunks whose
+## extraction failed); streamed chunks are not extracted
+run_bolt_after = ['samples', 'coreset', 'plan-chunks']
 
-    bolt_tempfile = os.path.join(bolt_tempdir, (imp_base + str(chr) + '_' + interval[0] + '-' +
-                                            interval[1] + '.model_1.bolt'))
+if bgen_access == 'extract':
+    run_bolt_after.append('extract-bgen')
 
-    bolt_tempfile_list.append(bolt_tempfile)
+stages = {'samples': (samples_stage, []),
+          'coreset': (coreset_stage, ['samples']),
+          'plan-chunks': (plan_chunks_stage, []),
+          'extract-bgen': (extract_stage, ['plan-chunks']),
+          'run-bolt': (run_bolt_stage, run_bolt_after)}
 
-## print(bolt_tempfile_list)
+for model in model_list:
+    stages['join-' + model['name']] = (lambda model = model: join_stage(model), ['run-bolt'])
 
+## the chromosomes are planned in processes forked before the stages
+## run in threads, no more of them than the local executor may use
+plan_pool = bolt.process_pool(min(bolt.local_capacity(local_cores, local_mem)[0], len(chr_list)))
 
-bolt_df = pd.concat((pd.read_csv(f, sep = '\t', dtype={'CHR': 'str', 'BP': 'str', 'GENPOS' : 'str', 'CHISQ_BOLT_LMM_INF' : 'str'}) for f in bolt_tempfile_list), ignore_index=True)
+try:
+    bolt.run_stages(stages)
+finally:
+    plan_pool.shutdown()
+    merge_pool.shutdown()
 
-bolt_df.to_csv(bolt_outfile, sep='\t', index=False, quoting=None)
 
+## the trace directory is in the temporary directory
+write_trace()
+atexit.unregister(write_trace)
 
 if(temp_delete):
     print('\ndeleting temporary directory ' + tempdir)
@@ -6,6 +6,9 @@ import argparse
 import sys
 import socket
 import json
+import contextlib
+import shlex
+import time
 from datetime import datetime
 from pathlib import Path
 
@@ -87,14 +90,21 @@ pheno_file = cfg['pheno-file']
 data_dir = cfg['data-dir'] 
 imp_base = cfg['imp-base']
 
-pheno_1 = cfg['pheno-1']
-cov_1 = cfg['cov-1']
 ncpus = str(cfg['ncpus'])
 ldscore_file = cfg['ldscore-file']
 min_maf = cfg['min-maf']
 min_info = cfg['min-info']
 
-remove_samples_list = cfg['remove-samples-list']
+## persistent cache of bgen chunks, size in gb
+bgen_cache_dir = cfg.get('bgen-cache-dir')
+bgen_cache_size = cfg.get('bgen-cache-size', 1000)
+
+if bgen_cache_dir:
+    bgen_cache_dir = os.path.expandvars(bgen_cache_dir)
+
+## 'extract' writes the bgen file of each chunk, 'pipe' streams it to
+## bolt-lmm through a named pipe, extracting it only if that fails
+bgen_access = cfg.get('bgen-access', 'extract')
 
 
 ## serialised json_list
@@ -108,6 +118,10 @@ bolt_tempdir = serial_list['bolt-tempdir']
 tempdir = serial_list['tempdir']
 coreset_path = serial_list['coreset-path']
 
+## the remove-samples-list main.py runs with, see its
+## --remove-samples-list
+remove_samples_list = serial_list['remove-samples-list']
+
 ## creating directory, dealing with race condition
 bgen_tempdir = os.path.join(tempdir, 'temp-bgen')
 Path(bgen_tempdir).mkdir(parents=True, exist_ok=True)
@@ -124,116 +138,249 @@ base_index = int(pbs_array_index) - 1
 print('pbs array index: ' + str(pbs_array_index))
 print('debug mode: ' + str(debug_mode)) 
 print('base index: ' + str(base_index))
+
+
+## == task: chunks and model ==
+
+## each task runs one model on one or more chunks (chunks-per-task),
+## fitting the model once for all of them
+chunk_indices, model_index = serial_list['task-list'][base_index]
+
+chunks = [serial_list['chunk-list'][chunk_index] for chunk_index in chunk_indices]
+model = serial_list['model-list'][model_index]
+
+print('chunk(s): ' + str(chunks))
+print('model: ' + str(model))
+
+chunk_base = bolt.chunk_name(imp_base, chunks[0])
+
+## spans of this task, combined into the trace of the run by main.py
+if serial_list.get('trace-dir'):
+    bolt.set_trace_file(os.path.join(serial_list['trace-dir'],
+                                      ('run-bolt.' + chunk_base + '.' + model['name'] + '.jsonl')))
+
+
+## == bolt-lmm options ==
+
+stats_file = os.path.join(bolt_tempdir, (chunk_base + '.' + model['name'] + '.coresnps'))
+
+## output of each chunk
+stats_files_bgen_snps = [os.path.join(bolt_tempdir, (bolt.chunk_name(imp_base, chunk) + '.' +
+                                                     model['name'] + '.bolt'))
+                         for chunk in chunks]
+
+## output of bolt-lmm, of all chunks
+stats_file_bgen_snps = stats_files_bgen_snps[0] + '.part'
+
+# phenotypes
+pheno_col = model['pheno']
+print('\nphenotype: ' + pheno_col)
+
+## categorial and quantitative covariates
+print('\ncovariates: ' + model['cov'])
+## phenotype file of the model's columns and complete cases, and the
+## samples of the core SNP set the model does not analyse, see
+## bolt.write_model_samples
+model_pheno_file = model.get('pheno-file', pheno_file)
+model_remove_file = model.get('remove-file', remove_samples_list)
+
+print('phenotype file: ' + model_pheno_file)
+
+covar_string = bolt.covar_options(model['cov'], model_pheno_file)
+
+## if there is a file with samples to remove
+if(model_remove_file):
+    print('\nsamples to remove in file: ' + model_remove_file)
+    remove_string = ' --remove=' + model_remove_file
+else:
+    remove_string = ''
     
+## TODO get betas
+bolt_options = (' --bfile=' + coreset_path +
+                ' --noBgenIDcheck' +
+                ' --sampleFile=' + sample_file +
+                ' --phenoFile=' + model_pheno_file +
+                ' --phenoCol=' + pheno_col +
+                ' --lmm' +
+                ' --covarMaxLevels=50 ' +
+                ' --h2gGuess=0.15 ' +
+                ' --numThreads=' + ncpus +
+                ' --LDscoresFile=' + ldscore_file +
+                ' --LDscoresMatchBp' +
+                ' --verboseStats' +
+                ' --bgenMinMAF=' + str(min_maf) +
+                ' --bgenMinINFO=' + str(min_info) +
+                ' --statsFile=' + stats_file +
+                ' --statsFileBgenSnps=' + stats_file_bgen_snps +
+                covar_string +
+                remove_string
+                )
 
-## == generating bgenfile for range ==
 
-chunk = serial_list['chunk-list'][base_index]
-print('chunk: ' + str(chunk))
+## lines of the bolt-lmm output marking the start of the association
+## tests and its wall time
+bolt_streaming = re.compile(r'=== Streaming genotypes')
+bolt_elapsed = re.compile(r'Total elapsed time for analysis = ([0-9.eE+-]+) sec')
 
-chr = chunk[0]
-interval = chunk[1]
 
-bgen_file = os.path.join(data_dir, (imp_base + str(chr) + '.bgen'))
-bgen_tempfile= (os.path.join(bgen_tempdir, (imp_base + str(chr) + '_' + interval[0] + '-' +
-                                            interval[1] + '.bgen')))
+def run_bolt(bgen_chunkfiles):
 
-## bgen range needs a leading 0 for 1-digit chromosomes (WTF!)
-bgen_range = str(chr).zfill(2) + ':' + interval[0] + '-' + interval[1]
+    """ Runs bolt-lmm on bgen files, one per chunk, returns its exit
+    status. The output of bolt-lmm is passed on line by line, to trace
+    the model fit and the association tests separately """
 
-bgen_c = 'bgenix -g ' + bgen_file + ' -incl-range ' + bgen_range + ' > ' + bgen_tempfile
+    bolt_c = 'bolt ' + ''.join(' --bgenFile=' + f for f in bgen_chunkfiles) + bolt_options
 
-print('\ngenerating bgen file for range ' + bgen_range + ' with command')
-print('\n' + bgen_c)
+    print('\nrunning bolt-lmm with command')
+    print('\n' + bolt_c)
 
-os.system(bgen_c)
+    sys.stdout.flush()
 
-## bgen index
-bgen_idx_c = 'bgenix -g ' + bgen_tempfile + ' -index'
+    start_time = time.time()
+    assoc_time = None
+    elapsed = None
 
-print('\nindexing bgen file ' + bgen_tempfile)
-print('\n' + bgen_idx_c)
+    bolt_process = subprocess.Popen(shlex.split(bolt_c), stdout = subprocess.PIPE,
+                                    universal_newlines = True)
 
-os.system(bgen_idx_c)
+    for line in bolt_process.stdout:
 
+        sys.stdout.write(line)
 
-## == run bolt-lmm ==
+        ## the association tests start with streaming the genotypes
+        ## of the bgen snps, after the model fit on the core snps
+        if assoc_time is None and bolt_streaming.match(line):
+            assoc_time = time.time()
 
-## TODO multiple models
-stats_file = (os.path.join(bolt_tempdir, (imp_base + str(chr) + '_' + interval[0] + '-' +
-                                            interval[1] + '.model_1.coresnps')))
+        elapsed_match = bolt_elapsed.match(line)
+        if elapsed_match:
+            elapsed = float(elapsed_match.group(1))
 
-stats_file_bgen_snps = (os.path.join(bolt_tempdir, (imp_base + str(chr) + '_' + interval[0] +
-                                                    '-' + interval[1] + '.model_1.bolt')))
+    bolt_process.wait()
 
-# phenotypes
-pheno_col = pheno_1.split(',')[0]
-print('\nphenotype: ' + pheno_col)
+    end_time = time.time()
 
-# categorial covariates
-ccovar = cov_1.split(';')[0].split(',')
+    if assoc_time is None:
+        bolt.trace_event('bolt-lmm', 'bolt', start_time, end_time,
+                         exit_status = bolt_process.returncode, elapsed = elapsed)
+    else:
+        bolt.trace_event('bolt-lmm model fit', 'bolt', start_time, assoc_time)
+        bolt.trace_event('bolt-lmm association', 'bolt', assoc_time, end_time,
+                         exit_status = bolt_process.returncode, elapsed = elapsed)
 
-## test if there are categorial covariates
-if(ccovar[0] != ''):
-    print('\ncategorial covariate(s): ' + str(ccovar))
-    ccovar_string = ''.join([(' --covarCol=' + x) for x in ccovar])
-else:
-    ccovar_string = ''
+    return(bolt_process.returncode)
 
-# quantitative covariates
-qcovar = cov_1.split(';')[1].split(',')
 
-## test if there are quantitative covariates
-if(qcovar[0] != ''):
-    print('\nquantitative covariate(s): ' + str(qcovar))
-    qcovar_string = ''.join([(' --qCovarCol=' + x) for x in qcovar])
-else:
-    qcovar_string = ''
+## == bgen files for ranges and running bolt-lmm ==
+
+def chunk_bgen(chunk):
+
+    """ Path of the imputed bgen file of a chunk and its range in
+    bgenix format """
+
+    ## bgen range needs a leading 0 for 1-digit chromosomes (WTF!)
+    return(os.path.join(data_dir, (imp_base + str(chunk[0]) + '.bgen')),
+           str(chunk[0]).zfill(2) + ':' + chunk[1][0] + '-' + chunk[1][1])
+
+
+## chunks in the cache stay locked against eviction until bolt-lmm
+## has finished
+chunk_stack = contextlib.ExitStack()
+
+
+def materialise_chunk(chunk):
+
+    """ Extracts a chunk, once for the tasks of all models and with a
+    chunk cache for later runs, returns the path of its bgen file. A
+    chunk that is the whole chromosome is not extracted, bolt-lmm
+    reads the bgen file itself """
+
+    bgen_file, bgen_range = chunk_bgen(chunk)
+
+    if len([c for c in serial_list['chunk-list'] if c[0] == chunk[0]]) == 1:
+        print('\nchunk is the whole chromosome, using bgen file ' + bgen_file)
+        print('\nbgen file not extracted, saved writing ' +
+              str(os.path.getsize(bgen_file)) + ' bytes')
+        return(bgen_file)
+
+    with bolt.trace_span('bgen chunk', 'bgen', range = bgen_range, cached = bool(bgen_cache_dir)):
+        if bgen_cache_dir:
+            return(chunk_stack.enter_context(
+                bolt.bgen_cache_chunk(bgen_cache_dir, bgen_file, bgen_range, bgen_cache_size)))
+        else:
+            bgen_chunkfile = os.path.join(bgen_tempdir, (bolt.chunk_name(imp_base, chunk) + '.bgen'))
+            return(bolt.extract_bgen_chunk(bgen_file, bgen_range, bgen_chunkfile))
+
+
+n_chr_chunks = len([c for c in serial_list['chunk-list'] if c[0] == chunks[0][0]])
+
+if bgen_access == 'pipe' and len(chunks) == 1 and n_chr_chunks > 1:
+
+    bgen_file, bgen_range = chunk_bgen(chunks[0])
+
+    ## bytes of the chunk in the bgen file, i.e. not written (and read
+    ## again for indexing) without extracting the chunk
+    bgen_range_bytes = bolt.bgen_range_bytes(bgen_file, chunks[0][1])
+
+    ## bgenix is killed only if bolt-lmm fails, e.g. stops reading the
+    ## pipe; bgenix failing, e.g. stopping early, fails the streamed
+    ## chunk even if bolt-lmm has finished on what it read. bolt-lmm
+    ## is run again on the extracted chunk only if the stream failed,
+    ## not if bolt-lmm failed on its own
+    bolt_returncode, streamed = bolt.run_bgen_streamed(bgen_file, bgen_range,
+                                                       lambda pipe: run_bolt([pipe]),
+                                                       lambda: run_bolt([materialise_chunk(chunks[0])]))
+
+    if bolt_returncode == 0 and streamed:
+        print('\nbgen chunk streamed, saved writing ' + str(bgen_range_bytes) + ' bytes')
 
-if((ccovar[0] != '') or (ccovar[0] != '')):
-    print('\ncovariates in file: ' + pheno_file)
-    covar_file_string = ' --covarFile=' + pheno_file
 else:
-    covar_file_string = ''
+    ## several chunks are always extracted, bolt-lmm reads their bgen
+    ## files one after the other
+    bolt_returncode = run_bolt([materialise_chunk(chunk) for chunk in chunks])
 
-## if there is a file with samples to remove
-if(remove_samples_list):
-    print('\nsamples to remove in file: ' + remove_samples_list)
-    remove_string = ' --remove=' + remove_samples_list
+chunk_stack.close()
+
+
+def check_chunk_rows(chunk_counts, chunk_files = ()):
+
+    """ Exits if bolt-lmm has written more variants for a chunk than
+    the bgen index lists for its range, or, without MAF and INFO
+    filters, fewer of them, e.g. as the bgen chunk was cut short (see
+    bolt.chunk_rows_valid). The output files of the chunks are removed
+    first """
+
+    filtered = bool(min_maf) or bool(min_info)
+
+    for chunk, n_rows in zip(chunks, chunk_counts):
+
+        n_variants = bolt.bgen_range_variants(chunk_bgen(chunk)[0], chunk[1])
+
+        if n_variants is None:
+            continue
+
+        if not bolt.chunk_rows_valid(n_rows, n_variants, filtered):
+            for chunk_file in chunk_files:
+                if os.path.exists(chunk_file):
+                    os.remove(chunk_file)
+            sys.exit('bolt-lmm wrote ' + str(n_rows) + ' variant(s) for chunk ' + str(chunk) +
+                     ' of ' + str(n_variants) + ' in the bgen index')
+
+
+if bolt_returncode != 0:
+    sys.exit('bolt-lmm failed with exit status ' + str(bolt_returncode))
+
+## the output files only exist if bolt-lmm has finished successfully
+## and has written the variants of all chunks
+if len(chunks) == 1:
+    chunk_counts = [bolt.count_lines(stats_file_bgen_snps) - 1]
+    check_chunk_rows(chunk_counts)
+    os.replace(stats_file_bgen_snps, stats_files_bgen_snps[0])
 else:
-    remove_string = ''
-    
-## TODO multiple models
-## TODO get betas
-bolt_c = ('bolt ' +
-          ' --bfile=' + coreset_path +
-          ' --noBgenIDcheck' +
-          ' --bgenFile=' + bgen_tempfile +
-          ' --sampleFile=' + sample_file +
-          ' --phenoFile=' + pheno_file +
-          ' --phenoCol=' + pheno_col +
-          ' --lmm' +
-          ' --covarMaxLevels=50 ' +
-          ' --h2gGuess=0.15 ' +
-          ' --numThreads=' + ncpus +
-          ' --LDscoresFile=' + ldscore_file +
-          ' --LDscoresMatchBp' +
-          ' --verboseStats' +
-          ' --bgenMinMAF=' + str(min_maf) +
-          ' --bgenMinINFO=' + str(min_info) +
-          ' --statsFile=' + stats_file +
-          ' --statsFileBgenSnps=' + stats_file_bgen_snps +
-          covar_file_string +
-          ccovar_string +
-          qcovar_string +
-          remove_string
-          )
-
-print('\nrunning bolt-lmm with command')
-print('\n' + bolt_c)
-
-## not rather subprocess.run ?
-os.system(bolt_c)
+    chunk_counts = bolt.split_bolt_output(stats_file_bgen_snps, chunks, stats_files_bgen_snps)
+    os.remove(stats_file_bgen_snps)
+    print('\nsplit bolt-lmm output into chunks with ' + str(chunk_counts) + ' variants')
+    check_chunk_rows(chunk_counts, stats_files_bgen_snps)
 
 print('\nfinished running bolt-lmm at: ' + str(datetime.now()))
 
@@ -0,0 +1,102 @@
+import os.path
+import yaml
+import argparse
+import sys
+import socket
+import json
+from datetime import datetime
+
+## path to library files
+bindir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(bindir, "../lib/"))
+
+import bolt
+
+program = os.path.basename(sys.argv[0])
+version = bolt.__version__()
+host = socket.gethostname()
+
+## change to current working directory (directory where qsub was
+## executed) within PBS job (workaround for SGE option "-cwd")
+if 'PBS_O_WORKDIR' in os.environ:
+    wd = os.environ['PBS_O_WORKDIR']
+    os.chdir(wd)
+
+print('\nProgram: ' + program)
+print('Version: ' + version)
+print('Host: ' + host)
+print('Start time: ' + str(datetime.now()))
+
+
+## == parsing arguments ==
+
+parser = argparse.ArgumentParser(description = "running the plink filters of the core SNP set in a process pool")
+
+## required arguments
+
+requiredNamed = parser.add_argument_group('required named arguments')
+
+requiredNamed.add_argument('-c', '--config-file', dest = 'config_file', required = True,
+                           help = 'path to yaml configuration file',
+                           type = lambda x: bolt.is_valid_file(parser, x))
+
+requiredNamed.add_argument('-f', '--data-file', dest = 'data_file',
+                           required = True,
+                           help = 'path to json data file', metavar = 'FILE',
+                           type = lambda x: bolt.is_valid_file(parser, x))
+
+## optional arguments
+
+parser.add_argument('-v', '--version',
+                    ## metavar = '',
+                    action = 'version', version='%(prog)s ' + version,
+                    help='prints out the version of the program')
+
+
+args = parser.parse_args()
+
+yaml_file = args.config_file
+
+## serialised json_list
+serial_list = json.load(open(args.data_file, 'rb'))
+
+
+## == running plink ==
+
+## one job of plink-cores and plink-mem runs the plink filters of all
+## chromosomes in a local process pool, instead of an array job that
+## waits in the queue. main.py merges the core SNP sets
+
+tempdir = serial_list['plink-data']['tempdir']
+
+
+def plink_command(gen_bases, attempt):
+
+    """ Writes the data file for run-plink.py running the given
+    chromosomes, returns the pipeline command """
+
+    json_file_plink = os.path.join(tempdir, ('data_file_plink_' + str(attempt) + '.json'))
+
+    serial_data = dict(serial_list['plink-data'], **{'gen-list': gen_bases})
+
+    with open(json_file_plink, "w" ) as fh:
+        json.dump(serial_data, fh )
+
+    return('python3 ' + os.path.join(bindir, 'run-plink.py') + ' --config-file ' + yaml_file + ' --data-file ' + json_file_plink)
+
+
+plink_results, plink_attempts = bolt.run_tasks('local', 'run-plink', serial_list['log-dir'],
+                                               serial_list['resources'], serial_list['gen-list'],
+                                               plink_command, serial_list['retry'],
+                                               cores = serial_list['cores'], mem = serial_list['mem'])
+
+## the results of the tasks for main.py, written last, so that they
+## exist only if all tasks have run
+results_file = serial_list['results-file']
+
+with open(results_file + '.tmp', 'w') as fh:
+    json.dump({'results': plink_results, 'attempts': plink_attempts}, fh)
+
+os.replace(results_file + '.tmp', results_file)
+
+print('\nfinished running plink at: ' + str(datetime.now()))
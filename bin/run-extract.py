@@ -0,0 +1,154 @@
+import os.path
+import yaml
+import argparse
+import sys
+import socket
+import json
+from datetime import datetime
+from pathlib import Path
+
+## path to library files
+bindir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(bindir, "../lib/"))
+
+import bolt
+
+program = os.path.basename(sys.argv[0])
+version = bolt.__version__()
+host = socket.gethostname()
+
+## If not in debug mode, change to current working directory
+## (directory where qsub was executed) within PBS job (workaround for
+## SGE option "-cwd")
+
+## needs python 3.8
+if 'PBS_O_WORKDIR' in os.environ:
+    wd = os.environ['PBS_O_WORKDIR']
+    os.chdir(wd)
+
+print('\nProgram: ' + program)
+print('Version: ' + version)
+print('Host: ' + host)
+print('Start time: ' + str(datetime.now()))
+
+
+## == parsing arguments ==
+
+parser = argparse.ArgumentParser(description = "extracting the bgen chunks of the bolt-lmm analysis pipeline")
+
+## required arguments
+
+requiredNamed = parser.add_argument_group('required named arguments')
+
+requiredNamed.add_argument('-c', '--config-file', dest = 'config_file', required = True,
+                           help = 'path to yaml configuration file',
+                           type = lambda x: bolt.is_valid_file(parser, x))
+
+requiredNamed.add_argument('-f', '--data-file', dest = 'data_file',
+                           required = True,
+                           help = 'path to json data file', metavar = 'FILE',
+                           type = lambda x: bolt.is_valid_file(parser, x))
+
+## optional arguments
+
+parser.add_argument('-d', '--debug-mode',
+                    dest = 'debug_mode',
+                    action='store_true',
+                    help='run in debug mode if set')
+
+parser.add_argument('-v', '--version',
+                    ## metavar = '',
+                    action = 'version', version='%(prog)s ' + version,
+                    help='prints out the version of the program')
+
+
+args = parser.parse_args()
+
+## run mode
+debug_mode = args.debug_mode
+
+data_file = args.data_file
+
+
+## == configurations ==
+
+## get configurations from yaml file
+yaml_file = args.config_file
+
+yaml_fh = open(yaml_file, 'r')
+cfg = yaml.safe_load(yaml_fh)
+
+## import parameters from yaml
+data_dir = cfg['data-dir']
+imp_base = cfg['imp-base']
+
+## persistent cache of bgen chunks, size in gb
+bgen_cache_dir = cfg.get('bgen-cache-dir')
+bgen_cache_size = cfg.get('bgen-cache-size', 1000)
+
+if bgen_cache_dir:
+    bgen_cache_dir = os.path.expandvars(bgen_cache_dir)
+
+
+## serialised json_list
+serial_list = json.load(open(data_file, 'rb'))
+
+
+## == file paths ==
+tempdir = serial_list['tempdir']
+
+## creating directory, dealing with race condition
+bgen_tempdir = os.path.join(tempdir, 'temp-bgen')
+Path(bgen_tempdir).mkdir(parents=True, exist_ok=True)
+
+
+## to debug
+if debug_mode:
+    pbs_array_index = 1
+else:
+    pbs_array_index = os.environ['PBS_ARRAY_INDEX']
+
+base_index = int(pbs_array_index) - 1
+
+print('pbs array index: ' + str(pbs_array_index))
+print('debug mode: ' + str(debug_mode))
+print('base index: ' + str(base_index))
+
+
+## == task: chunk ==
+
+## each task extracts one chunk, for the run-bolt tasks of all models
+chunk = serial_list['chunk-list'][serial_list['task-list'][base_index]]
+
+print('chunk: ' + str(chunk))
+
+chr = chunk[0]
+interval = chunk[1]
+chunk_base = bolt.chunk_name(imp_base, chunk)
+
+## spans of this task, combined into the trace of the run by main.py
+if serial_list.get('trace-dir'):
+    bolt.set_trace_file(os.path.join(serial_list['trace-dir'],
+                                      ('run-extract.' + chunk_base + '.jsonl')))
+
+
+## == extracting the bgen chunk ==
+
+bgen_file = os.path.join(data_dir, (imp_base + str(chr) + '.bgen'))
+
+## bgen range needs a leading 0 for 1-digit chromosomes
+bgen_range = str(chr).zfill(2) + ':' + interval[0] + '-' + interval[1]
+
+## the same files run-bolt.py uses, it extracts a chunk only if it is
+## not there
+with bolt.trace_span('bgen chunk', 'bgen', range = bgen_range, cached = bool(bgen_cache_dir)):
+    if bgen_cache_dir:
+        with bolt.bgen_cache_chunk(bgen_cache_dir, bgen_file, bgen_range, bgen_cache_size) as bgen_chunkfile:
+            pass
+    else:
+        bgen_chunkfile = bolt.extract_bgen_chunk(bgen_file, bgen_range,
+                                                 os.path.join(bgen_tempdir, (chunk_base + '.bgen')))
+
+print('\nbgen chunk ' + bgen_chunkfile + ': ' + str(os.path.getsize(bgen_chunkfile)) + ' bytes')
+
+print('\nfinished extracting bgen chunk at: ' + str(datetime.now()))
@@ -1,5 +1,6 @@
 import os.path
 import subprocess
+import shlex
 import yaml
 import argparse
 import sys
@@ -110,8 +111,15 @@ print('base index: ' + str(gen_base_index))
 
 gen_base = serial_list['gen-list'][gen_base_index]
 
+## samples of all models, see bolt.write_model_samples
+keep_file = serial_list.get('keep-file', pheno_file)
+
 print('gen_base: ' + gen_base)
 
+## spans of this task, combined into the trace of the run by main.py
+if serial_list.get('trace-dir'):
+    bolt.set_trace_file(os.path.join(serial_list['trace-dir'], ('run-plink.' + gen_base + '.jsonl')))
+
 
 ## == file paths ==
 
@@ -129,45 +137,56 @@ input_bim = os.path.join(data_dir, (gen_base + '.bim'))
 temp_bim = os.path.join(bed_tempdir, (gen_base + '.bim')) 
 
 input_bed = os.path.join(data_dir, (gen_base + '.bed'))
-temp_bed = os.path.join(bed_tempdir, (gen_base + '.bed')) 
-
-temp_fam = os.path.join(bed_tempdir, (gen_base + '.fam')) 
 
 plink_path = os.path.join(plink_tempdir, (gen_base + '.coreset'))
 
-gen_base_path = os.path.join(bed_tempdir, gen_base)
-
 
 ## == data files for plink ==
 
-## creating temporary input files for plink filtering and formatting
-## per chromosome, linking the ukb_gen_chr*.bed file, writing a
-## modified ukb_gen_chr*.bim file and copying a (common) fam file to
-## the respective temp-ukb_gen_chr* directory
+## only the ukb_gen_chr*.bim file is staged, with unique variant ids,
+## in the temp-bed directory. plink reads the bed and the (common) fam
+## file in place
 
-awk_c = "awk 'BEGIN { OFS = \"\t\"} {print $1,$1\"_\"$4\"_\"$5\"_\"$6\"_1\",$3,$4,$5,$6}' " + input_bim + ' > ' + temp_bim
-link_c = 'ln -s ' + input_bed + ' ' + temp_bed
-copy_c = 'cp ' + fam_file + ' ' + temp_fam
+print("\nstaging input files")
 
-print("\nprocessing input files")
-print(awk_c + '\n')
-print(link_c + '\n')
-print(copy_c + '\n')
+try:
+    with bolt.trace_span('stage bim', 'plink') as span:
+        n_staged = bolt.stage_bim(input_bim, temp_bim)
+        span['variants'] = n_staged
+except (OSError, ValueError) as e:
+    sys.exit('staging ' + input_bim + ' failed: ' + str(e))
 
-os.system(awk_c)
-os.system(link_c)
-os.system(copy_c)
+if n_staged is None:
+    print('\nstaged bim file ' + temp_bim + ' up to date')
+else:
+    print('\nstaged bim file ' + temp_bim + ' with ' + str(n_staged) + ' variants')
+
+## a truncated or mismatching bed file fails here, not in plink
+n_variants = bolt.count_lines(temp_bim)
+n_samples = bolt.count_lines(fam_file)
+
+try:
+    with bolt.trace_span('check bed', 'plink', variants = n_variants, samples = n_samples):
+        bolt.check_bed(input_bed, n_variants, n_samples)
+except (OSError, ValueError) as e:
+    sys.exit('checking ' + input_bed + ' failed: ' + str(e))
+
+print('\n' + input_bed + ': ' + str(n_variants) + ' variants, ' + str(n_samples) + ' samples')
 
 
 ## == running plink ==
 
 ## creates coreset snp files per chromosome in temp-plink directory: .bed .bim .fam .log .nosex 
-plink_c = 'plink --bfile ' + gen_base_path + ' --keep ' + pheno_file + ' --maf ' + str(thr_maf) + ' --geno ' + str(thr_geno) + ' --hwe ' + (thr_hwe) + ' --make-bed  --out ' + plink_path
+plink_c = 'plink --bed ' + input_bed + ' --bim ' + temp_bim + ' --fam ' + fam_file + ' --keep ' + keep_file + ' --maf ' + str(thr_maf) + ' --geno ' + str(thr_geno) + ' --hwe ' + str(thr_hwe) + ' --make-bed  --out ' + plink_path
 
 print("running plink")
 print(plink_c + '\n')
 
-## not rather subprocess.run ?
-os.system(plink_c)
+with bolt.trace_span('plink', 'plink') as span:
+    plink_out = subprocess.run(shlex.split(plink_c))
+    span['exit_status'] = plink_out.returncode
+
+if plink_out.returncode != 0:
+    sys.exit('plink failed with exit status ' + str(plink_out.returncode) + ', see ' + plink_path + '.log')
 
 print('\nfinished running plink at: ' + str(datetime.now()))
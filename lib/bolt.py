@@ -1,4 +1,5 @@
 import argparse
+import asyncio
 import os
 import os.path
 import shutil
@@ -8,6 +9,23 @@ import subprocess
 import sys
 import glob
 import time
+from datetime import datetime
+import shlex
+import concurrent.futures
+import multiprocessing
+import array
+import math
+import json
+import sqlite3
+import fcntl
+import hashlib
+import heapq
+import threading
+import statistics
+import contextlib
+import tempfile
+import uuid
+from pathlib import Path
 
 def __version__() -> str:
 
@@ -29,146 +47,4199 @@ def is_valid_file(parser, arg):
 
 
 
-def monitor_qsub(job_id: str) -> None:
+def parse_qstat_full(qstat_stdout: str) -> dict:
+
+    """
+
+    Parses the full (-f) output of qstat into the attributes of each
+    job, joining attribute values that qstat wraps over several lines.
+
+    Args:
+    qstat_stdout (str): The output of qstat -f
+
+    Returns:
+    A dictionary of attribute dictionaries keyed by job id, e.g.
+
+    {'1234[1].pbs': {'job_state': 'F', 'Exit_status': '0', ...}}
+
+    """
+
+    jobs = {}
+    attributes = None
+    key = None
+
+    for line in qstat_stdout.splitlines():
+
+        if line.startswith('Job Id:'):
+            attributes = {}
+            jobs[line.split(':', 1)[1].strip()] = attributes
+            key = None
+
+        elif attributes is None or not line.strip():
+            continue
+
+        ## continuation lines of a wrapped value start with a tab
+        elif line.startswith('\t') and key is not None:
+            attributes[key] = attributes[key] + line.strip()
+
+        elif ' = ' in line:
+            key, value = line.strip().split(' = ', 1)
+            attributes[key] = value
+
+    return(jobs)
+
+
+
+def qstat_subjobs(job_id: str) -> dict:
+
+    """
+
+    Queries the state and exit status of the subjobs of one (array)
+    job with qstat, including finished subjobs.
+
+    Args:
+    job_id (str): The id of the (array) job, e.g. '1234[]' or '1234'
+
+    Returns:
+    A dictionary of subjob results keyed by array index (1 for a
+    single job), each a dictionary with 'state', 'exit_status' (None
+    while the subjob has not finished), 'mem-used' (peak memory in gb),
+    'walltime-used' (in hours), 'queue-time' and 'start-time' (when
+    the subjob was queued and started, in seconds since the epoch) as
+    far as pbs reports them, or None if qstat failed
+
+    """
+
+    qstat_c = ['qstat', '-x', '-f']
+
+    if '[]' in job_id:
+        qstat_c.append('-t')
+
+    qstat_c.append(job_id)
+
+    qstat = subprocess.run(qstat_c, capture_output=True)
+
+    if qstat.returncode != 0:
+        print('\nqstat returncode: ' + str(qstat.returncode))
+        print(qstat.stderr.decode('UTF-8'))
+        return(None)
+
+    jobs = parse_qstat_full(qstat.stdout.decode('UTF-8'))
+
+    subjobs = {}
+
+    for qstat_id, attributes in jobs.items():
+
+        index = re.search(r'\[(\d*)\]', qstat_id)
+
+        ## the array job itself is listed with empty brackets
+        if index is not None and index.group(1) == '':
+            continue
+
+        index = 1 if index is None else int(index.group(1))
+
+        exit_status = attributes.get('Exit_status')
+
+        mem_used = attributes.get('resources_used.mem')
+        walltime_used = attributes.get('resources_used.walltime')
+
+        queue_time = attributes.get('qtime')
+        start_time = attributes.get('stime')
+
+        subjobs[index] = {'state': attributes.get('job_state'),
+                          'exit_status': None if exit_status is None else int(exit_status),
+                          'mem-used': None if mem_used is None else parse_pbs_mem(mem_used),
+                          'walltime-used': None if walltime_used is None else parse_pbs_walltime(walltime_used),
+                          'queue-time': None if queue_time is None else parse_pbs_time(queue_time),
+                          'start-time': None if start_time is None else parse_pbs_time(start_time)}
+
+    return(subjobs)
+
+
+
+def parse_pbs_mem(value: str) -> float:
+
+    """
+
+    Args:
+    value (str): A pbs memory value, e.g. '1234567kb' or '48gb'
+
+    Returns:
+    The memory in gb
+
+    """
+
+    units = {'b': 0, 'kb': 1, 'mb': 2, 'gb': 3, 'tb': 4}
+
+    match = re.fullmatch(r'(\d+)([kmgt]?b)?', value.strip().lower())
+
+    return(int(match.group(1)) * 1024 ** units[match.group(2) or 'b'] / 1024 ** 3)
+
+
+
+def parse_pbs_time(value: str) -> float:
+
+    """
+
+    Args:
+    value (str): A pbs time stamp, e.g. 'Sat Oct 18 08:41:18 2026'
+
+    Returns:
+    The time in seconds since the epoch
+
+    """
+
+    return(datetime.strptime(value.strip(), '%a %b %d %H:%M:%S %Y').timestamp())
+
+
+
+def parse_pbs_walltime(value: str) -> float:
+
+    """
+
+    Args:
+    value (str): A pbs wall time value, e.g. '01:02:03'
+
+    Returns:
+    The wall time in hours
+
+    """
+
+    seconds = 0
+
+    for field in value.strip().split(':'):
+        seconds = seconds * 60 + int(field)
+
+    return(seconds / 3600)
+
+
+
+def failed_subjobs(subjobs: dict) -> list:
+
+    """
+
+    Args:
+    subjobs (dict): Subjob results as returned by monitor_qsub or
+    run_job
+
+    Returns:
+    A sorted list of the array indices of subjobs that did not finish
+    with exit status 0
+
+    """
+
+    return(sorted(index for index, result in subjobs.items()
+                  if result['exit_status'] != 0))
+
+
+
+def monitor_qsub(job_id: str, min_interval: int = 10, max_interval: int = 300,
+                 on_finished = None) -> dict:
     """
 
-    Using qstat to monitor a process started on the queue in order to
-    wait until all of them are finished.
+    Using qstat to monitor a (array) job on the queue in order to wait
+    until all of its subjobs are finished. Only the job itself is
+    queried. The polling interval adapts to the progress of the job:
+    it is a tenth of the time the longest running subjob has been
+    running (of the time since submission while all are queued), so
+    that a short job is noticed finishing within seconds and a long
+    one is not polled needlessly often, and it shrinks towards
+    min_interval as the last subjobs are running. It stays between
+    min_interval and max_interval.
 
     Args:
     job_id (str): The process ID of the (array) job.
+    min_interval (int): Shortest time between two queries in seconds
+    max_interval (int): Longest time between two queries in seconds
+    on_finished (function): Called with the results of the subjobs
+    that have finished since the last query, keyed by array index,
+    e.g. to process their output while others are still running
+
+    Returns:
+    A dictionary of subjob results keyed by array index, see
+    qstat_subjobs
 
     """
 
-    qstat = subprocess.run(['qstat'], capture_output=True)
-    qstat_stdout = qstat.stdout.decode('ascii')
-    print('\njob ' + job_id + ' in the queue:') 
-    print(qstat_stdout)
-    time.sleep(300)
+    ## finished subjobs are in state F (or X while the array job is
+    ## still running)
+    finished_states = ('F', 'X')
+
+    interval = min_interval
+    previous_counts = None
+    reported = set()
+
+    ## the finish of a subjob is noticed within this fraction of its
+    ## run time
+    latency = 0.1
+
+    monitor_start = time.time()
 
-    
     while True:
-        ## subprocess.run is synchronous, waits until it finishes and
-        ## returns a CompletedProcess object
 
-        ## would prefer to use qstat with job id but that does not seem to
-        ## work (qstat_stdout empty). Does not seem to find the process
+        time.sleep(interval)
 
-        ## qstat = subprocess.run(['qstat', job_id], capture_output=True)
+        subjobs = qstat_subjobs(job_id)
 
-        qstat = subprocess.run(['qstat'], capture_output=True)
-        qstat_args = qstat.args
-        qstat_stdout = qstat.stdout.decode('ascii')
-        qstat_stderr = qstat.stderr.decode('ascii')
-        qstat_returncode = qstat.returncode
-    
-        # print('\njob id:\n' + job_id) ## to debug
-        # print('\nqstat stdout:\n' + qstat_stdout) ## to debug
-        # print('\nqstat stderr:\n' + qstat_stderr) ## to debug
-        # print('\nqstat returncode:\n' + str(qstat_returncode)) ## to debug
+        ## if something unexpected happened (e.g. the pbs server is
+        ## not responding), try again later
+        if subjobs is None or len(subjobs) == 0:
+            print('\nsomething unexpected, no qstat result for job ' + job_id)
+            interval = max_interval
+            continue
 
-    
-        ## checking if the job id is listed in the qstat stdoutput, if
-        ## not, wait 5 min until checking again
-        if(job_id in qstat_stdout):
-            time.sleep(300)
-        
-        else:
+        states = [result['state'] for result in subjobs.values()]
 
-            ## if something unexpected happened and the return code of
-            ## the qstat process is not 0, try again in 5 minutes
-            if(qstat_returncode != 0):
-                print('\nqstat returncode:\n' + str(qstat_returncode))
-                print('\nsomething unexpected')
-                time.sleep(300)
-            else:
-                print('\njob ' + job_id + ' has exited the queue:') 
-                print(qstat_stdout)
+        counts = {state: states.count(state) for state in sorted(set(states))}
 
-                break
+        if counts != previous_counts:
+            print('\njob ' + job_id + ' subjob states at ' + str(datetime.now()) +
+                  ': ' + str(counts))
+            previous_counts = counts
 
-    # ## check if qstat stderr states that the process is unknown
-    # ## (i.e. finished). If so, break out of the loop. escape
-    # ## special characters in pattern.
-    # qstat_stderr_pattern = r'.*Unknown.*' + re.escape(job_id)
-    # ## print('stderr search pattern: ' + qstat_stderr_pattern) ## to debug
-        
-    # if(re.match(qstat_stderr_pattern, qstat_stderr)):
-    #     print('\nqstat stderr:\n' + qstat_stderr)
-    #     print('task ' + job_id + ' finished')
-    #     break
-    ## if something unexpected happens, try again in 5 minutes
-    # else:
-    #     print('\nsomething unexpected')
-    #     time.sleep(300)
+        n_finished = sum(state in finished_states for state in states)
 
+        if on_finished is not None:
+            finished = {index: result for index, result in subjobs.items()
+                        if result['state'] in finished_states and index not in reported}
+            if finished:
+                reported.update(finished)
+                on_finished(finished)
 
+        if n_finished == len(subjobs):
+            break
 
+        now = time.time()
 
+        ## how long the subjob most likely to finish next has been
+        ## running, how long the job has been queued if none is
+        running_times = [now - result['start-time'] if result['start-time'] is not None
+                         else (result['walltime-used'] or 0) * 3600
+                         for result in subjobs.values() if result['state'] == 'R']
 
+        elapsed = max(running_times) if running_times else now - monitor_start
+
+        remaining = (len(subjobs) - n_finished) / len(subjobs)
+
+        interval = min(min_interval + int((max_interval - min_interval) * remaining),
+                       max(min_interval, int(latency * elapsed)))
+
+    failed = failed_subjobs(subjobs)
+
+    print('\njob ' + job_id + ' has exited the queue')
+
+    if failed:
+        print('\n' + str(len(failed)) + ' subjob(s) with non-zero exit status: ' + str(failed))
+
+    return(subjobs)
 
-def snp_chunks(snp_array: list, chromosome: str, chunksize: int) -> list:
+
+
+
+def qsub_resources(resources: dict) -> str:
 
     """
 
+    Formats a resource request for qsub.
+
     Args:
-    snp_array (list): A list of SNP locations
-    chr (str): The chromosome location of the SNPS
-    chunksize (int): The number of SNPs in one chunk
+    resources (dict): Resources of one (sub)job, i.e. 'ncpus', 'mem'
+    (in gb) and 'walltime' (in hours)
 
     Returns:
-    A list of tuples with chromosome chunks, i.e. chromosome,
-    first and last position, e.g. 
+    The qsub resource options, e.g.
+    '-lselect=1:ncpus=8:mem=48gb -lwalltime=72:00:00'
 
-    [('chr3', (727, 648)), ('chr3', (65, 598)), ('chr3', (671, 735))
+    """
 
-    Raises:
+    walltime_min = int(round(resources['walltime'] * 60))
+
+    walltime = '%02d:%02d:00' % (walltime_min // 60, walltime_min % 60)
+
+    return('-lselect=1:ncpus=' + str(resources['ncpus']) +
+           ':mem=' + str(resources['mem']) + 'gb' +
+           ' -lwalltime=' + walltime)
+
+
+
+def submit_qsub(command: str, job_name: str, log_dir: str, resources: dict,
+                n_tasks: int = None) -> str:
 
-    
     """
 
-    chunk_list = []
-    
-    nsnps = len(snp_array)
+    Submits a command to the pbs queue, as an array job if a number of
+    tasks is given.
 
-    ## print('number of snps: ' + str(nsnps))
+    Args:
+    command (str): The command to run in each (sub)job
+    job_name (str): The name of the job
+    log_dir (str): Directory for the stdout and stderr log files
+    resources (dict): Resources of one (sub)job, see qsub_resources
+    n_tasks (int): The number of array subjobs, None for a single job
 
-    # print(snp_array[0])
-    # print(snp_array[-1])
+    Returns:
+    The job id without the '.pbs' suffix, e.g. '1234[]' for an array
+    job
 
-    ## ceiling division (sign inverted floor division) to get number of chunks
-    nchunks = -1 * (-nsnps // chunksize)
+    """
 
-    ## print('number of chunks: ' + str(nchunks))
+    echo_command = 'echo -e "%s"' % command
 
-    ## tuple of boundaries
-    limit_lower_idx = 0
-    limit_upper_idx = chunksize -1
+    qsub_command = ('qsub -S /bin/bash -o ' + log_dir + ' -e ' + log_dir +
+                    ' -V -N ' + job_name)
 
-    limit_lower_pos = snp_array[limit_lower_idx]
+    if n_tasks is not None:
+        qsub_command = qsub_command + ' -J 1-' + str(n_tasks)
 
-    if limit_upper_idx < (nsnps - 1):
-        limit_upper_pos = snp_array[limit_upper_idx]
+    qsub_command = qsub_command + ' ' + qsub_resources(resources)
+
+    print('\npipeline command: ' + command)
+    print('\nqsub command: ' + qsub_command)
+    print('\ncommand: ' + echo_command + ' | ' + qsub_command)
+
+    ## I am not using shell=True, so need to use shlex to parse the
+    ## string for subprocess.Popen
+    p1 = subprocess.Popen(shlex.split(echo_command), stdout=subprocess.PIPE)
+    p2 = subprocess.Popen(shlex.split(qsub_command), stdin=p1.stdout, stdout=subprocess.PIPE)
+    ## Allow p1 to receive a SIGPIPE if p2 exits
+    p1.stdout.close()
+
+    job_id = p2.communicate()[0].decode('UTF-8').replace('.pbs', '').rstrip()
+
+    return(job_id)
+
+
+
+def local_capacity(cores: int = None, mem: int = None) -> tuple:
+
+    """
+
+    Determines the cores and memory available to the local executor.
+
+    Args:
+    cores (int): Number of cores to use, all cores available to the
+    process if None
+    mem (int): Memory to use in gb, the total memory of the host if None
+
+    Returns:
+    A tuple (cores, mem)
+
+    """
+
+    if cores is None:
+        cores = len(os.sched_getaffinity(0))
+
+    if mem is None:
+        with open('/proc/meminfo', 'r') as fh:
+            for line in fh:
+                if line.startswith('MemTotal:'):
+                    ## MemTotal is given in kB
+                    mem = int(line.split()[1]) // (1024 * 1024)
+                    break
+
+    return((cores, mem))
+
+
+
+## the cores and memory taken by the running tasks of the local
+## executor, shared by the jobs of all stages running at the same time,
+## see run_local
+_local_used = {'cores': 0, 'mem': 0}
+_local_used_changed = threading.Condition()
+
+
+
+def run_local(command: str, job_name: str, log_dir: str, resources: dict,
+              n_tasks: int = None, cores: int = None, mem: int = None,
+              on_finished = None) -> dict:
+
+    """
+
+    Runs a command as a (array) job in a local process pool instead of
+    the pbs queue. PBS_ARRAY_INDEX and PBS_O_WORKDIR are set for each
+    task as qsub would, and stdout and stderr are written to log files
+    named like the pbs ones. The number of tasks running at the same
+    time is limited by the cores and memory available, which the jobs
+    running at the same time (e.g. in concurrent stages, see
+    run_stages) share: a task starts only once the tasks of all jobs
+    leave enough of them.
+
+    Args:
+    command (str): The command to run in each task
+    job_name (str): The name of the job
+    log_dir (str): Directory for the stdout and stderr log files
+    resources (dict): Resources of one task, see qsub_resources
+    n_tasks (int): The number of array tasks, None for a single job
+    cores (int): Number of cores to use, see local_capacity
+    mem (int): Memory to use in gb, see local_capacity
+    on_finished (function): Called with the result of each task as
+    soon as it has finished, see monitor_qsub
+
+    Returns:
+    A dictionary of task results keyed by array index (1 for a single
+    job), see qstat_subjobs
+
+    """
+
+    cores, mem = local_capacity(cores, mem)
+
+    ## a task that asks for more than the host has still runs, one at
+    ## a time
+    n_slots = max(1, min(cores // resources['ncpus'], mem // resources['mem']))
+
+    job_id = 'local' + uuid.uuid4().hex[:8]
+
+    queue_time = time.time()
+
+    if n_tasks is None:
+        indices = [None]
     else:
-        limit_upper_pos = snp_array[-1]
+        indices = list(range(1, n_tasks + 1))
 
-    ## limits of chunks as an array of tuples. array because it needs
-    ## to be appended
-    chunk_list.append((chromosome, (limit_lower_pos, limit_upper_pos)))
+    print('\nrunning ' + job_name + ' in a local pool of ' + str(n_slots) +
+          ' slot(s) (' + str(cores) + ' cores, ' + str(mem) + 'gb)')
+    print('\npipeline command: ' + command)
 
-    ## while the upper limit is position is not the last snp
-    while limit_upper_idx < (nsnps - 1):
+    ## a task that asks for more than the host has takes all of it
+    task_cores = min(resources['ncpus'], cores)
+    task_mem = min(resources['mem'], mem)
 
-        limit_lower_idx = limit_upper_idx + 1
-        limit_upper_idx = limit_upper_idx + chunksize
+    def task_fits():
+        return(_local_used['cores'] + task_cores <= cores and _local_used['mem'] + task_mem <= mem)
 
-        limit_lower_pos = snp_array[limit_lower_idx]
-        
-        if limit_upper_idx < (nsnps - 1):
-            limit_upper_pos = snp_array[limit_upper_idx]
-            chunk_list.append((chromosome, (limit_lower_pos, limit_upper_pos)))
-        else:
-            limit_upper_pos = snp_array[-1]
-            chunk_list.append((chromosome, (limit_lower_pos, limit_upper_pos)))
+    def run_task(index):
 
-    return(chunk_list)
+        with _local_used_changed:
+            _local_used_changed.wait_for(task_fits)
+            _local_used['cores'] += task_cores
+            _local_used['mem'] += task_mem
+
+        try:
+            return(run_task_process(index))
+        finally:
+            with _local_used_changed:
+                _local_used['cores'] -= task_cores
+                _local_used['mem'] -= task_mem
+                _local_used_changed.notify_all()
+
+    def run_task_process(index):
+
+        env = dict(os.environ)
+        env['PBS_O_WORKDIR'] = os.getcwd()
+        env['PBS_JOBID'] = job_id
+        env['PBS_JOBNAME'] = job_name
+
+        if index is not None:
+            env['PBS_ARRAY_INDEX'] = str(index)
+
+        logs = subjob_logs(log_dir, job_name, job_id, index)
+
+        start_time = time.time()
+
+        with open(logs['stdout'], 'w') as out_fh, open(logs['stderr'], 'w') as err_fh:
+            process = subprocess.Popen(shlex.split(command), env=env,
+                                       stdout=out_fh, stderr=err_fh)
+
+            ## the peak memory of the task and its (waited for)
+            ## children, as pbs would report it
+            pid, status, rusage = os.wait4(process.pid, 0)
+            process.returncode = os.waitstatus_to_exitcode(status)
+
+        return(dict({'state': 'F', 'exit_status': process.returncode,
+                     'mem-used': rusage.ru_maxrss / 1024 ** 2,
+                     'walltime-used': (time.time() - start_time) / 3600,
+                     'queue-time': queue_time, 'start-time': start_time}, **logs))
+
+    subjobs = {}
+
+    ## the tasks are separate processes, threads only wait for them
+    with concurrent.futures.ThreadPoolExecutor(max_workers=n_slots) as pool:
+
+        futures = {pool.submit(run_task, i): 1 if i is None else i for i in indices}
+
+        for future in concurrent.futures.as_completed(futures):
+
+            subjobs[futures[future]] = future.result()
+
+            if on_finished is not None:
+                on_finished({futures[future]: subjobs[futures[future]]})
+
+    subjobs = dict(sorted(subjobs.items()))
+
+    failed = failed_subjobs(subjobs)
+
+    if failed:
+        print('\n' + job_name + ' task(s) with non-zero exit status: ' + str(failed))
+
+    return(subjobs)
+
+
+
+def run_job(executor: str, command: str, job_name: str, log_dir: str,
+            resources: dict, n_tasks: int = None, cores: int = None,
+            mem: int = None, on_finished = None) -> dict:
+
+    """
+
+    Runs a (array) job with the configured executor and waits until
+    it has finished.
+
+    Args:
+    executor (str): 'pbs' to submit to the queue with qsub, 'local' to
+    run in a local process pool
+    command (str): The command to run in each (sub)job
+    job_name (str): The name of the job
+    log_dir (str): Directory for the stdout and stderr log files
+    resources (dict): Resources of one (sub)job, see qsub_resources
+    n_tasks (int): The number of array tasks, None for a single job
+    cores (int): Number of cores for the local executor
+    mem (int): Memory in gb for the local executor
+    on_finished (function): Called with the results of subjobs as
+    they finish, see monitor_qsub
+
+    Returns:
+    A dictionary of subjob results keyed by array index, see
+    qstat_subjobs, with the paths of their log files in 'stdout' and
+    'stderr'
+
+    Raises:
+    ValueError: If the executor is unknown
+
+    """
+
+    if executor == 'local':
+        return(run_local(command, job_name, log_dir, resources, n_tasks, cores, mem,
+                         on_finished = on_finished))
+
+    elif executor == 'pbs':
+        print('\nrunning ' + job_name + ' on the pbs queue')
+
+        job_id = submit_qsub(command, job_name, log_dir, resources, n_tasks)
+
+        print('\nrunning ' + job_name + ' as job-id: ' + job_id)
+
+        def add_logs(subjobs):
+            for index, result in subjobs.items():
+                result.update(subjob_logs(log_dir, job_name, job_id,
+                                          index if n_tasks is not None else None))
+
+        def finished(subjobs):
+            add_logs(subjobs)
+            on_finished(subjobs)
+
+        subjobs = monitor_qsub(job_id, on_finished = None if on_finished is None else finished)
+
+        add_logs(subjobs)
+
+        return(subjobs)
+
+    else:
+        raise ValueError('unknown executor: ' + str(executor))
+
+
+
+def subjob_logs(log_dir: str, job_name: str, job_id: str, index: int = None) -> dict:
+
+    """
+
+    Args:
+    log_dir (str): Directory of the log files
+    job_name (str): The name of the job
+    job_id (str): The id of the job, e.g. '1234[]'
+    index (int): The array index of the subjob, None for a single job
+
+    Returns:
+    The paths of the stdout and stderr log files of a (sub)job, named
+    as pbs names them (e.g. run-bolt.o1234.5), in 'stdout' and
+    'stderr'
+
+    """
+
+    log_suffix = job_id.split('[')[0].split('.')[0]
+
+    if index is not None:
+        log_suffix = log_suffix + '.' + str(index)
+
+    log_base = os.path.join(log_dir, job_name)
+
+    return({'stdout': log_base + '.o' + log_suffix,
+            'stderr': log_base + '.e' + log_suffix})
+
+
+
+def subjob_failure(result: dict) -> str:
+
+    """
+
+    Determines why a (sub)job failed, from the messages pbs and
+    bolt-lmm write to its log files or otherwise from its exit status
+    (128 or 256 plus the signal number if it was killed under pbs, the
+    negative signal number under the local executor, see run_local).
+
+    Args:
+    result (dict): The result of the subjob, see run_job
+
+    Returns:
+    None if the subjob finished successfully, 'mem' if it ran out of
+    memory, 'walltime' if it exceeded its wall time, 'node' for
+    failures of pbs itself (other negative exit status) and 'error'
+    otherwise
+
+    """
+
+    exit_status = result['exit_status']
+
+    if exit_status == 0:
+        return(None)
+
+    log_text = ''
+
+    for log in (result.get('stdout'), result.get('stderr')):
+        if log is not None and os.path.exists(log):
+            with open(log, 'r', errors='replace') as fh:
+                log_text = log_text + fh.read()
+
+    if re.search(r'PBS: job killed: (mem|vmem|pmem) .*exceeded limit|'
+                 r'std::bad_alloc|[Oo]ut of memory|oom-kill', log_text):
+        return('mem')
+
+    if re.search(r'PBS: job killed: walltime .*exceeded limit', log_text):
+        return('walltime')
+
+    ## killed by SIGKILL (e.g. by the OOM killer) or SIGTERM (pbs
+    ## stopping a job at its wall time), as the shell of a pbs job or
+    ## the local executor report it
+    if exit_status in (137, 265, -9):
+        return('mem')
+
+    if exit_status in (143, 271, -15):
+        return('walltime')
+
+    if exit_status is None or exit_status < 0:
+        return('node')
+
+    return('error')
+
+
+
+def run_tasks(executor: str, job_name: str, log_dir: str, resources: dict,
+              tasks: list, task_command, retry: dict, cores: int = None,
+              mem: int = None, on_finished = None) -> tuple:
+
+    """
+
+    Runs a list of tasks as an array job (see run_job) and resubmits
+    failed tasks: with more memory if they ran out of memory, with
+    more wall time if they exceeded it, with the same resources after
+    a failure of pbs itself. Other failures are not resubmitted. Tasks
+    with different resources run in one array job per resources; on
+    the pbs queue these are submitted together and monitored at the
+    same time, with the local executor one after the other, as they
+    share its cores.
+
+    Args:
+    executor (str): The executor, see run_job
+    job_name (str): The name of the job
+    log_dir (str): Directory for the stdout and stderr log files
+    resources (dict): Resources of one task, see qsub_resources, or a
+    list with the resources of each task
+    tasks (list): The tasks
+    task_command (function): Called with a list of tasks and the name
+    of their array job, e.g. '2.1' for the first array job of the
+    second attempt, returns the command running the i-th of these
+    tasks in array subjob i
+    retry (dict): 'max' (maximum number of resubmissions of a task),
+    'mem-factor' and 'walltime-factor' (by which memory and wall time
+    grow per resubmission) and 'mem-max' and 'walltime-max' (the
+    maximum memory in gb and wall time in hours)
+    cores (int): Number of cores for the local executor
+    mem (int): Memory in gb for the local executor
+    on_finished (function): Called with each task and its subjob
+    result as soon as an attempt of the task has finished, one call
+    at a time
+
+    Returns:
+    A tuple (results, attempts): the results of the last attempt of
+    each task, a list in the order of tasks, each a subjob result (see
+    run_job) with 'failure' (see subjob_failure); and a list with a
+    record of each attempt of each task
+
+    """
+
+    if isinstance(resources, dict):
+        task_resources = [dict(resources) for task in tasks]
+    else:
+        task_resources = [dict(r) for r in resources]
+    results = [None] * len(tasks)
+    attempts = []
+
+    pending = list(range(len(tasks)))
+    attempt = 1
+
+    ## the array jobs of an attempt report finished tasks from threads
+    ## of their own
+    finished_lock = threading.Lock()
+
+    while pending:
+
+        ## tasks with the same resources run in one array job
+        groups = {}
+
+        for i in pending:
+            groups.setdefault(tuple(sorted(task_resources[i].items())), []).append(i)
+
+        pending = []
+
+        def run_group(group_number, group_resources, group):
+
+            """ Runs the tasks of one array job """
+
+            def finished(subjobs):
+                with finished_lock:
+                    for index, result in subjobs.items():
+                        on_finished(tasks[group[index - 1]], result)
+
+            return(run_job(executor, task_command([tasks[i] for i in group],
+                                                  str(attempt) + '.' + str(group_number)),
+                           job_name, log_dir, dict(group_resources),
+                           n_tasks = len(group), cores = cores, mem = mem,
+                           on_finished = None if on_finished is None else finished))
+
+        group_jobs = [(group_number, group_resources, group)
+                      for group_number, (group_resources, group) in enumerate(groups.items(), 1)]
+
+        if executor == 'pbs' and len(group_jobs) > 1:
+            with concurrent.futures.ThreadPoolExecutor(max_workers = len(group_jobs)) as pool:
+                group_subjobs = list(pool.map(lambda job: run_group(*job), group_jobs))
+        else:
+            group_subjobs = [run_group(*job) for job in group_jobs]
+
+        for (group_number, group_resources, group), subjobs in zip(group_jobs, group_subjobs):
+
+            group_resources = dict(group_resources)
+
+            for index, i in enumerate(group, 1):
+
+                ## a subjob missing from the qstat output has not run
+                result = subjobs.get(index, {'state': None, 'exit_status': None,
+                                             'mem-used': None, 'walltime-used': None})
+                result['failure'] = subjob_failure(result)
+
+                results[i] = result
+
+                attempts.append({'task': tasks[i], 'attempt': attempt,
+                                 'resources': group_resources,
+                                 'exit-status': result['exit_status'],
+                                 'failure': result['failure'],
+                                 'mem-used': result.get('mem-used'),
+                                 'walltime-used': result.get('walltime-used'),
+                                 'queue-time': result.get('queue-time'),
+                                 'start-time': result.get('start-time'),
+                                 'stdout': result.get('stdout'),
+                                 'time': str(datetime.now())})
+
+                if result['failure'] is None or result['failure'] == 'error':
+                    continue
+
+                if attempt > retry['max']:
+                    continue
+
+                escalated = dict(task_resources[i])
+
+                if result['failure'] == 'mem':
+                    escalated['mem'] = min(retry['mem-max'],
+                                           int(math.ceil(escalated['mem'] * retry['mem-factor'])))
+
+                if result['failure'] == 'walltime':
+                    escalated['walltime'] = min(retry['walltime-max'],
+                                                escalated['walltime'] * retry['walltime-factor'])
+
+                ## no point in running again with the maximum resources
+                if result['failure'] != 'node' and escalated == task_resources[i]:
+                    print('\n' + job_name + ' task ' + str(tasks[i]) + ' failed (' +
+                          result['failure'] + ') with the maximum resources')
+                    continue
+
+                print('\n' + job_name + ' task ' + str(tasks[i]) + ' failed (' +
+                      result['failure'] + '), resubmitting with ' + str(escalated))
+
+                task_resources[i] = escalated
+                pending.append(i)
+
+        attempt += 1
+
+    return((results, attempts))
+
+
+
+def run_stages(stages: dict) -> dict:
+
+    """
+
+    Runs the stages of a pipeline as a directed acyclic graph: each
+    stage starts as soon as the stages it depends on have finished, so
+    that independent stages (e.g. the core SNP set and chunk planning)
+    run at the same time. The stages are functions that block while
+    their jobs run, an asyncio event loop runs each in its own thread.
+    The spans a stage traces are shown on its own track, see
+    trace_event.
+
+    If a stage fails, the stages that have not started are skipped,
+    those running are waited for, and the exception of the failed
+    stage (e.g. the SystemExit of sys.exit) is raised.
+
+    Args:
+    stages (dict): Tuples (function, dependencies) keyed by stage
+    name, the dependencies being a list of stage names
+
+    Returns:
+    A dictionary of the return values of the stage functions keyed by
+    stage name
+
+    Raises:
+    ValueError: If a dependency is not a stage or the dependencies
+    have a cycle
+
+    """
+
+    ## stages in an order in which their dependencies come first
+    order = []
+    visiting = set()
+
+    def visit(name, path):
+        if name not in stages:
+            raise ValueError('unknown stage ' + name + ' required by ' + path[-1])
+        if name in order:
+            return
+        if name in visiting:
+            raise ValueError('cyclic stage dependencies ' + ' -> '.join(path + [name]))
+        visiting.add(name)
+        for dependency in stages[name][1]:
+            visit(dependency, path + [name])
+        order.append(name)
+
+    for name in stages:
+        visit(name, [])
+
+    results = {}
+    failures = []
+
+    ## exceptions are passed on outside the event loop, which would
+    ## otherwise stop at a SystemExit
+    def run_stage_thread(name):
+        _trace_track.name = name
+        try:
+            with trace_span(name, 'stage'):
+                results[name] = stages[name][0]()
+        except BaseException as exception:
+            failures.append(exception)
+        finally:
+            _trace_track.name = None
+
+    async def run_all():
+
+        tasks = {}
+
+        async def run_stage(name):
+            await asyncio.gather(*(tasks[d] for d in stages[name][1]))
+            if not failures:
+                await asyncio.to_thread(run_stage_thread, name)
+
+        for name in order:
+            tasks[name] = asyncio.ensure_future(run_stage(name))
+
+        await asyncio.gather(*tasks.values())
+
+    asyncio.run(run_all())
+
+    if failures:
+        raise failures[0]
+
+    return(results)
+
+
+
+def log_walltime(log_file: str) -> float:
+
+    """
+
+    Args:
+    log_file (str): The path of the stdout log file of a run-bolt task
+
+    Returns:
+    The wall time of the bolt-lmm analysis in hours as bolt-lmm
+    reports it at the end of its log, None if not found
+
+    """
+
+    if log_file is None or not os.path.exists(log_file):
+        return(None)
+
+    with open(log_file, 'r', errors='replace') as fh:
+        match = re.search(r'Total elapsed time for analysis = ([0-9.eE+-]+) sec', fh.read())
+
+    if match is None:
+        return(None)
+
+    return(float(match.group(1)) / 3600)
+
+
+
+def resource_sizes(job_name: str, features: dict) -> dict:
+
+    """
+
+    The sizes of a task that its memory and wall time are taken to be
+    proportional to.
+
+    Args:
+    job_name (str): The job, 'run-plink' or 'run-bolt'
+    features (dict): The task features 'samples', 'variants'
+    (genotyped variants of the chromosome for run-plink, imputed
+    variants of the chunk for run-bolt) and, for run-bolt,
+    'coreset-snps'
+
+    Returns:
+    A dictionary with the 'mem' and 'walltime' sizes, empty for other
+    jobs
+
+    """
+
+    if job_name == 'run-plink':
+        return({'mem': features['samples'],
+                'walltime': features['samples'] * features['variants']})
+
+    ## bolt-lmm holds the core snp genotypes in memory, and its time
+    ## grows with the model fit on the core snps and the tested
+    ## variants
+    if job_name == 'run-bolt':
+        return({'mem': features['samples'] * features['coreset-snps'],
+                'walltime': features['samples'] * (features['coreset-snps'] + features['variants'])})
+
+    return({})
+
+
+
+def load_history(history_file: str) -> list:
+
+    """
+
+    Args:
+    history_file (str): The path of the resource history, a json
+    lines file with one record per task attempt, see append_history
+
+    Returns:
+    The records of the history, empty if there is no history file
+
+    """
+
+    if not history_file or not os.path.exists(history_file):
+        return([])
+
+    history = []
+
+    with open(history_file, 'r') as fh:
+        for line in fh:
+            ## a line may be incomplete if a run was killed writing it
+            try:
+                history.append(json.loads(line))
+            except ValueError:
+                continue
+
+    return(history)
+
+
+
+def append_history(history_file: str, records: list) -> None:
+
+    """
+
+    Appends records to the resource history, shared by runs writing at
+    the same time.
+
+    Args:
+    history_file (str): The path of the resource history
+    records (list): The records, each with 'job', 'features' (see
+    resource_sizes), the requested 'resources' and 'mem-used' and
+    'walltime-used'
+
+    """
+
+    Path(os.path.dirname(os.path.abspath(history_file))).mkdir(parents=True, exist_ok=True)
+
+    with open(history_file, 'a') as fh:
+        fcntl.flock(fh, fcntl.LOCK_EX)
+        for record in records:
+            fh.write(json.dumps(record) + '\n')
+        fh.flush()
+        fcntl.flock(fh, fcntl.LOCK_UN)
+
+
+
+def resource_bucket(value: float) -> int:
+
+    """
+
+    Args:
+    value (float): An amount of memory in gb or wall time in hours
+
+    Returns:
+    The smallest of 1, 2, 3, 4, 6, 8, 12, 16, 24, ... (powers of 2 and
+    1.5 times powers of 2) not below the value
+
+    """
+
+    bucket = 1
+
+    while bucket < value:
+        if bucket >= 2 and bucket & (bucket - 1) == 0:
+            bucket = bucket * 3 // 2
+        else:
+            bucket = 2 ** math.ceil(math.log2(bucket + 1))
+
+    return(bucket)
+
+
+
+def predict_resources(history: list, job_name: str, features: dict, resources: dict,
+                      margin: float, min_records: int, limits: dict,
+                      recent: int = 50) -> dict:
+
+    """
+
+    Predicts the memory and wall time of a task from the resources
+    used by earlier successful tasks of the same job (and ncpus),
+    scaled by the sizes of the task (see resource_sizes). The
+    prediction is the largest use per size of the most recent tasks,
+    times the size of the task and a safety margin, rounded up to a
+    few sizes (see resource_bucket), so that the tasks of a job fall
+    into few array jobs of the same resources (see run_tasks).
+
+    Args:
+    history (list): The resource history, see load_history
+    job_name (str): The job
+    features (dict): The task features, see resource_sizes
+    resources (dict): The default resources of the task, see
+    qsub_resources, used where the history has too few records
+    margin (float): The factor of safety, e.g. 1.5
+    min_records (int): The minimum number of records for a prediction
+    limits (dict): The maximum 'mem-max' (gb) and 'walltime-max'
+    (hours)
+    recent (int): Number of most recent records to predict from
+
+    Returns:
+    The resources of the task
+
+    """
+
+    sizes = resource_sizes(job_name, features)
+
+    predicted = dict(resources)
+
+    for resource in ('mem', 'walltime'):
+
+        if not sizes.get(resource):
+            continue
+
+        use_per_size = [record[resource + '-used'] / resource_sizes(job_name, record['features'])[resource]
+                        for record in history
+                        if record['job'] == job_name
+                        and record['resources']['ncpus'] == resources['ncpus']
+                        and record['failure'] is None
+                        and record.get(resource + '-used')
+                        and resource_sizes(job_name, record['features'])[resource]][-recent:]
+
+        if len(use_per_size) < min_records:
+            continue
+
+        value = resource_bucket(max(use_per_size) * sizes[resource] * margin)
+
+        predicted[resource] = max(1, min(limits[resource + '-max'], value))
+
+    return(predicted)
+
+
+
+def snp_chunks(snp_array: list, chromosome: str, chunksize: int) -> list:
+
+    """
+
+    Args:
+    snp_array (list): A list of SNP locations
+    chr (str): The chromosome location of the SNPS
+    chunksize (int): The number of SNPs in one chunk
+
+    Returns:
+    A list of tuples with chromosome chunks, i.e. chromosome,
+    first and last position, e.g. 
+
+    [('chr3', (727, 648)), ('chr3', (65, 598)), ('chr3', (671, 735))
+
+    Raises:
+
+    
+    """
+
+    chunk_list = []
+    
+    nsnps = len(snp_array)
+
+    if nsnps == 0:
+        return(chunk_list)
+
+    ## print('number of snps: ' + str(nsnps))
+
+    # print(snp_array[0])
+    # print(snp_array[-1])
+
+    ## ceiling division (sign inverted floor division) to get number of chunks
+    nchunks = -1 * (-nsnps // chunksize)
+
+    ## print('number of chunks: ' + str(nchunks))
+
+    ## tuple of boundaries
+    limit_lower_idx = 0
+    limit_upper_idx = chunksize -1
+
+    limit_lower_pos = snp_array[limit_lower_idx]
+
+    if limit_upper_idx < (nsnps - 1):
+        limit_upper_pos = snp_array[limit_upper_idx]
+    else:
+        limit_upper_pos = snp_array[-1]
+
+    ## limits of chunks as an array of tuples. array because it needs
+    ## to be appended
+    chunk_list.append((chromosome, (limit_lower_pos, limit_upper_pos)))
+
+    ## while the upper limit is position is not the last snp
+    while limit_upper_idx < (nsnps - 1):
+
+        limit_lower_idx = limit_upper_idx + 1
+        limit_upper_idx = limit_upper_idx + chunksize
+
+        limit_lower_pos = snp_array[limit_lower_idx]
+        
+        if limit_upper_idx < (nsnps - 1):
+            limit_upper_pos = snp_array[limit_upper_idx]
+            chunk_list.append((chromosome, (limit_lower_pos, limit_upper_pos)))
+        else:
+            limit_upper_pos = snp_array[-1]
+            chunk_list.append((chromosome, (limit_lower_pos, limit_upper_pos)))
+
+    return(chunk_list)
+
+
+
+def cost_chunks(positions, weights, chromosome: str, target_cost: float,
+                fixed_cost: float) -> list:
+
+    """
+
+    Divides a chromosome into chunks of about the same cost instead of
+    the same number of SNPs. The cost of a chunk is the fixed cost of
+    fitting the model plus the summed cost of its variants. The
+    number of chunks is the smallest that keeps every chunk within
+    the target cost, and the variants are spread evenly over them, so
+    there are no small tail chunks.
+
+    Args:
+    positions (array): The positions of the variants, sorted
+    weights (array): The cost of testing each variant, e.g. 0 for
+    variants removed by the MAF and INFO filters
+    chromosome (str): The chromosome location of the SNPS
+    target_cost (float): The maximum cost of a chunk
+    fixed_cost (float): The cost every chunk pays, independent of its
+    variants
+
+    Returns:
+    A list of tuples with chromosome chunks, see snp_chunks
+
+    Raises:
+    ValueError: If the fixed cost exceeds the target cost
+
+    """
+
+    import numpy as np
+
+    if fixed_cost >= target_cost:
+        raise ValueError('fixed cost per chunk ' + str(fixed_cost) +
+                         ' is not below the target cost ' + str(target_cost))
+
+    positions = np.asarray(positions)
+
+    ## e.g. a chromosome without variants in the mfi file
+    if len(positions) == 0:
+        return([])
+
+    cumulative_cost = np.cumsum(weights, dtype='float64')
+
+    total_cost = cumulative_cost[-1]
+
+    ## ceiling division (sign inverted floor division) to get number of chunks
+    nchunks = max(1, int(-1 * (-total_cost // (target_cost - fixed_cost))))
+
+    ## last variant of each chunk but the last one
+    cut_costs = total_cost * np.arange(1, nchunks) / nchunks
+    cut_idx = np.searchsorted(cumulative_cost, cut_costs)
+
+    chunk_list = []
+    limit_lower_idx = 0
+
+    for limit_upper_idx in list(cut_idx) + [len(positions) - 1]:
+
+        ## do not split variants at the same position
+        while (limit_upper_idx < len(positions) - 1 and
+               positions[limit_upper_idx + 1] == positions[limit_upper_idx]):
+            limit_upper_idx += 1
+
+        if limit_upper_idx < limit_lower_idx:
+            continue
+
+        chunk_list.append((chromosome, (positions[limit_lower_idx], positions[limit_upper_idx])))
+
+        limit_lower_idx = limit_upper_idx + 1
+
+    return(chunk_list)
+
+
+
+def merge_bolt_chunks(chunk_files: list, outfile: str, hits: dict = None,
+                      diagnostics: dict = None) -> dict:
+
+    """
+
+    Concatenates bolt-lmm output chunks into one file, streaming line
+    by line so that memory use does not depend on the number of
+    variants. The chunks have to be given in chromosome and position
+    order. A header is written once; chunks that lack some of the
+    columns (bolt-lmm can skip the BOLT_LMM statistic) get empty
+    fields. Variants at a chunk boundary, which the bgenix ranges of
+    both neighbouring chunks include, are written once.
+
+    Args:
+    chunk_files (list): The paths of the bolt-lmm output chunks
+    outfile (str): The path of the merged output file
+    hits (dict): A table of top hits (see hit_table), updated with
+    the variants written, or None
+    diagnostics (dict): A table of diagnostics (see
+    diagnostics_table), updated with the variants written, or None
+
+    Returns:
+    A dictionary with the number of variants written, duplicates
+    removed, bytes read and bytes written
+
+    """
+
+    ## union of the columns of all chunks, in order of appearance
+    columns = []
+
+    for chunk_file in chunk_files:
+        with open(chunk_file, 'r') as fh:
+            for column in fh.readline().rstrip('\n').split('\t'):
+                if column not in columns:
+                    columns.append(column)
+
+    stats = {'variants': 0, 'duplicates': 0, 'bytes-read': 0, 'bytes-written': 0}
+
+    ## variants at the last position of the previous chunk
+    boundary_chr = None
+    boundary_bp = None
+    boundary_keys = set()
+
+    with open(outfile, 'w') as out_fh:
+
+        header = '\t'.join(columns) + '\n'
+        out_fh.write(header)
+        stats['bytes-written'] += len(header)
+
+        if hits is not None:
+            hit_columns(hits, columns)
+
+        if diagnostics is not None:
+            diagnostic_columns(diagnostics, columns)
+
+        for chunk_file in chunk_files:
+
+            with open(chunk_file, 'r') as fh:
+
+                chunk_header = fh.readline()
+                stats['bytes-read'] += len(chunk_header)
+
+                chunk_columns = chunk_header.rstrip('\n').split('\t')
+
+                ## column positions in the output, None if all columns
+                ## are there in the same order
+                if chunk_columns == columns:
+                    column_map = None
+                else:
+                    column_map = [chunk_columns.index(c) if c in chunk_columns else None
+                                  for c in columns]
+
+                idx_snp = chunk_columns.index('SNP')
+                idx_chr = chunk_columns.index('CHR')
+                idx_bp = chunk_columns.index('BP')
+                idx_a1 = chunk_columns.index('ALLELE1')
+                idx_a0 = chunk_columns.index('ALLELE0')
+
+                last_chr = None
+                last_bp = None
+                last_keys = set()
+
+                for line in fh:
+
+                    stats['bytes-read'] += len(line)
+
+                    fields = line.rstrip('\n').split('\t')
+
+                    chr = fields[idx_chr]
+                    bp = int(fields[idx_bp])
+                    key = (fields[idx_snp], fields[idx_a1], fields[idx_a0])
+
+                    if chr == boundary_chr and bp == boundary_bp and key in boundary_keys:
+                        stats['duplicates'] += 1
+                        continue
+
+                    if chr == last_chr and bp == last_bp:
+                        last_keys.add(key)
+                    else:
+                        last_chr = chr
+                        last_bp = bp
+                        last_keys = {key}
+
+                    if column_map is not None:
+                        fields = ['' if i is None else fields[i] for i in column_map]
+                        line = '\t'.join(fields) + '\n'
+
+                    if hits is not None:
+                        add_hit(hits, fields, line)
+
+                    if diagnostics is not None:
+                        add_diagnostics(diagnostics, fields)
+
+                    out_fh.write(line)
+                    stats['variants'] += 1
+                    stats['bytes-written'] += len(line)
+
+            ## an empty chunk keeps the previous boundary
+            if last_chr is not None:
+                boundary_chr = last_chr
+                boundary_bp = last_bp
+                boundary_keys = last_keys
+
+    return(stats)
+
+
+
+def split_bolt_output(stats_file: str, chunks: list, chunk_files: list) -> list:
+
+    """
+
+    Splits the bolt-lmm output of several chunks, tested in one run of
+    bolt-lmm with one bgen file per chunk, into the output files of
+    the chunks. bolt-lmm writes the variants of the bgen files one
+    file after the other, each in position order, so a variant belongs
+    to the next chunk where the chromosome changes, the position goes
+    back or passes the end of the current chunk. The variants at the
+    boundary of two chunks, which the bgenix ranges of both include,
+    come twice in a row, the first half belongs to the current chunk.
+    Chunks without variants (e.g. none passing the filters of
+    bolt-lmm) get only the header. Each chunk file appears only once
+    it is complete.
+
+    Args:
+    stats_file (str): The path of the bolt-lmm output of the chunks
+    chunks (list): The chunks in the order of their bgen files, see
+    snp_chunks
+    chunk_files (list): The paths of the output files of the chunks
+
+    Returns:
+    The number of variants of each chunk
+
+    Raises:
+    ValueError: If the output has a variant outside the chunks
+
+    """
+
+    counts = [0] * len(chunks)
+
+    chunk_tempfiles = [f + '.' + uuid.uuid4().hex for f in chunk_files]
+
+    ## chromosomes as in the output, where codes may differ from the
+    ## chunks (e.g. X and 23), the position decides
+    chunk_chrs = [str(chunk[0]).lstrip('0') for chunk in chunks]
+    chunk_ends = [int(chunk[1][1]) for chunk in chunks]
+
+    def in_chunk(index, chr, bp):
+        return((chr.lstrip('0') == chunk_chrs[index] or chr.lstrip('0') not in chunk_chrs)
+               and bp <= chunk_ends[index])
+
+    with open(stats_file, 'r') as fh:
+
+        header = fh.readline()
+        columns = header.rstrip('\n').split('\t')
+
+        idx_snp = columns.index('SNP')
+        idx_chr = columns.index('CHR')
+        idx_bp = columns.index('BP')
+        idx_a1 = columns.index('ALLELE1')
+        idx_a0 = columns.index('ALLELE0')
+
+        n_split = max(idx_snp, idx_chr, idx_bp, idx_a1, idx_a0) + 1
+
+        out_fh = None
+        current = -1
+
+        def open_chunk(index):
+
+            nonlocal out_fh, current
+
+            ## chunks skipped have only the header
+            for skipped in range(current + 1, index):
+                with open(chunk_tempfiles[skipped], 'w') as skipped_fh:
+                    skipped_fh.write(header)
+
+            if out_fh is not None:
+                out_fh.close()
+
+            current = index
+            out_fh = open(chunk_tempfiles[index], 'w')
+            out_fh.write(header)
+
+        def write(lines):
+            out_fh.writelines(lines)
+            counts[current] += len(lines)
+
+        ## variants at the end position of the current chunk, with
+        ## their keys
+        boundary = []
+        boundary_keys = []
+
+        def write_boundary():
+            n = len(boundary)
+            if n % 2 == 0 and boundary_keys[:n // 2] == boundary_keys[n // 2:]:
+                write(boundary[:n // 2])
+                open_chunk(current + 1)
+                write(boundary[n // 2:])
+            else:
+                write(boundary)
+            del boundary[:]
+            del boundary_keys[:]
+
+        open_chunk(0)
+
+        last_chr = None
+        last_bp = None
+
+        try:
+
+            for line in fh:
+
+                fields = line.split('\t', n_split)
+
+                chr = fields[idx_chr]
+                bp = int(fields[idx_bp])
+
+                if boundary and (chr != last_chr or bp != last_bp):
+                    write_boundary()
+
+                if (not in_chunk(current, chr, bp) or
+                    (last_chr is not None and (chr != last_chr or bp < last_bp))):
+
+                    index = current + 1
+
+                    while index < len(chunks) - 1 and not in_chunk(index, chr, bp):
+                        index += 1
+
+                    if index == len(chunks) or not in_chunk(index, chr, bp):
+                        raise ValueError('variant ' + fields[idx_snp] + ' at ' + chr + ':' + str(bp) +
+                                         ' of ' + stats_file + ' is not in the chunks ' + str(chunks))
+
+                    open_chunk(index)
+
+                last_chr = chr
+                last_bp = bp
+
+                if bp == chunk_ends[current] and current < len(chunks) - 1:
+                    boundary.append(line)
+                    boundary_keys.append((fields[idx_snp], fields[idx_a1], fields[idx_a0]))
+                else:
+                    write([line])
+
+            if boundary:
+                write_boundary()
+
+        finally:
+            out_fh.close()
+
+    ## chunks after the last variant have only the header
+    for chunk_tempfile in chunk_tempfiles[current + 1:]:
+        with open(chunk_tempfile, 'w') as out_fh:
+            out_fh.write(header)
+
+    for chunk_tempfile, chunk_file in zip(chunk_tempfiles, chunk_files):
+        os.replace(chunk_tempfile, chunk_file)
+
+    return(counts)
+
+
+
+def hit_table(filters: dict, max_hits: int) -> dict:
+
+    """
+
+    Creates a table of the top hits of an association analysis, the
+    variants with the smallest p-values among those passing the
+    filters, bounded to max_hits variants. It is filled streaming
+    (see add_hit, e.g. by merge_bolt_chunks) and written with
+    write_hits.
+
+    Args:
+    filters (dict): 'p-column' (the p-value column, e.g. P_BOLT_LMM;
+    P_BOLT_LMM_INF is used for variants without it), 'max-p' (the
+    p-value threshold), 'min-maf' (threshold on the minor allele
+    frequency from A1FREQ) and 'min-info' (threshold on INFO)
+    max_hits (int): The maximum number of hits kept
+
+    Returns:
+    The table of hits
+
+    """
+
+    return({'filters': filters, 'max-hits': max_hits, 'heap': [],
+            'passed': 0, 'columns': None, 'order': 0})
+
+
+
+def hit_columns(hits: dict, columns: list) -> None:
+
+    """
+
+    Sets the columns of the variants added to a table of hits.
+
+    Args:
+    hits (dict): The table of hits, see hit_table
+    columns (list): The columns of the bolt-lmm output
+
+    """
+
+    def index(column):
+        return(columns.index(column) if column in columns else None)
+
+    hits['columns'] = columns
+    hits['idx-p'] = index(hits['filters']['p-column'])
+    hits['idx-p-inf'] = index('P_BOLT_LMM_INF')
+    hits['idx-freq'] = index('A1FREQ')
+    hits['idx-info'] = index('INFO')
+
+
+
+def add_hit(hits: dict, fields: list, line: str) -> bool:
+
+    """
+
+    Adds a variant to a table of hits if it passes the filters and is
+    among the max_hits smallest p-values so far. The p-value is
+    checked first, as most variants fail it.
+
+    Args:
+    hits (dict): The table of hits, see hit_table and hit_columns
+    fields (list): The fields of the variant, in the columns of the
+    table
+    line (str): The line of the variant in the bolt-lmm output
+
+    Returns:
+    True if the variant passes the filters
+
+    """
+
+    filters = hits['filters']
+
+    p = None
+
+    if hits['idx-p'] is not None and fields[hits['idx-p']]:
+        p = fields[hits['idx-p']]
+    elif hits['idx-p-inf'] is not None:
+        p = fields[hits['idx-p-inf']]
+
+    try:
+        p = float(p)
+    except (TypeError, ValueError):
+        return(False)
+
+    if p > filters['max-p']:
+        return(False)
+
+    ## without an allele frequency, e.g. empty or NA, the MAF filter
+    ## cannot be checked and the variant is skipped
+    if hits['idx-freq'] is not None:
+        try:
+            freq = float(fields[hits['idx-freq']])
+        except ValueError:
+            return(False)
+        if min(freq, 1 - freq) < filters['min-maf']:
+            return(False)
+
+    ## a missing INFO score (empty or NA) is not filtered
+    if hits['idx-info'] is not None and fields[hits['idx-info']] not in ('', 'NA'):
+        try:
+            info = float(fields[hits['idx-info']])
+        except ValueError:
+            return(False)
+        if info < filters['min-info']:
+            return(False)
+
+    hits['passed'] += 1
+    hits['order'] += 1
+
+    ## a max-heap on the p-value (by its negative), the largest of the
+    ## kept p-values is replaced; ties keep the earlier variant
+    entry = (-p, -hits['order'], line)
+
+    if len(hits['heap']) < hits['max-hits']:
+        heapq.heappush(hits['heap'], entry)
+    elif entry > hits['heap'][0]:
+        heapq.heapreplace(hits['heap'], entry)
+
+    return(True)
+
+
+
+def write_hits(hits: dict, hits_file: str) -> int:
+
+    """
+
+    Writes a table of hits, sorted by p-value, with the header of the
+    bolt-lmm output. The file appears only once it is complete.
+
+    Args:
+    hits (dict): The table of hits, see hit_table
+    hits_file (str): The path of the hits file (tab-separated)
+
+    Returns:
+    The number of hits written
+
+    """
+
+    hits_tempfile = hits_file + '.' + uuid.uuid4().hex
+
+    with open(hits_tempfile, 'w') as fh:
+
+        if hits['columns'] is not None:
+            fh.write('\t'.join(hits['columns']) + '\n')
+
+        for entry in sorted(hits['heap'], reverse = True):
+            fh.write(entry[2])
+
+    os.replace(hits_tempfile, hits_file)
+
+    return(len(hits['heap']))
+
+
+
+def neg_log10_p(p: str) -> float:
+
+    """
+
+    Converts a p-value of the bolt-lmm output into -log10(p). bolt-lmm
+    writes p-values below the smallest double with their exponent,
+    e.g. '2.1E-400', which float() reads as 0.
+
+    Args:
+    p (str): The p-value as written by bolt-lmm
+
+    Returns:
+    -log10(p), None if p is not a number
+
+    """
+
+    try:
+        value = float(p)
+    except ValueError:
+        return(None)
+
+    if math.isnan(value):
+        return(None)
+
+    if value > 0:
+        return(-math.log10(value))
+
+    mantissa, _, exponent = p.upper().partition('E')
+
+    try:
+        return(-(math.log10(float(mantissa)) + int(exponent)))
+    except ValueError:
+        return(math.inf)
+
+
+
+def diagnostics_table(accuracy: float = 0.0005, bin_size: int = 1000000,
+                      level: float = 0.1) -> dict:
+
+    """
+
+    Creates a table of diagnostics of an association analysis, filled
+    streaming (see add_diagnostics, e.g. by merge_bolt_chunks) in
+    memory that does not depend on the number of variants: the number
+    of variants per chromosome, a quantile sketch of -log10(p) of each
+    p-value column for the genomic inflation factor and QQ plot, and
+    the points of a Manhattan plot on a grid.
+
+    The sketch is a histogram with logarithmic bins, bin k holding
+    the values in (gamma^(k-1), gamma^k] with gamma =
+    (1 + accuracy) / (1 - accuracy), so that any quantile is returned
+    within a relative error of accuracy.
+
+    Args:
+    accuracy (float): The relative accuracy of the quantile sketches
+    bin_size (int): Width of the Manhattan plot grid in base pairs
+    level (float): Height of the Manhattan plot grid in -log10(p)
+
+    Returns:
+    The table of diagnostics
+
+    """
+
+    return({'gamma': (1 + accuracy) / (1 - accuracy), 'bin-size': bin_size,
+            'level': level, 'variants': 0, 'chromosomes': {}, 'sketches': {},
+            'manhattan': set(), 'columns': None, 'cache': {}})
+
+
+
+def diagnostic_columns(diagnostics: dict, columns: list) -> None:
+
+    """
+
+    Sets the columns of the variants added to a table of diagnostics.
+    The p-value columns are those starting with 'P_'; the Manhattan
+    plot shows P_BOLT_LMM, or P_BOLT_LMM_INF where bolt-lmm did not
+    compute it.
+
+    Args:
+    diagnostics (dict): The table of diagnostics, see
+    diagnostics_table
+    columns (list): The columns of the bolt-lmm output
+
+    """
+
+    def index(column):
+        return(columns.index(column) if column in columns else None)
+
+    diagnostics['columns'] = columns
+    diagnostics['idx-chr'] = columns.index('CHR')
+    diagnostics['idx-bp'] = columns.index('BP')
+    diagnostics['idx-p'] = [(columns.index(c), c) for c in columns if c.startswith('P_')]
+    diagnostics['idx-p-plot'] = index('P_BOLT_LMM')
+    diagnostics['idx-p-inf'] = index('P_BOLT_LMM_INF')
+
+    for column in columns:
+        if column.startswith('P_'):
+            diagnostics['sketches'].setdefault(column, {'n': 0, 'zero': 0, 'bins': {}})
+
+
+
+def add_diagnostics(diagnostics: dict, fields: list) -> None:
+
+    """
+
+    Adds a variant to a table of diagnostics.
+
+    Args:
+    diagnostics (dict): The table of diagnostics, see
+    diagnostics_table and diagnostic_columns
+    fields (list): The fields of the variant, in the columns of the
+    table
+
+    """
+
+    chr = fields[diagnostics['idx-chr']]
+
+    diagnostics['variants'] += 1
+    diagnostics['chromosomes'][chr] = diagnostics['chromosomes'].get(chr, 0) + 1
+
+    cache = diagnostics['cache']
+
+    def bins(p):
+
+        """ The sketch bin (None for p = 1) and the Manhattan plot
+        level of a p-value. bolt-lmm writes p-values with two
+        significant digits, so there are few distinct ones and they
+        are converted once """
+
+        if p in cache:
+            return(cache[p])
+
+        value = neg_log10_p(p)
+
+        if value is None:
+            result = None
+        elif value <= 0:
+            result = (None, 0)
+        else:
+            value = min(value, 10000)
+            result = (math.ceil(math.log(value) / math.log(diagnostics['gamma'])),
+                      round(value / diagnostics['level']))
+
+        if len(cache) < 1000000:
+            cache[p] = result
+
+        return(result)
+
+    for idx, column in diagnostics['idx-p']:
+
+        if not fields[idx]:
+            continue
+
+        result = bins(fields[idx])
+
+        if result is None:
+            continue
+
+        sketch = diagnostics['sketches'][column]
+        sketch['n'] += 1
+
+        if result[0] is None:
+            sketch['zero'] += 1
+        else:
+            sketch['bins'][result[0]] = sketch['bins'].get(result[0], 0) + 1
+
+    p = None
+
+    if diagnostics['idx-p-plot'] is not None and fields[diagnostics['idx-p-plot']]:
+        p = fields[diagnostics['idx-p-plot']]
+    elif diagnostics['idx-p-inf'] is not None:
+        p = fields[diagnostics['idx-p-inf']]
+
+    result = bins(p) if p else None
+
+    if result is not None:
+        diagnostics['manhattan'].add((chr, int(fields[diagnostics['idx-bp']]) // diagnostics['bin-size'],
+                                      result[1]))
+
+
+
+def sketch_bins(sketch: dict, gamma: float) -> list:
+
+    """
+
+    Lists the bins of a quantile sketch in increasing order of their
+    values.
+
+    Args:
+    sketch (dict): A sketch of a table of diagnostics
+    gamma (float): The bin growth factor of the sketch
+
+    Returns:
+    A list of tuples (value, count), the value of a bin being the
+    midpoint that bounds the relative error
+
+    """
+
+    bins = [(0.0, sketch['zero'])] if sketch['zero'] else []
+
+    for k in sorted(sketch['bins']):
+        bins.append((2 * gamma ** k / (gamma + 1), sketch['bins'][k]))
+
+    return(bins)
+
+
+
+def sketch_quantile(sketch: dict, gamma: float, q: float) -> float:
+
+    """
+
+    Args:
+    sketch (dict): A sketch of a table of diagnostics
+    gamma (float): The bin growth factor of the sketch
+    q (float): The quantile, between 0 and 1
+
+    Returns:
+    The q-quantile of the values in the sketch, None if it is empty
+
+    """
+
+    rank = q * (sketch['n'] - 1)
+    seen = 0
+
+    for value, count in sketch_bins(sketch, gamma):
+        seen += count
+        if seen > rank:
+            return(value)
+
+    return(None)
+
+
+
+def genomic_inflation(diagnostics: dict) -> dict:
+
+    """
+
+    Computes the genomic inflation factor lambda GC of each p-value
+    column, the median of the chi-squared (1 df) statistics
+    corresponding to the p-values over the median of the chi-squared
+    distribution.
+
+    Args:
+    diagnostics (dict): The table of diagnostics, see
+    diagnostics_table
+
+    Returns:
+    A dictionary of lambda GC keyed by p-value column, None for
+    columns without p-values
+
+    """
+
+    normal = statistics.NormalDist()
+    expected_median = normal.inv_cdf(0.75) ** 2
+
+    inflation = {}
+
+    for column, sketch in diagnostics['sketches'].items():
+
+        median = sketch_quantile(sketch, diagnostics['gamma'], 0.5)
+
+        if median is None:
+            inflation[column] = None
+            continue
+
+        ## the median -log10(p) is the median of the statistics
+        p = max(10 ** -median, 1e-300)
+        inflation[column] = normal.inv_cdf(p / 2) ** 2 / expected_median
+
+    return(inflation)
+
+
+
+def qq_points(diagnostics: dict, column: str) -> list:
+
+    """
+
+    Lists the points of a QQ plot of a p-value column, one per bin of
+    its quantile sketch.
+
+    Args:
+    diagnostics (dict): The table of diagnostics, see
+    diagnostics_table
+    column (str): The p-value column
+
+    Returns:
+    A list of tuples (expected, observed) of -log10(p), the expected
+    value being that of the bin's most significant variant
+
+    """
+
+    sketch = diagnostics['sketches'][column]
+
+    points = []
+    rank = 0
+
+    for value, count in reversed(sketch_bins(sketch, diagnostics['gamma'])):
+        points.append((-math.log10((rank + 0.5) / sketch['n']), value))
+        rank += count
+
+    return(points)
+
+
+
+def write_diagnostics(diagnostics: dict, diagnostics_file: str) -> dict:
+
+    """
+
+    Writes the diagnostics of an association analysis to a json file:
+    the number of variants in total and per chromosome, lambda GC and
+    the median p-value of each p-value column, the QQ plot points and
+    the Manhattan plot grid. The file appears only once it is
+    complete.
+
+    Args:
+    diagnostics (dict): The table of diagnostics, see
+    diagnostics_table
+    diagnostics_file (str): The path of the json file
+
+    Returns:
+    The summary written
+
+    """
+
+    inflation = genomic_inflation(diagnostics)
+
+    summary = {'variants': diagnostics['variants'],
+               'chromosomes': diagnostics['chromosomes'],
+               'lambda-gc': inflation,
+               'p-values': {c: s['n'] for c, s in diagnostics['sketches'].items()},
+               'qq': {c: [list(point) for point in qq_points(diagnostics, c)]
+                      for c in diagnostics['sketches'] if diagnostics['sketches'][c]['n']},
+               'manhattan': {'bin-size': diagnostics['bin-size'],
+                             'level': diagnostics['level'],
+                             'points': sorted(diagnostics['manhattan'])}}
+
+    diagnostics_tempfile = diagnostics_file + '.' + uuid.uuid4().hex
+
+    with open(diagnostics_tempfile, 'w') as fh:
+        json.dump(summary, fh, indent = 1)
+
+    os.replace(diagnostics_tempfile, diagnostics_file)
+
+    return(summary)
+
+
+
+def plot_diagnostics(summary: dict, qq_file: str, manhattan_file: str) -> list:
+
+    """
+
+    Draws the QQ plot of each p-value column and the Manhattan plot
+    from the binned points of the diagnostics. Needs the optional
+    matplotlib package.
+
+    Args:
+    summary (dict): The diagnostics, see write_diagnostics
+    qq_file (str): The path of the QQ plot (png)
+    manhattan_file (str): The path of the Manhattan plot (png)
+
+    Returns:
+    The paths of the plots written, None if matplotlib is not
+    installed
+
+    """
+
+    ## figures without pyplot, which is not thread-safe (models are
+    ## joined at the same time, see run_stages)
+    try:
+        from matplotlib.figure import Figure
+    except ImportError:
+        print('\nmatplotlib is not installed, not drawing ' + qq_file + ' and ' + manhattan_file)
+        return(None)
+
+    ## very small p-values beyond the plotted range are drawn at its top
+    def capped(values, cap = 300):
+        return([min(v, cap) for v in values])
+
+    fig = Figure(figsize = (6, 6))
+    ax = fig.subplots()
+
+    limit = 0
+
+    for column, points in summary['qq'].items():
+        expected = [e for e, o in points]
+        observed = capped([o for e, o in points])
+        lambda_gc = summary['lambda-gc'][column]
+        ax.plot(expected, observed, '.', markersize = 3,
+                label = column + ' (lambda GC ' + '%.3f' % lambda_gc + ')')
+        limit = max(limit, max(expected))
+
+    ax.plot([0, limit], [0, limit], color = 'grey', linewidth = 1)
+    ax.set_xlabel('expected -log10(p)')
+    ax.set_ylabel('observed -log10(p)')
+    ax.legend()
+
+    fig.savefig(qq_file, dpi = 150)
+
+    ## chromosomes side by side in the order of the results
+    bin_size = summary['manhattan']['bin-size']
+    level = summary['manhattan']['level']
+
+    offsets = {}
+    ticks = []
+    offset = 0
+
+    for chr in summary['chromosomes']:
+        chr_bins = [b for c, b, l in summary['manhattan']['points'] if c == chr]
+        if not chr_bins:
+            continue
+        offsets[chr] = offset
+        ticks.append((offset + max(chr_bins) / 2, chr))
+        offset += max(chr_bins) + 1
+
+    fig = Figure(figsize = (14, 5))
+    ax = fig.subplots()
+
+    for index, chr in enumerate(offsets):
+        points = [(b, l) for c, b, l in summary['manhattan']['points'] if c == chr]
+        ax.plot([(offsets[chr] + b + 0.5) * bin_size / 1e6 for b, l in points],
+                capped([l * level for b, l in points]), '.', markersize = 2,
+                color = ('#1f4e79', '#7fa7d1')[index % 2])
+
+    ax.axhline(-math.log10(5e-8), color = 'red', linewidth = 0.5)
+    ax.set_xticks([t * bin_size / 1e6 for t, c in ticks])
+    ax.set_xticklabels([c for t, c in ticks], fontsize = 7)
+    ax.set_xlabel('chromosome')
+    ax.set_ylabel('-log10(p)')
+
+    fig.savefig(manhattan_file, dpi = 150)
+
+    return([qq_file, manhattan_file])
+
+
+
+def bgzip_tabix(infile: str, threads: int = 1) -> str:
+
+    """
+
+    Writes a bgzip-compressed copy of a merged bolt-lmm output file
+    and indexes it with tabix on the CHR and BP columns, for region
+    lookups such as 'tabix model_1.bolt.txt.gz 19:45000000-45500000'.
+
+    Args:
+    infile (str): The path of the bolt-lmm output file, sorted by
+    chromosome and position
+    threads (int): Number of bgzip compression threads
+
+    Returns:
+    The path of the compressed file
+
+    Raises:
+    subprocess.CalledProcessError: If bgzip or tabix fail
+
+    """
+
+    outfile = infile + '.gz'
+
+    with open(infile, 'r') as fh:
+        columns = fh.readline().rstrip('\n').split('\t')
+
+    ## tabix columns are 1-based
+    col_chr = str(columns.index('CHR') + 1)
+    col_bp = str(columns.index('BP') + 1)
+
+    bgzip_c = ['bgzip', '--threads', str(threads), '--stdout', infile]
+
+    print('\ncompressing ' + infile + ' with command')
+    print('\n' + ' '.join(bgzip_c) + ' > ' + outfile)
+
+    with open(outfile, 'wb') as out_fh:
+        subprocess.run(bgzip_c, stdout=out_fh, check=True)
+
+    tabix_c = ['tabix', '--force', '--sequence', col_chr, '--begin', col_bp,
+               '--end', col_bp, '--skip-lines', '1', outfile]
+
+    print('\nindexing ' + outfile + ' with command')
+    print('\n' + ' '.join(tabix_c))
+
+    subprocess.run(tabix_c, check=True)
+
+    return(outfile)
+
+
+
+def write_parquet(infile: str, outdir: str, block_size: int = 64) -> str:
+
+    """
+
+    Converts a merged bolt-lmm output file into a Parquet dataset with
+    typed columns, partitioned by chromosome (CHR=1/, CHR=2/, ...), so
+    that single chromosomes and columns can be read without parsing
+    the whole file. The file is converted in blocks, memory use does
+    not depend on its size. Needs the optional pyarrow package.
+
+    The dataset is written into a temporary directory next to outdir
+    and replaces an existing dataset only once it is complete, and
+    each part file has a name of its own, so that a chromosome
+    appearing again in the file (if it is not sorted) adds a part
+    instead of overwriting one.
+
+    Args:
+    infile (str): The path of the bolt-lmm output file, sorted by
+    chromosome
+    outdir (str): The directory of the Parquet dataset
+    block_size (int): Size of the blocks read at a time in mb
+
+    Returns:
+    The path of the dataset, None if pyarrow is not installed
+
+    """
+
+    try:
+        import pyarrow as pa
+        import pyarrow.compute as pc
+        import pyarrow.csv as pa_csv
+        import pyarrow.parquet as pq
+    except ImportError:
+        print('\npyarrow is not installed, not writing Parquet dataset ' + outdir)
+        return(None)
+
+    with open(infile, 'r') as fh:
+        columns = fh.readline().rstrip('\n').split('\t')
+
+    ## identifiers and alleles as strings (CHR can be X or XY), all
+    ## other columns are numbers
+    string_columns = ('SNP', 'CHR', 'ALLELE1', 'ALLELE0')
+    column_types = {c: (pa.string() if c in string_columns
+                        else pa.int64() if c == 'BP' else pa.float64())
+                    for c in columns}
+
+    reader = pa_csv.open_csv(
+        infile,
+        read_options=pa_csv.ReadOptions(block_size=block_size * 1024 * 1024),
+        parse_options=pa_csv.ParseOptions(delimiter='\t'),
+        convert_options=pa_csv.ConvertOptions(column_types=column_types,
+                                              null_values=['NA', '']))
+
+    print('\nwriting Parquet dataset ' + outdir)
+
+    dataset_tempdir = outdir.rstrip('/') + '.' + uuid.uuid4().hex
+
+    ## the file is sorted by chromosome, only one writer is open at a
+    ## time
+    chr_writer = None
+    chr_current = None
+
+    try:
+        for batch in reader:
+
+            table = pa.Table.from_batches([batch])
+
+            for chr in pc.unique(table['CHR']).to_pylist():
+
+                if chr != chr_current:
+
+                    if chr_writer is not None:
+                        chr_writer.close()
+
+                    chr_dir = os.path.join(dataset_tempdir, 'CHR=' + chr)
+                    os.makedirs(chr_dir, exist_ok=True)
+
+                    chr_writer = pq.ParquetWriter(os.path.join(chr_dir, 'part-' + uuid.uuid4().hex + '.parquet'),
+                                                  table.schema.remove(table.schema.get_field_index('CHR')))
+                    chr_current = chr
+
+                chr_table = table.filter(pc.equal(table['CHR'], chr)).drop_columns(['CHR'])
+
+                chr_writer.write_table(chr_table)
+
+        if chr_writer is not None:
+            chr_writer.close()
+
+    except BaseException:
+        if chr_writer is not None:
+            chr_writer.close()
+        shutil.rmtree(dataset_tempdir, ignore_errors = True)
+        raise
+
+    ## an empty dataset for a file without variants
+    os.makedirs(dataset_tempdir, exist_ok = True)
+
+    ## a directory is only replaced if it is empty, the previous
+    ## dataset is moved out of the way first
+    if os.path.exists(outdir):
+        previous_dir = dataset_tempdir + '.previous'
+        os.replace(outdir, previous_dir)
+        os.replace(dataset_tempdir, outdir)
+        shutil.rmtree(previous_dir)
+    else:
+        os.replace(dataset_tempdir, outdir)
+
+    return(outdir)
+
+
+
+def read_snp_positions(bgen_file: str, bim_file: str) -> array.array:
+
+    """
+
+    Reads the positions of all variants of a chromosome, from the
+    SQLite index (.bgi) of its bgen file if there is one, otherwise
+    from the 4th column of its .bim file.
+
+    Args:
+    bgen_file (str): The path of the bgen file
+    bim_file (str): The path of the bim file, used without bgen index
+
+    Returns:
+    An array of positions, in the order of the file
+
+    """
+
+    bgi_file = bgen_file + '.bgi'
+
+    if os.path.exists(bgi_file):
+
+        ## read-only, the index may be on a shared, read-only directory
+        connection = sqlite3.connect('file:' + bgi_file + '?mode=ro', uri=True)
+
+        try:
+            cursor = connection.execute('SELECT position FROM Variant ORDER BY chromosome, position')
+            positions = array.array('q', (row[0] for row in cursor))
+        finally:
+            connection.close()
+
+    else:
+
+        ## only need snp position, i.e. 4th column
+        import pandas as pd
+
+        bim_positions = pd.read_csv(bim_file, sep='\t', header=None, usecols=[3],
+                                    dtype='int64', engine='c')
+
+        positions = array.array('q', bim_positions[3].to_numpy())
+
+    return(positions)
+
+
+
+def read_variant_weights(mfi_file: str, cost_model: dict) -> tuple:
+
+    """
+
+    Reads positions, minor allele frequencies and INFO scores from a
+    UK biobank mfi file (no header; alternate id, rsid, position,
+    alleles, MAF, minor allele, INFO) and weights each variant with
+    its cost: cost_model['per-variant'] if it passes the MAF and INFO
+    filters of bolt-lmm, 0 otherwise.
+
+    Args:
+    mfi_file (str): The path of the mfi file
+    cost_model (dict): The cost model, see plan_chromosome_chunks
+
+    Returns:
+    A tuple of arrays (positions, weights)
+
+    """
+
+    import pandas as pd
+
+    mfi = pd.read_csv(mfi_file, sep='\t', header=None, usecols=[2, 5, 7],
+                      names=['position', 'maf', 'info'], engine='c')
+
+    passed = (mfi['maf'] >= cost_model['min-maf']) & (mfi['info'] >= cost_model['min-info'])
+
+    return((mfi['position'].to_numpy(), passed.to_numpy() * cost_model['per-variant']))
+
+
+
+def plan_chromosome_chunks(chromosome: str, bgen_file: str, bim_file: str,
+                           chunksize: int, cache_dir: str,
+                           cost_model: dict = None) -> list:
+
+    """
+
+    Divides the variants of a chromosome into chunks, either of
+    chunksize variants (see snp_chunks) or, with a cost model, of
+    about the same cost (see cost_chunks). The chunk plan is cached in
+    cache_dir, keyed by the size and modification time of the file the
+    positions are read from and the chunking parameters, so that later
+    runs with the same input and parameters plan instantly.
+
+    Args:
+    chromosome (str): The chromosome
+    bgen_file (str): The path of the bgen file, see read_snp_positions
+    bim_file (str): The path of the bim file, see read_snp_positions
+    chunksize (int): The number of SNPs in one chunk
+    cache_dir (str): Directory of the chunk plan cache
+    cost_model (dict): None for chunks of chunksize variants, otherwise
+    'target' (wall time per chunk in seconds), 'fixed' (seconds per
+    chunk for the model fit), 'per-variant' (seconds per tested
+    variant), 'min-maf', 'min-info' and 'mfi-file' (mfi file of the
+    chromosome with MAF and INFO of each variant, or None to count
+    all variants)
+
+    Returns:
+    A list of chunks, see snp_chunks, with the positions as strings
+
+    """
+
+    if cost_model is not None and cost_model['mfi-file']:
+        source_file = cost_model['mfi-file']
+    elif os.path.exists(bgen_file + '.bgi'):
+        source_file = bgen_file + '.bgi'
+    else:
+        source_file = bim_file
+
+    source_stat = os.stat(source_file)
+
+    plan_key = {'source': os.path.realpath(source_file),
+                'size': source_stat.st_size,
+                'mtime': source_stat.st_mtime,
+                'chunksize': chunksize,
+                'cost-model': cost_model}
+
+    cache_file = os.path.join(cache_dir, os.path.basename(source_file) + '.chunks.json')
+
+    if os.path.exists(cache_file):
+
+        with open(cache_file, 'r') as fh:
+            cached_plan = json.load(fh)
+
+        if cached_plan['key'] == plan_key:
+            print('chromosome ' + str(chromosome) + ': chunk plan from ' + cache_file)
+            return([(c[0], tuple(c[1])) for c in cached_plan['chunks']])
+
+    print('chromosome ' + str(chromosome) + ': reading positions from ' + source_file)
+
+    if cost_model is None:
+        positions = read_snp_positions(bgen_file, bim_file)
+        chunks = snp_chunks(positions, chromosome, chunksize)
+
+    else:
+        if cost_model['mfi-file']:
+            positions, weights = read_variant_weights(source_file, cost_model)
+        else:
+            positions = read_snp_positions(bgen_file, bim_file)
+            weights = [cost_model['per-variant']] * len(positions)
+
+        chunks = cost_chunks(positions, weights, chromosome,
+                             cost_model['target'], cost_model['fixed'])
+
+    chunks = [(c[0], (str(c[1][0]), str(c[1][1]))) for c in chunks]
+
+    ## write to a temporary file first, runs planning at the same time
+    ## must not read a partial plan
+    cache_tempfile = cache_file + '.' + uuid.uuid4().hex
+
+    with open(cache_tempfile, 'w') as fh:
+        json.dump({'key': plan_key, 'chunks': chunks}, fh)
+
+    os.replace(cache_tempfile, cache_file)
+
+    return(chunks)
+
+
+
+def process_pool(processes: int = None) -> concurrent.futures.ProcessPoolExecutor:
+
+    """
+
+    Starts a pool of worker processes. The workers are forked, and all
+    of them at once, so the pool has to be started before the process
+    starts threads (e.g. before run_stages), as a process forked from a
+    threaded process may inherit locks other threads held. The spawn
+    and forkserver start methods are no option: they run the main
+    script again in each worker, and the scripts of the pipeline have
+    no main guard.
+
+    Args:
+    processes (int): Number of worker processes, all cores available
+    to the process if None, see local_capacity
+
+    Returns:
+    The pool, with its workers running
+
+    """
+
+    if processes is None:
+        processes = len(os.sched_getaffinity(0))
+
+    pool = concurrent.futures.ProcessPoolExecutor(max_workers=max(1, processes),
+                                                  mp_context=multiprocessing.get_context('fork'))
+
+    ## a pool of forked workers starts all of them with its first task
+    pool.submit(os.getpid).result()
+
+    return(pool)
+
+
+
+def plan_chunks(chr_list: list, data_dir: str, imp_base: str, chunksize: int,
+                cache_dir: str, cost_model: dict = None, processes: int = None,
+                pool: concurrent.futures.ProcessPoolExecutor = None) -> list:
+
+    """
+
+    Plans the chunks of all chromosomes in parallel, see
+    plan_chromosome_chunks.
+
+    Args:
+    chr_list (list): The chromosomes
+    data_dir (str): Directory of the imputed snp files
+    imp_base (str): Prefix of the imputed snp files
+    chunksize (int): The number of SNPs in one chunk
+    cache_dir (str): Directory of the chunk plan cache
+    cost_model (dict): The cost model, see plan_chromosome_chunks. The
+    mfi file is given as a pattern with '{chr}' in place of the
+    chromosome
+    processes (int): Number of chromosomes planned at the same time,
+    all cores if None; not used with pool
+    pool (ProcessPoolExecutor): The pool planning the chromosomes, see
+    process_pool, started here (and shut down) if None
+
+    Returns:
+    A list of chunks of all chromosomes, in the order of chr_list
+
+    """
+
+    Path(cache_dir).mkdir(parents=True, exist_ok=True)
+
+    def chr_cost_model(chr):
+        if cost_model is None or not cost_model['mfi-file']:
+            return(cost_model)
+        return(dict(cost_model, **{'mfi-file': cost_model['mfi-file'].replace('{chr}', str(chr))}))
+
+    if pool is None:
+        with process_pool(min(processes or len(os.sched_getaffinity(0)), len(chr_list))) as pool:
+            return(plan_chunks(chr_list, data_dir, imp_base, chunksize, cache_dir,
+                               cost_model, pool = pool))
+
+    futures = [pool.submit(plan_chromosome_chunks, chr,
+                           os.path.join(data_dir, (imp_base + str(chr) + '.bgen')),
+                           os.path.join(data_dir, (imp_base + str(chr) + '.bim')),
+                           chunksize, cache_dir, chr_cost_model(chr))
+               for chr in chr_list]
+
+    chunk_list = []
+
+    for future in futures:
+        chunk_list.extend(future.result())
+
+    return(chunk_list)
+
+
+
+def stage_bim(input_bim: str, staged_bim: str) -> int:
+
+    """
+
+    Writes a copy of a bim file with variant ids made unique from
+    chromosome, position and alleles (chr_bp_a1_a2_1), streaming line
+    by line. The copy gets the modification time of the input, and an
+    existing copy with the same modification time is kept, so that
+    staging again (e.g. in a resumed run) costs nothing. The copy
+    appears only once it is complete.
+
+    Args:
+    input_bim (str): The path of the bim file
+    staged_bim (str): The path of the copy
+
+    Returns:
+    The number of variants, None if an existing copy was kept
+
+    Raises:
+    ValueError: If a line of the bim file does not have 6 columns
+
+    """
+
+    input_stat = os.stat(input_bim)
+
+    if os.path.exists(staged_bim) and os.stat(staged_bim).st_mtime == input_stat.st_mtime:
+        return(None)
+
+    staged_tempfile = staged_bim + '.' + uuid.uuid4().hex
+
+    n_variants = 0
+
+    try:
+        with open(input_bim, 'r') as in_fh, open(staged_tempfile, 'w') as out_fh:
+
+            for line_number, line in enumerate(in_fh, 1):
+
+                fields = line.split()
+
+                if len(fields) != 6:
+                    raise ValueError(input_bim + ' line ' + str(line_number) + ': ' +
+                                     str(len(fields)) + ' columns, expected 6')
+
+                chr, snp, cm, bp, a1, a2 = fields
+
+                out_fh.write('\t'.join([chr, '_'.join([chr, bp, a1, a2, '1']), cm, bp, a1, a2]) + '\n')
+
+                n_variants += 1
+
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(staged_tempfile)
+        raise
+
+    os.utime(staged_tempfile, ns = (input_stat.st_atime_ns, input_stat.st_mtime_ns))
+
+    os.replace(staged_tempfile, staged_bim)
+
+    return(n_variants)
+
+
+
+def count_lines(path: str) -> int:
+
+    """
+
+    Args:
+    path (str): The path of a text file
+
+    Returns:
+    The number of lines of the file
+
+    """
+
+    n_lines = 0
+
+    with open(path, 'rb') as fh:
+        for block in iter(lambda: fh.read(1024 * 1024), b''):
+            n_lines += block.count(b'\n')
+
+    return(n_lines)
+
+
+
+def check_bed(bed_file: str, n_variants: int, n_samples: int) -> None:
+
+    """
+
+    Checks that a plink bed file is in variant-major mode and has the
+    size its variants and samples imply, e.g. that it is not truncated.
+
+    Args:
+    bed_file (str): The path of the bed file
+    n_variants (int): The number of variants (lines of the bim file)
+    n_samples (int): The number of samples (lines of the fam file)
+
+    Raises:
+    ValueError: If the bed file has a wrong header or size
+
+    """
+
+    with open(bed_file, 'rb') as fh:
+        magic = fh.read(3)
+
+    if magic != b'\x6c\x1b\x01':
+        raise ValueError(bed_file + ' is not a variant-major plink bed file')
+
+    ## 2 bits per sample, each variant padded to full bytes
+    expected_size = 3 + n_variants * ((n_samples + 3) // 4)
+
+    bed_size = os.path.getsize(bed_file)
+
+    if bed_size != expected_size:
+        raise ValueError(bed_file + ' has ' + str(bed_size) + ' bytes, expected ' +
+                         str(expected_size) + ' for ' + str(n_variants) + ' variants and ' +
+                         str(n_samples) + ' samples')
+
+
+
+def model_list(cfg: dict) -> list:
+
+    """
+
+    Reads the models from the configuration: pheno-1/cov-1,
+    pheno-2/cov-2, ... Each phenotype in the comma-separated list of a
+    pheno-k entry is a model with the covariates of cov-k.
+
+    Args:
+    cfg (dict): The configuration
+
+    Returns:
+    A list of models, each a dictionary with 'name' (model_1,
+    model_2, ...), 'pheno' (phenotype column) and 'cov' (covariates,
+    see covar_options)
+
+    """
+
+    models = []
+    k = 1
+
+    while ('pheno-' + str(k)) in cfg:
+
+        phenos = str(cfg['pheno-' + str(k)]).replace(' ', '').split(',')
+        cov = cfg.get('cov-' + str(k)) or ';'
+
+        for pheno in phenos:
+            models.append({'name': 'model_' + str(len(models) + 1),
+                           'pheno': pheno,
+                           'cov': cov.replace(' ', '')})
+
+        k += 1
+
+    return(models)
+
+
+
+def covar_options(cov: str, covar_file: str) -> str:
+
+    """
+
+    Formats the covariates of a model as bolt-lmm options.
+
+    Args:
+    cov (str): The covariates, cat_cov1,...,cat_covn;quant_cov1,...,quant_covn
+    covar_file (str): The file containing the covariate columns
+
+    Returns:
+    The bolt-lmm options, e.g.
+    ' --covarFile=pheno.txt --covarCol=Sex --qCovarCol=Age'
+
+    """
+
+    ## without semicolon, only categorial covariates
+    cov = cov + ';'
+
+    # categorial covariates
+    ccovar = cov.split(';')[0].split(',')
+
+    # quantitative covariates
+    qcovar = cov.split(';')[1].split(',')
+
+    ccovar_string = ''.join([(' --covarCol=' + x) for x in ccovar if x != ''])
+    qcovar_string = ''.join([(' --qCovarCol=' + x) for x in qcovar if x != ''])
+
+    if ccovar_string or qcovar_string:
+        return(' --covarFile=' + covar_file + ccovar_string + qcovar_string)
+    else:
+        return('')
+
+
+
+def read_sample_ids(sample_file: str, skip_rows: int = 0):
+
+    """
+
+    Reads the samples of a whitespace-delimited file with FID and IID
+    in its first two columns, e.g. a fam file (no header), an Oxford
+    sample file (2 header lines) or the phenotype file (1 header line).
+
+    Args:
+    sample_file (str): The path of the file
+    skip_rows (int): The number of header lines
+
+    Returns:
+    A pandas Index of the samples, as 'FID<tab>IID' strings
+
+    """
+
+    import pandas as pd
+
+    samples = pd.read_csv(sample_file, sep=r'\s+', header=None, skiprows=skip_rows,
+                          usecols=[0, 1], dtype=str, engine='c')
+
+    ## object strings, the hash tables of set operations on them are
+    ## faster than on the string dtype
+    return(pd.Index(samples[0] + '\t' + samples[1], dtype=object).drop_duplicates())
+
+
+
+def sample_overlap(fam_file: str, sample_file: str, pheno_file: str,
+                   remove_file: str = None) -> dict:
+
+    """
+
+    Intersects the samples of the genotype data, the imputed data, the
+    phenotype file and the list of samples to remove. bolt-lmm analyses
+    the samples of the core SNP set, i.e. the samples of the fam file
+    that are in the phenotype file (see run-plink.py), and exits with
+    an error if any of these that are not removed is missing in the
+    sample file.
+
+    Args:
+    fam_file (str): The path of the fam file
+    sample_file (str): The path of the Oxford sample file of the
+    imputed data
+    pheno_file (str): The path of the phenotype file
+    remove_file (str): The path of the list of samples to remove, or
+    None
+
+    Returns:
+    A dictionary with the numbers of samples 'fam', 'sample', 'pheno',
+    'remove', 'fam-sample' (in both the fam and sample file),
+    'fam-pheno' (in the core SNP set) and 'analysis' (analysed by
+    bolt-lmm), with 'missing', a pandas Index of the samples of the
+    core SNP set missing in the sample file and not removed, and
+    with 'samples', a pandas Index of the analysed samples
+
+    """
+
+    fam = read_sample_ids(fam_file)
+    sample = read_sample_ids(sample_file, skip_rows = 2)
+    pheno = read_sample_ids(pheno_file, skip_rows = 1)
+
+    if remove_file:
+        remove = read_sample_ids(remove_file)
+    else:
+        remove = fam[:0]
+
+    coreset = fam.intersection(pheno, sort = False)
+    kept = coreset.difference(remove, sort = False)
+
+    in_sample = kept.isin(sample)
+    missing = kept[~in_sample]
+
+    return({'fam': len(fam),
+            'sample': len(sample),
+            'pheno': len(pheno),
+            'remove': len(remove),
+            'fam-sample': int(fam.isin(sample).sum()),
+            'fam-pheno': len(coreset),
+            'analysis': len(kept) - len(missing),
+            'missing': missing,
+            'samples': kept[in_sample]})
+
+
+
+def write_sample_ids(samples, sample_file: str) -> None:
+
+    """
+
+    Writes samples as a header-less, tab-delimited FID/IID file, as
+    plink --keep and bolt-lmm --remove read it.
+
+    Args:
+    samples: The samples, an iterable of 'FID<tab>IID' strings, see
+    read_sample_ids
+    sample_file (str): The path of the file
+
+    """
+
+    with open(sample_file, 'w') as fh:
+        for sample in samples:
+            fh.write(sample + '\n')
+
+
+
+def write_model_samples(pheno_file: str, models: list, samples, sample_dir: str) -> dict:
+
+    """
+
+    Writes the analysis samples of each model: a phenotype file with
+    the phenotype and covariate columns of the model and only the
+    complete cases among the given samples (bolt-lmm ignores samples
+    with a missing phenotype or covariate), the samples of all models
+    as a keep file for the core SNP set, and for each model the
+    samples of the core SNP set it does not analyse as a remove file.
+
+    Args:
+    pheno_file (str): The path of the phenotype file
+    models (list): The models, see model_list
+    samples: The samples to analyse, a pandas Index of 'FID<tab>IID'
+    strings, see sample_overlap
+    sample_dir (str): The directory of the files
+
+    Returns:
+    A dictionary with the path of the 'keep' file and, for each model
+    name, a dictionary with its 'pheno-file', its 'remove-file' (None
+    if it analyses all samples of the keep file) and its number of
+    'samples'
+
+    """
+
+    import pandas as pd
+
+    Path(sample_dir).mkdir(parents=True, exist_ok=True)
+
+    model_columns = {}
+
+    for model in models:
+        cov = model['cov'] + ';'
+        covariates = [x for x in cov.replace(';', ',').split(',') if x != '']
+        model_columns[model['name']] = [model['pheno']] + [x for x in covariates if x != model['pheno']]
+
+    columns = ['FID', 'IID'] + list(dict.fromkeys(sum(model_columns.values(), [])))
+
+    ## values are written as they are in the phenotype file
+    pheno = pd.read_csv(pheno_file, sep=r'\s+', usecols=lambda x: x in columns, dtype=str,
+                        keep_default_na=False, engine='c')
+
+    keys = pd.Index(pheno['FID'] + '\t' + pheno['IID'], dtype=object)
+
+    ## the first record of a sample, as in bolt-lmm
+    pheno = pheno[keys.isin(samples) & ~keys.duplicated()]
+    keys = pd.Index(pheno['FID'] + '\t' + pheno['IID'], dtype=object)
+
+    missing = pheno.isin(['-9', 'NA'])
+
+    complete = {}
+
+    for model in models:
+        complete[model['name']] = ~missing[model_columns[model['name']]].any(axis=1).to_numpy()
+
+    keep = keys[pd.DataFrame(complete, index=pheno.index).any(axis=1).to_numpy()]
+
+    keep_file = os.path.join(sample_dir, 'keep.txt')
+    write_sample_ids(keep, keep_file)
+
+    model_samples = {'keep': keep_file}
+
+    for model in models:
+
+        model_pheno_file = os.path.join(sample_dir, (model['name'] + '.pheno.txt'))
+        model_remove_file = os.path.join(sample_dir, (model['name'] + '.remove.txt'))
+
+        model_complete = complete[model['name']]
+
+        pheno.loc[model_complete, ['FID', 'IID'] + model_columns[model['name']]].to_csv(
+            model_pheno_file, sep='\t', index=False)
+
+        remove = keep.difference(keys[model_complete], sort = False)
+
+        if len(remove):
+            write_sample_ids(remove, model_remove_file)
+        else:
+            ## the remove file of a previous run
+            if os.path.exists(model_remove_file):
+                os.remove(model_remove_file)
+            model_remove_file = None
+
+        model_samples[model['name']] = {'pheno-file': model_pheno_file,
+                                        'remove-file': model_remove_file,
+                                        'samples': int(model_complete.sum())}
+
+    return(model_samples)
+
+
+
+def check_model_columns(pheno_file: str, models: list) -> list:
+
+    """
+
+    Checks that the phenotype and covariate columns of the models are
+    in the phenotype file and that the phenotypes and quantitative
+    covariates are numeric, apart from the missing values -9 and NA.
+    Categorial covariates may be any strings. Only the columns of the
+    models are read.
+
+    Args:
+    pheno_file (str): The path of the phenotype file
+    models (list): The models, see model_list
+
+    Returns:
+    A list of problems, empty if there are none
+
+    """
+
+    import pandas as pd
+
+    with open(pheno_file, 'r') as fh:
+        header = fh.readline().split()
+
+    problems = []
+
+    if header[:2] != ['FID', 'IID']:
+        problems.append(pheno_file + ': the first two columns are ' + str(header[:2]) +
+                        ', not FID and IID')
+
+    ## columns and whether they need to be numeric
+    numeric = {}
+
+    for model in models:
+
+        cov = model['cov'] + ';'
+        ccovar = [x for x in cov.split(';')[0].split(',') if x != '']
+        qcovar = [x for x in cov.split(';')[1].split(',') if x != '']
+
+        for column in [model['pheno']] + qcovar:
+            numeric[column] = True
+
+        for column in ccovar:
+            numeric.setdefault(column, False)
+
+    for column in numeric:
+        if column not in header:
+            problems.append(pheno_file + ': no column ' + column)
+
+    numeric_columns = [column for column in numeric if numeric[column] and column in header]
+
+    if not numeric_columns:
+        return(problems)
+
+    values = pd.read_csv(pheno_file, sep=r'\s+', usecols=numeric_columns, dtype=str,
+                         keep_default_na=False, engine='c')
+
+    for column in numeric_columns:
+
+        missing = values[column].isin(['-9', 'NA'])
+        invalid = pd.to_numeric(values[column], errors='coerce').isna() & ~missing
+
+        if invalid.any():
+            problems.append(pheno_file + ': column ' + column + ' has ' + str(int(invalid.sum())) +
+                            ' non-numeric value(s), e.g. ' + repr(values[column][invalid].iloc[0]))
+
+    return(problems)
+
+
+
+def missing_inputs(cfg: dict, chr_list: list) -> list:
+
+    """
+
+    Checks that the input files of the configuration exist: the sample
+    files, the phenotype file, the LD score file, the list of samples
+    to remove and, for each chromosome, the genotype bed and bim files
+    and the imputed bgen file with either its index or its bim file
+    (see read_snp_positions).
+
+    Args:
+    cfg (dict): The configuration
+    chr_list (list): The chromosomes
+
+    Returns:
+    A list of the missing files, empty if there are none
+
+    """
+
+    files = [cfg['fam-file'], cfg['sample-file'], cfg['pheno-file'], cfg['ldscore-file']]
+
+    if cfg.get('remove-samples-list'):
+        files.append(cfg['remove-samples-list'])
+
+    missing = []
+
+    for chr in chr_list:
+
+        gen_path = os.path.join(cfg['data-dir'], (cfg['gen-base'] + str(chr)))
+        imp_path = os.path.join(cfg['data-dir'], (cfg['imp-base'] + str(chr)))
+
+        files.extend([gen_path + '.bed', gen_path + '.bim', imp_path + '.bgen'])
+
+        if not os.path.exists(imp_path + '.bgen.bgi') and not os.path.exists(imp_path + '.bim'):
+            missing.append(imp_path + '.bgen.bgi (or ' + imp_path + '.bim)')
+
+    missing = [path for path in files if not os.path.exists(path)] + missing
+
+    return(missing)
+
+
+
+def chunk_name(base: str, chunk: tuple) -> str:
+
+    """
+
+    Args:
+    base (str): Prefix of the imputed snp files
+    chunk (tuple): A chunk, see snp_chunks
+
+    Returns:
+    The name of the chunk used in its file names, e.g.
+    'ukb_imp_chr3_727-648'
+
+    """
+
+    chr = chunk[0]
+    interval = chunk[1]
+
+    return(base + str(chr) + '_' + interval[0] + '-' + interval[1])
+
+
+
+def shared_directory(path: str) -> str:
+
+    """
+
+    Creates a directory of a cache shared by users of one group:
+    group-writable and setgid, so that the files created in it belong
+    to the group of the directory and any member can replace or remove
+    them. The mode of an existing directory of another user is left as
+    it is.
+
+    Args:
+    path (str): The path of the directory
+
+    Returns:
+    The path of the directory
+
+    """
+
+    Path(path).mkdir(parents=True, exist_ok=True)
+
+    ## explicitly, the umask usually removes group write permission
+    with contextlib.suppress(PermissionError):
+        os.chmod(path, 0o2775)
+
+    return(path)
+
+
+
+def open_lock(lock_file: str):
+
+    """
+
+    Opens a lock file for fcntl.flock, creating it if needed. It is
+    opened read-only, which is all flock needs, so that the lock file
+    of another user can be locked too.
+
+    Args:
+    lock_file (str): The path of the lock file
+
+    Returns:
+    The file object of the lock file
+
+    """
+
+    return(os.fdopen(os.open(lock_file, os.O_RDONLY | os.O_CREAT, 0o664), 'r'))
+
+
+
+def extract_bgen_chunk(bgen_file: str, bgen_range: str, bgen_chunkfile: str) -> str:
+
+    """
+
+    Extracts a range of a bgen file into a new, indexed bgen file with
+    bgenix, unless that has been done already. Tasks extracting the
+    same chunk at the same time (e.g. the models of a chunk) wait for
+    each other, and the chunk files are written under temporary names
+    first, so a chunk file that exists is complete.
+
+    Args:
+    bgen_file (str): The path of the bgen file
+    bgen_range (str): The range in bgenix format, e.g. '03:727-648'
+    bgen_chunkfile (str): The path of the bgen file of the chunk
+
+    Returns:
+    The path of the bgen file of the chunk
+
+    Raises:
+    subprocess.CalledProcessError: If bgenix fails
+
+    """
+
+    with open_lock(bgen_chunkfile + '.lock') as lock_fh:
+
+        fcntl.flock(lock_fh, fcntl.LOCK_EX)
+
+        if os.path.exists(bgen_chunkfile) and os.path.exists(bgen_chunkfile + '.bgi'):
+            print('\nbgen file ' + bgen_chunkfile + ' exists already')
+            return(bgen_chunkfile)
+
+        bgen_tempfile = bgen_chunkfile + '.' + uuid.uuid4().hex + '.bgen'
+
+        bgen_c = ['bgenix', '-g', bgen_file, '-incl-range', bgen_range]
+
+        print('\ngenerating bgen file for range ' + bgen_range + ' with command')
+        print('\n' + ' '.join(bgen_c) + ' > ' + bgen_tempfile)
+
+        with trace_span('bgenix extract', 'bgen', range=bgen_range) as span:
+            with open(bgen_tempfile, 'wb') as out_fh:
+                subprocess.run(bgen_c, stdout=out_fh, check=True)
+            span['bytes-written'] = os.path.getsize(bgen_tempfile)
+
+        ## bgen index
+        bgen_idx_c = ['bgenix', '-g', bgen_tempfile, '-index']
+
+        print('\nindexing bgen file ' + bgen_tempfile)
+        print('\n' + ' '.join(bgen_idx_c))
+
+        with trace_span('bgenix index', 'bgen', range=bgen_range):
+            subprocess.run(bgen_idx_c, check=True)
+
+        ## group-writable, so that users sharing a chunk cache can mark
+        ## it as used, see bgen_cache_chunk
+        for chunk_tempfile in (bgen_tempfile, bgen_tempfile + '.bgi'):
+            os.chmod(chunk_tempfile, 0o664)
+
+        ## index first, the bgen file marks a complete chunk
+        os.replace(bgen_tempfile + '.bgi', bgen_chunkfile + '.bgi')
+        os.replace(bgen_tempfile, bgen_chunkfile)
+
+    return(bgen_chunkfile)
+
+
+
+def bgen_cache_key(bgen_file: str, bgen_range: str) -> str:
+
+    """
+
+    Args:
+    bgen_file (str): The path of the bgen file
+    bgen_range (str): The range in bgenix format, e.g. '03:727-648'
+
+    Returns:
+    The key of a bgen chunk in the chunk cache, a hash of the
+    identity of the bgen file (real path, size and modification time)
+    and the range
+
+    """
+
+    bgen_stat = os.stat(bgen_file)
+
+    identity = '\t'.join([os.path.realpath(bgen_file), str(bgen_stat.st_size),
+                          str(bgen_stat.st_mtime), bgen_range])
+
+    return(hashlib.sha1(identity.encode('UTF-8')).hexdigest())
+
+
+
+@contextlib.contextmanager
+def bgen_cache_chunk(cache_dir: str, bgen_file: str, bgen_range: str, cache_size: float):
+
+    """
+
+    Provides a bgen chunk from the persistent chunk cache, shared by
+    runs and users, extracting it first if it is not cached yet (see
+    extract_bgen_chunk). The chunk is locked against eviction while in
+    use, i.e. inside the with-statement:
+
+    with bgen_cache_chunk(cache_dir, bgen_file, bgen_range, 2000) as bgen_chunkfile:
+        ...
+
+    After an extraction, the least recently used chunks are evicted
+    to keep the cache within its size (see evict_bgen_cache). The
+    directories and chunks of the cache are group-writable (see
+    shared_directory), so that the users of its group share them.
+
+    Args:
+    cache_dir (str): Directory of the chunk cache
+    bgen_file (str): The path of the bgen file
+    bgen_range (str): The range in bgenix format, e.g. '03:727-648'
+    cache_size (float): The maximum size of the cache in gb
+
+    Yields:
+    The path of the bgen file of the chunk
+
+    """
+
+    key = bgen_cache_key(bgen_file, bgen_range)
+
+    shared_directory(cache_dir)
+    entry_dir = shared_directory(os.path.join(cache_dir, key[:2]))
+
+    bgen_chunkfile = os.path.join(entry_dir, key + '.bgen')
+
+    extracted = False
+
+    with open_lock(bgen_chunkfile + '.lock') as lock_fh:
+
+        while True:
+
+            fcntl.flock(lock_fh, fcntl.LOCK_SH)
+
+            if os.path.exists(bgen_chunkfile) and os.path.exists(bgen_chunkfile + '.bgi'):
+                break
+
+            ## extraction needs the exclusive lock
+            fcntl.flock(lock_fh, fcntl.LOCK_UN)
+
+            print('\nbgen chunk cache miss for range ' + bgen_range + ' of ' + bgen_file)
+
+            extract_bgen_chunk(bgen_file, bgen_range, bgen_chunkfile)
+
+            extracted = True
+
+        ## evicting while holding the lock of the new chunk
+        if extracted:
+            evict_bgen_cache(cache_dir, cache_size)
+
+        print('\nbgen chunk for range ' + bgen_range + ' of ' + bgen_file +
+              ' in cache: ' + bgen_chunkfile)
+
+        ## modification time as time of last use for eviction; chunks
+        ## are group-writable, only users outside the group of the
+        ## cache cannot set it
+        with contextlib.suppress(PermissionError):
+            os.utime(bgen_chunkfile)
+
+        try:
+            yield bgen_chunkfile
+        finally:
+            fcntl.flock(lock_fh, fcntl.LOCK_UN)
+
+
+
+def evict_bgen_cache(cache_dir: str, cache_size: float, min_age: int = 600) -> int:
+
+    """
+
+    Removes the least recently used chunks from the chunk cache until
+    it is within its size. Chunks in use or used in the last min_age
+    seconds (e.g. just extracted, but not locked for use yet) are not
+    removed, nor chunks of other users that this user may not remove,
+    and only one task evicts at a time.
+
+    Args:
+    cache_dir (str): Directory of the chunk cache
+    cache_size (float): The maximum size of the cache in gb
+    min_age (int): Time since the last use in seconds below which
+    chunks are not removed
+
+    Returns:
+    The number of bytes removed
+
+    """
+
+    removed = 0
+
+    ## a cache directory of another user that is not group-writable
+    try:
+        evict_fh = open_lock(os.path.join(cache_dir, '.evict.lock'))
+    except PermissionError:
+        return(removed)
+
+    with evict_fh:
+
+        try:
+            fcntl.flock(evict_fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return(removed)
+
+        entries = []
+
+        for bgen_chunkfile in glob.glob(os.path.join(cache_dir, '??', '*.bgen')):
+
+            ## complete chunks only, not temporary files of extractions
+            if not re.fullmatch(r'[0-9a-f]{40}\.bgen', os.path.basename(bgen_chunkfile)):
+                continue
+
+            try:
+                bgen_stat = os.stat(bgen_chunkfile)
+                bgi_size = os.path.getsize(bgen_chunkfile + '.bgi')
+            except FileNotFoundError:
+                continue
+
+            entries.append((bgen_stat.st_mtime, bgen_stat.st_size + bgi_size, bgen_chunkfile))
+
+        total = sum(entry[1] for entry in entries)
+        budget = cache_size * 1024 ** 3
+
+        for mtime, size, bgen_chunkfile in sorted(entries):
+
+            if total <= budget or mtime > time.time() - min_age:
+                break
+
+            try:
+                lock_fh = open_lock(bgen_chunkfile + '.lock')
+            except PermissionError:
+                continue
+
+            with lock_fh:
+
+                ## skip chunks in use or being extracted
+                try:
+                    fcntl.flock(lock_fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+
+                ## bgen file first, it marks a complete chunk; chunks
+                ## of other users in a directory that is not
+                ## group-writable are skipped
+                try:
+                    os.remove(bgen_chunkfile)
+                except PermissionError:
+                    print('cannot evict bgen chunk ' + bgen_chunkfile + ' of another user')
+                    continue
+
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(bgen_chunkfile + '.bgi')
+
+            print('evicted bgen chunk ' + bgen_chunkfile + ' from cache')
+
+            total -= size
+            removed += size
+
+    return(removed)
+
+
+
+def bgen_range_bytes(bgen_file: str, interval: tuple) -> int:
+
+    """
+
+    Args:
+    bgen_file (str): The path of the bgen file of a chromosome
+    interval (tuple): First and last position of the range
+
+    Returns:
+    The number of bytes of the variants in the range according to the
+    bgen index (.bgi), None if there is no index
+
+    """
+
+    bgi_file = bgen_file + '.bgi'
+
+    if not os.path.exists(bgi_file):
+        return(None)
+
+    connection = sqlite3.connect('file:' + bgi_file + '?mode=ro', uri=True)
+
+    try:
+        cursor = connection.execute('SELECT SUM(size_in_bytes) FROM Variant WHERE ' +
+                                    'position BETWEEN ? AND ?',
+                                    (int(interval[0]), int(interval[1])))
+        range_bytes = cursor.fetchone()[0]
+    finally:
+        connection.close()
+
+    return(range_bytes)
+
+
+
+def bgen_range_variants(bgen_file: str, interval: tuple) -> int:
+
+    """
+
+    Args:
+    bgen_file (str): The path of the bgen file of a chromosome
+    interval (tuple): First and last position of the range
+
+    Returns:
+    The number of variants in the range according to the bgen index
+    (.bgi), None if there is no index
+
+    """
+
+    bgi_file = bgen_file + '.bgi'
+
+    if not os.path.exists(bgi_file):
+        return(None)
+
+    connection = sqlite3.connect('file:' + bgi_file + '?mode=ro', uri=True)
+
+    try:
+        cursor = connection.execute('SELECT COUNT(*) FROM Variant WHERE ' +
+                                    'position BETWEEN ? AND ?',
+                                    (int(interval[0]), int(interval[1])))
+        range_variants = cursor.fetchone()[0]
+    finally:
+        connection.close()
+
+    return(range_variants)
+
+
+
+@contextlib.contextmanager
+def bgen_pipe(bgen_file: str, bgen_range: str, kill_after: float = 1):
+
+    """
+
+    Streams a range of a bgen file through a named pipe, so that a
+    program reading the bgen file once from start to end can read the
+    range without it being written to disk. The pipe is created in the
+    node's local temporary directory. bgenix starts writing as soon as
+    the pipe is opened for reading, inside the with-statement:
+
+    with bgen_pipe(bgen_file, bgen_range) as stream:
+        returncode = run_reader(stream['pipe'])
+        stream['reader-failed'] = returncode != 0
+
+    After the reader, bgenix is waited for, and its exit status is
+    checked, also if it has closed the pipe but not exited yet. Only
+    if the reader has failed (or the with-statement raises), bgenix
+    is killed if it has not exited after kill_after seconds, e.g. as
+    it waits for a reader that stopped early, and stream['killed'] is
+    set.
+
+    Args:
+    bgen_file (str): The path of the bgen file
+    bgen_range (str): The range in bgenix format, e.g. '03:727-648'
+    kill_after (float): Seconds bgenix is given to exit after the
+    reader has failed
+
+    Yields:
+    A dictionary with the path of the named pipe, 'pipe', the flags
+    'reader-failed' (set by the with-statement) and 'killed', and the
+    exit status of bgenix, 'returncode', set after the with-statement
+
+    Raises:
+    subprocess.CalledProcessError: If bgenix fails and the reader has
+    not, e.g. bgenix stopped early and the reader read a cut short
+    range
+
+    """
+
+    pipe_dir = tempfile.mkdtemp(prefix='bgen-pipe-')
+    pipe = os.path.join(pipe_dir, 'chunk.bgen')
+
+    os.mkfifo(pipe)
+
+    bgen_c = 'bgenix -g ' + shlex.quote(bgen_file) + ' -incl-range ' + bgen_range
+
+    print('\nstreaming bgen range ' + bgen_range + ' through pipe ' + pipe + ' with command')
+    print('\n' + bgen_c + ' > ' + pipe)
+
+    ## the shell opening the pipe for writing blocks until a reader
+    ## opens it
+    bgenix = subprocess.Popen(['sh', '-c', 'exec ' + bgen_c + ' > "$0"', pipe])
+
+    stream = {'pipe': pipe, 'reader-failed': False, 'killed': False}
+
+    completed = False
+
+    try:
+        yield stream
+        completed = True
+    finally:
+        if not completed or stream['reader-failed']:
+            ## bgenix exits on its own if the reader failed after
+            ## reading all of the range, or has closed the pipe
+            with contextlib.suppress(subprocess.TimeoutExpired):
+                bgenix.wait(timeout = kill_after)
+            if bgenix.poll() is None:
+                bgenix.kill()
+                stream['killed'] = True
+        ## a reader that has not opened the pipe leaves the shell
+        ## blocked in opening it, bgenix then fails writing to a pipe
+        ## without reader; opened again until the shell has got past
+        ## it, as it may not have reached the open the first time
+        while True:
+            if bgenix.poll() is None:
+                with contextlib.suppress(OSError):
+                    os.close(os.open(pipe, os.O_RDONLY | os.O_NONBLOCK))
+            try:
+                bgenix.wait(timeout = 1)
+                break
+            except subprocess.TimeoutExpired:
+                continue
+        stream['returncode'] = bgenix.returncode
+        shutil.rmtree(pipe_dir)
+
+    if not stream['reader-failed'] and bgenix.returncode != 0:
+        raise subprocess.CalledProcessError(bgenix.returncode, bgen_c)
+
+
+
+def run_bgen_streamed(bgen_file: str, bgen_range: str, run_reader, run_extracted) -> tuple:
+
+    """
+
+    Runs a program reading a range of a bgen file on the range
+    streamed through a named pipe (see bgen_pipe), and again on the
+    extracted range if the stream failed: bgenix failed (e.g. stopped
+    early, so that the program may have finished on a cut short range,
+    or could not write to a program that stopped reading, e.g. as it
+    does not read the bgen file in one pass) or was killed. A program
+    failing on a complete stream fails on the extracted range as well,
+    and is not run again.
+
+    Args:
+    bgen_file (str): The path of the bgen file
+    bgen_range (str): The range in bgenix format, e.g. '03:727-648'
+    run_reader (function): Runs the program on the path of the pipe,
+    returns its exit status
+    run_extracted (function): Extracts the range and runs the program
+    on it, returns its exit status
+
+    Returns:
+    The exit status of the program, of its last run, and whether the
+    range was streamed, i.e. not extracted
+
+    """
+
+    stream = None
+    bgenix_failed = False
+    returncode = None
+
+    try:
+        with bgen_pipe(bgen_file, bgen_range) as stream:
+            returncode = run_reader(stream['pipe'])
+            stream['reader-failed'] = returncode != 0
+    except subprocess.CalledProcessError as e:
+        print('\nbgenix failed: ' + str(e))
+        bgenix_failed = True
+
+    if stream is not None and stream['killed']:
+        print('\nbgenix killed after the reader of the stream failed')
+        bgenix_failed = True
+    elif stream is not None and stream.get('returncode', 0) != 0:
+        print('\nbgenix failed after the reader of the stream failed')
+        bgenix_failed = True
+
+    if bgenix_failed:
+        print('\nbgen range ' + bgen_range + ' could not be streamed, extracting it')
+        return(run_extracted(), False)
+
+    return(returncode, True)
+
+
+
+def chunk_rows_valid(n_rows: int, n_variants: int, filtered: bool) -> bool:
+
+    """
+
+    Checks the number of variants written for a chunk against the
+    number of variants of its range in the bgen index. More rows than
+    variants means the output is not of the chunk; with filters (e.g.
+    on MAF and INFO) any number of variants may be removed, even all of
+    them, without filters the numbers have to be equal, e.g. no rows of
+    a range that has variants means the chunk was cut short.
+
+    Args:
+    n_rows (int): The number of variants written for the chunk
+    n_variants (int): The number of variants in the bgen index
+    filtered (bool): If variants are filtered
+
+    Returns:
+    True if the numbers agree
+
+    """
+
+    if filtered:
+        return(n_rows <= n_variants)
+
+    return(n_rows == n_variants)
+
+
+
+def file_checksum(path: str) -> str:
+
+    """
+
+    Args:
+    path (str): The path of a file
+
+    Returns:
+    The md5 checksum of the file, as md5sum would print it
+
+    """
+
+    md5 = hashlib.md5()
+
+    with open(path, 'rb') as fh:
+        for block in iter(lambda: fh.read(1024 * 1024), b''):
+            md5.update(block)
+
+    return(md5.hexdigest())
+
+
+
+def load_manifest(manifest_file: str) -> dict:
+
+    """
+
+    Loads the manifest of a pipeline run, which records the state of
+    its stages and the output files of its stages and chunks.
+
+    Args:
+    manifest_file (str): The path of the manifest file
+
+    Returns:
+    The manifest, a dictionary with 'stages' and 'chunks', each
+    mapping a name to a record, see record_output. Empty if there is
+    no manifest file yet
+
+    """
+
+    if not os.path.exists(manifest_file):
+        return({'stages': {}, 'chunks': {}})
+
+    with open(manifest_file, 'r') as fh:
+        return(json.load(fh))
+
+
+
+def save_manifest(manifest: dict, manifest_file: str) -> None:
+
+    """
+
+    Writes the manifest of a pipeline run, replacing the previous
+    manifest file only once the new one is complete.
+
+    Args:
+    manifest (dict): The manifest, see load_manifest
+    manifest_file (str): The path of the manifest file
+
+    """
+
+    manifest_tempfile = manifest_file + '.' + uuid.uuid4().hex
+
+    with open(manifest_tempfile, 'w') as fh:
+        json.dump(manifest, fh, indent=1)
+
+    os.replace(manifest_tempfile, manifest_file)
+
+
+
+def record_output(paths: list) -> dict:
+
+    """
+
+    Records the output files of a completed stage or chunk.
+
+    Args:
+    paths (list): The paths of the output files
+
+    Returns:
+    A record with 'state' ('done'), 'time' and 'files', the size,
+    modification time and checksum of each file
+
+    """
+
+    files = {}
+
+    for path in paths:
+        path_stat = os.stat(path)
+        files[path] = {'size': path_stat.st_size,
+                       'mtime': path_stat.st_mtime,
+                       'checksum': file_checksum(path)}
+
+    return({'state': 'done', 'time': str(datetime.now()), 'files': files})
+
+
+
+def output_valid(record: dict) -> bool:
+
+    """
+
+    Checks if the output files of a completed stage or chunk are
+    still there and unchanged. The checksum is only computed again if
+    the size or modification time of a file differ from the record.
+
+    Args:
+    record (dict): The record of the stage or chunk, see
+    record_output, or None
+
+    Returns:
+    True if the stage or chunk is done and all its output files are
+    unchanged
+
+    """
+
+    if record is None or record.get('state') != 'done':
+        return(False)
+
+    for path, file_record in record['files'].items():
+
+        if not os.path.exists(path):
+            return(False)
+
+        path_stat = os.stat(path)
+
+        if path_stat.st_size != file_record['size']:
+            return(False)
+
+        if (path_stat.st_mtime != file_record['mtime'] and
+            file_checksum(path) != file_record['checksum']):
+            return(False)
+
+    return(True)
+
+
+
+def plink_version() -> str:
+
+    """
+
+    Returns:
+    The version of plink in the search path, as plink --version
+    prints it, or None if plink cannot be run
+
+    """
+
+    try:
+        plink_out = subprocess.run(['plink', '--version'], capture_output = True, text = True)
+    except OSError:
+        return(None)
+
+    if plink_out.returncode != 0:
+        return(None)
+
+    return(plink_out.stdout.strip())
+
+
+
+def sample_checksum(sample_file: str) -> str:
+
+    """
+
+    Args:
+    sample_file (str): The path of a file with samples in its first
+    two columns (FID, IID), e.g. the phenotype file
+
+    Returns:
+    The md5 checksum of the samples, i.e. of the first two columns
+    only, so that e.g. additional phenotypes do not change it
+
+    """
+
+    md5 = hashlib.md5()
+
+    with open(sample_file, 'r') as fh:
+        for line in fh:
+            md5.update(('\t'.join(line.split()[:2]) + '\n').encode('UTF-8'))
+
+    return(md5.hexdigest())
+
+
+
+def coreset_inputs(fam_file: str, pheno_file: str, thresholds: dict,
+                   chr_list: list, gen_files: list) -> dict:
+
+    """
+
+    Describes all the inputs the core SNP set depends on.
+
+    Args:
+    fam_file (str): The path of the fam file
+    pheno_file (str): The path of the phenotype file with the samples
+    plink keeps
+    thresholds (dict): The filtering thresholds 'thr-maf', 'thr-geno'
+    and 'thr-hwe'
+    chr_list (list): The chromosomes
+    gen_files (list): The paths of the genotype bed and bim files
+
+    Returns:
+    A dictionary with the checksums of the fam file and the samples,
+    the thresholds, the plink version, the chromosomes and the
+    identity (real path, size and modification time) of the genotype
+    files
+
+    """
+
+    gen_identity = []
+
+    for gen_file in gen_files:
+        gen_stat = os.stat(gen_file)
+        gen_identity.append([os.path.realpath(gen_file), gen_stat.st_size, gen_stat.st_mtime])
+
+    return({'fam': file_checksum(fam_file),
+            'samples': sample_checksum(pheno_file),
+            'thresholds': {key: str(value) for key, value in thresholds.items()},
+            'plink': plink_version(),
+            'chr-list': [str(chr) for chr in chr_list],
+            'gen-files': gen_identity})
+
+
+
+def coreset_cache_key(inputs: dict) -> str:
+
+    """
+
+    Args:
+    inputs (dict): The inputs of the core SNP set, see coreset_inputs
+
+    Returns:
+    The key of the core SNP set in the core set cache, a hash of its
+    inputs
+
+    """
+
+    return(hashlib.sha1(json.dumps(inputs, sort_keys = True).encode('UTF-8')).hexdigest())
+
+
+
+def link_or_copy(source: str, destination: str) -> None:
+
+    """
+
+    Hard links a file, or copies it if the destination is on another
+    file system. An existing destination file is replaced.
+
+    Args:
+    source (str): The path of the file
+    destination (str): The path of the link or copy
+
+    """
+
+    ## already linked
+    if os.path.exists(destination) and os.path.samefile(source, destination):
+        return
+
+    destination_tempfile = destination + '.' + uuid.uuid4().hex
+
+    try:
+        os.link(source, destination_tempfile)
+    except OSError:
+        shutil.copy2(source, destination_tempfile)
+
+    os.replace(destination_tempfile, destination)
+
+
+
+def coreset_entry_complete(entry_dir: str) -> bool:
+
+    """
+
+    Args:
+    entry_dir (str): The directory of a core set cache entry
+
+    Returns:
+    True if the entry has all its files, i.e. it has not been damaged
+    (e.g. files removed by hand)
+
+    """
+
+    return(all(os.path.exists(os.path.join(entry_dir, name))
+               for name in ('coreset.bed', 'coreset.bim', 'coreset.fam', 'inputs.json')))
+
+
+
+def remove_coreset_entry(entry_dir: str) -> bool:
+
+    """
+
+    Removes a damaged or partial entry of the core set cache. It is
+    renamed first, so that other runs never see it half removed.
+
+    Args:
+    entry_dir (str): The directory of the entry
+
+    Returns:
+    True if the entry was removed, False if this user may not remove
+    it or another run did
+
+    """
+
+    removed_dir = entry_dir + '.removed.' + uuid.uuid4().hex
+
+    try:
+        os.rename(entry_dir, removed_dir)
+    except OSError:
+        return(False)
+
+    shutil.rmtree(removed_dir, ignore_errors = True)
+
+    return(True)
+
+
+
+def fetch_coreset(cache_dir: str, key: str, coreset_path: str) -> bool:
+
+    """
+
+    Provides the core SNP set from the core set cache, if it is
+    cached. A damaged entry is removed, so that the core SNP set is
+    computed and stored again.
+
+    Args:
+    cache_dir (str): Directory of the core set cache
+    key (str): The key of the core SNP set, see coreset_cache_key
+    coreset_path (str): The path (without extension) of the core SNP
+    set bed, bim and fam files
+
+    Returns:
+    True if the core SNP set was in the cache
+
+    """
+
+    entry_dir = os.path.join(cache_dir, key)
+
+    ## an entry only exists once it is complete, see store_coreset
+    if not os.path.isdir(entry_dir):
+        return(False)
+
+    if not coreset_entry_complete(entry_dir):
+        print('\ncore set cache entry ' + entry_dir + ' is damaged, removing it')
+        remove_coreset_entry(entry_dir)
+        return(False)
+
+    try:
+        for ext in ('.bed', '.bim', '.fam'):
+            link_or_copy(os.path.join(entry_dir, ('coreset' + ext)), coreset_path + ext)
+    except (FileNotFoundError, PermissionError) as error:
+        ## removed by another run in the meantime, or not readable
+        print('\ncannot use core set cache entry ' + entry_dir + ': ' + str(error))
+        return(False)
+
+    ## modification time as time of last use; entries are
+    ## group-writable, only users outside the group of the cache
+    ## cannot set it
+    with contextlib.suppress(PermissionError):
+        os.utime(entry_dir)
+
+    return(True)
+
+
+
+def store_coreset(cache_dir: str, key: str, coreset_path: str, inputs: dict,
+                  partial_age: int = 86400) -> str:
+
+    """
+
+    Stores a core SNP set in the core set cache. The entry appears
+    only once it is complete, and an entry stored by a concurrent run
+    in the meantime is kept. The cache directory and its entries are
+    group-writable (see shared_directory), so that the users of its
+    group can replace damaged entries and remove the partial entries
+    of runs killed while storing them. A cache this user may not write
+    to is left as it is.
+
+    Args:
+    cache_dir (str): Directory of the core set cache
+    key (str): The key of the core SNP set, see coreset_cache_key
+    coreset_path (str): The path (without extension) of the core SNP
+    set bed, bim and fam files
+    inputs (dict): The inputs of the core SNP set, see coreset_inputs,
+    written to inputs.json in the entry
+    partial_age (int): Age in seconds of the partial entries of the
+    key that are removed
+
+    Returns:
+    The directory of the cache entry, None if it could not be stored
+
+    """
+
+    entry_dir = os.path.join(cache_dir, key)
+    entry_tempdir = None
+
+    try:
+
+        shared_directory(cache_dir)
+
+        if os.path.isdir(entry_dir):
+            if coreset_entry_complete(entry_dir):
+                return(entry_dir)
+            remove_coreset_entry(entry_dir)
+
+        for partial_dir in glob.glob(os.path.join(cache_dir, key + '.*')):
+            with contextlib.suppress(OSError):
+                if os.stat(partial_dir).st_mtime < time.time() - partial_age:
+                    print('\nremoving partial core set cache entry ' + partial_dir)
+                    shutil.rmtree(partial_dir)
+
+        ## group-writable from the start, so that the other users can
+        ## remove it if this run is killed while storing it
+        entry_tempdir = tempfile.mkdtemp(prefix = key + '.', dir = cache_dir)
+        os.chmod(entry_tempdir, 0o2775)
+
+        ## files are hard linked where possible, read-only so that they
+        ## are not overwritten through a link
+        for ext in ('.bed', '.bim', '.fam'):
+            entry_file = os.path.join(entry_tempdir, ('coreset' + ext))
+            link_or_copy(coreset_path + ext, entry_file)
+            os.chmod(entry_file, 0o444)
+
+        with open(os.path.join(entry_tempdir, 'inputs.json'), 'w') as fh:
+            json.dump(inputs, fh, indent=1)
+
+    except PermissionError as error:
+        print('\ncannot store the core SNP set in cache ' + cache_dir + ': ' + str(error))
+        if entry_tempdir is not None:
+            shutil.rmtree(entry_tempdir, ignore_errors = True)
+        return(None)
+
+    try:
+        os.rename(entry_tempdir, entry_dir)
+    except OSError:
+        ## stored by a concurrent run
+        shutil.rmtree(entry_tempdir)
+
+    return(entry_dir)
+
+
+
+## trace file of this process, see set_trace_file
+_trace_file = None
+
+## the track of the spans of a thread without a track of their own,
+## see run_stages
+_trace_track = threading.local()
+
+
+
+def set_trace_file(trace_file: str) -> None:
+
+    """
+
+    Sets the file the spans of this process are written to (see
+    trace_span), None to not trace. Each process (main.py, each task)
+    writes its own file, see combine_traces.
+
+    Args:
+    trace_file (str): The path of the trace file, a json lines file
+    with one event per line
+
+    """
+
+    global _trace_file
+
+    if trace_file is not None:
+        Path(os.path.dirname(os.path.abspath(trace_file))).mkdir(parents=True, exist_ok=True)
+
+    _trace_file = trace_file
+
+
+
+def trace_event(name: str, category: str, start: float, end: float,
+                track: str = None, **args) -> None:
+
+    """
+
+    Writes a span with given start and end to the trace file, if set.
+
+    Args:
+    name (str): The name of the span
+    category (str): The category, e.g. 'stage', 'queue' or 'bgen'
+    start (float): The start time in seconds since the epoch
+    end (float): The end time in seconds since the epoch
+    track (str): The track (a row in the trace viewer) of the span, if
+    None the track of the stage running in this thread (see
+    run_stages) or the process's main track
+    args: Further attributes of the span, e.g. bytes read
+
+    """
+
+    if _trace_file is None:
+        return
+
+    if track is None:
+        track = getattr(_trace_track, 'name', None)
+
+    event = {'name': name, 'cat': category, 'ph': 'X',
+             'ts': int(start * 1e6), 'dur': int((end - start) * 1e6),
+             'track': track, 'args': args}
+
+    with open(_trace_file, 'a') as fh:
+        fh.write(json.dumps(event) + '\n')
+
+
+
+@contextlib.contextmanager
+def trace_span(name: str, category: str = 'stage', **args):
+
+    """
+
+    Traces the time spent inside the with-statement as a span, see
+    trace_event:
+
+    with trace_span('merge', 'stage', model='model_1') as span:
+        ...
+        span['bytes-read'] = n_bytes
+
+    Args:
+    name (str): The name of the span
+    category (str): The category of the span
+    args: Further attributes of the span
+
+    Yields:
+    The dictionary of attributes, to add attributes known at the end
+
+    """
+
+    start = time.time()
+
+    try:
+        yield args
+    finally:
+        trace_event(name, category, start, time.time(), **args)
+
+
+
+def combine_traces(trace_dir: str, trace_file: str) -> int:
+
+    """
+
+    Combines the trace files of all processes of a run into one trace
+    in the Chrome trace event format, which trace viewers (e.g.
+    chrome://tracing or Perfetto) read. Each process (trace file) is
+    shown as a process named after its file, each track as a thread.
+
+    Args:
+    trace_dir (str): Directory of the trace files (*.jsonl)
+    trace_file (str): The path of the combined trace (json)
+
+    Returns:
+    The number of spans
+
+    """
+
+    events = []
+    n_spans = 0
+
+    for pid, process_file in enumerate(sorted(glob.glob(os.path.join(trace_dir, '*.jsonl'))), 1):
+
+        process_name = os.path.basename(process_file)[:-len('.jsonl')]
+
+        events.append({'name': 'process_name', 'ph': 'M', 'pid': pid,
+                       'args': {'name': process_name}})
+
+        tracks = {None: 1}
+
+        with open(process_file, 'r') as fh:
+            for line in fh:
+
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    continue
+
+                track = event.pop('track', None)
+
+                if track not in tracks:
+                    tracks[track] = len(tracks) + 1
+                    events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid,
+                                   'tid': tracks[track], 'args': {'name': track}})
+
+                event['pid'] = pid
+                event['tid'] = tracks[track]
+
+                events.append(event)
+                n_spans += 1
+
+    trace_tempfile = trace_file + '.' + uuid.uuid4().hex
+
+    with open(trace_tempfile, 'w') as fh:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, fh)
+
+    os.replace(trace_tempfile, trace_file)
+
+    return(n_spans)
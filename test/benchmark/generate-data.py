@@ -0,0 +1,217 @@
+import os.path
+import argparse
+import sys
+import json
+import random
+import sqlite3
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+
+## path to library files
+bindir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(bindir, "../../lib/"))
+
+import bolt
+
+
+## Generates synthetic input files of UK biobank scale (by default 90
+## million imputed variants, 500,000 samples, 800,000 genotyped
+## variants) for the benchmarks in run-benchmarks.py and for pipeline
+## runs with the stand-in binaries in stubs/. The bgen files are text
+## files with one 'chromosome position' line per variant, which only
+## the stand-in bgenix and bolt understand.
+
+
+## == parsing arguments
+
+parser = argparse.ArgumentParser(description = "generating synthetic data for the bolt-lmm pipeline benchmarks")
+
+requiredNamed = parser.add_argument_group('required named arguments')
+
+requiredNamed.add_argument('-o', '--outdir', dest = 'outdir', required = True,
+                           help = 'directory for the generated files')
+
+parser.add_argument('--scale', dest = 'scale', type = float, default = 1.0,
+                    help = 'factor on the numbers of variants and samples, e.g. 0.01 for a quick run')
+
+parser.add_argument('--variants', dest = 'variants', type = int, default = 90000000,
+                    help = 'number of imputed variants over all chromosomes')
+
+parser.add_argument('--samples', dest = 'samples', type = int, default = 500000,
+                    help = 'number of samples')
+
+parser.add_argument('--coreset-variants', dest = 'coreset_variants', type = int, default = 800000,
+                    help = 'number of genotyped variants over all chromosomes')
+
+parser.add_argument('--chromosomes', dest = 'chromosomes', type = int, default = 22,
+                    choices = range(1, 23), metavar = '{1..22}',
+                    help = 'number of chromosomes')
+
+parser.add_argument('--chunksize', dest = 'chunksize', type = int, default = 500000,
+                    help = 'number of variants in a fake bolt-lmm output chunk')
+
+parser.add_argument('--bgen', dest = 'bgen', action = 'store_true',
+                    help = 'also write (text) bgen files with indices, for pipeline runs')
+
+parser.add_argument('--seed', dest = 'seed', type = int, default = 1,
+                    help = 'seed of the random number generator')
+
+args = parser.parse_args()
+
+
+## lengths of the chromosomes (GRCh37, in Mb), variants are
+## distributed proportionally
+chr_lengths = [249, 243, 198, 191, 181, 171, 159, 146, 141, 136, 135,
+               134, 115, 107, 103, 90, 81, 78, 59, 63, 48, 51]
+
+chr_list = list(range(1, args.chromosomes + 1))
+
+n_variants = int(args.variants * args.scale)
+n_samples = max(10, int(args.samples * args.scale))
+n_coreset = int(args.coreset_variants * args.scale)
+
+rng = np.random.default_rng(args.seed)
+random.seed(args.seed)
+
+outdir = args.outdir
+chunk_dir = os.path.join(outdir, 'bolt-chunks')
+
+Path(chunk_dir).mkdir(parents=True, exist_ok=True)
+
+print('generating ' + str(n_variants) + ' imputed variants, ' + str(n_coreset) +
+      ' genotyped variants and ' + str(n_samples) + ' samples on ' +
+      str(len(chr_list)) + ' chromosome(s) in ' + outdir)
+
+
+def chr_share(n, chr):
+
+    """ Number of n variants on a chromosome """
+
+    lengths = chr_lengths[:len(chr_list)]
+
+    return(int(round(n * lengths[chr - 1] / sum(lengths))))
+
+
+def positions(n, chr):
+
+    """ Sorted random positions on a chromosome, some of them repeated
+    as for multi-allelic variants """
+
+    return(np.sort(rng.integers(1, chr_lengths[chr - 1] * 1000000, n)))
+
+
+def write_lines(path, lines, block = 1000000):
+
+    """ Writes lines in blocks """
+
+    with open(path, 'w') as fh:
+        for start in range(0, len(lines), block):
+            fh.write(''.join(lines[start:start + block]))
+
+
+## == samples: fam, sample and phenotype files ==
+
+sample_ids = [str(1000000 + i) for i in range(n_samples)]
+
+with open(os.path.join(outdir, 'ukb.fam'), 'w') as fh:
+    for sample_id in sample_ids:
+        fh.write(sample_id + ' ' + sample_id + ' 0 0 ' + str(random.randint(1, 2)) + ' -9\n')
+
+with open(os.path.join(outdir, 'ukb.sample'), 'w') as fh:
+    fh.write('ID_1 ID_2 missing sex\n0 0 0 D\n')
+    for sample_id in sample_ids:
+        fh.write(sample_id + ' ' + sample_id + ' 0 ' + str(random.randint(1, 2)) + '\n')
+
+with open(os.path.join(outdir, 'pheno.txt'), 'w') as fh:
+    fh.write('FID\tIID\ty1\ty2\tSex\tAge\tPC1\n')
+    for sample_id in sample_ids:
+        fh.write('\t'.join([sample_id, sample_id,
+                            '%.4f' % random.gauss(0, 1), '%.4f' % random.gauss(0, 1),
+                            str(random.randint(1, 2)), str(random.randint(40, 70)),
+                            '%.4f' % random.gauss(0, 1)]) + '\n')
+
+with open(os.path.join(outdir, 'ld.tab'), 'w') as fh:
+    fh.write('SNP\tCHR\tBP\tLDSCORE\n')
+
+
+## == genotyped variants: bim and bed files ==
+
+for chr in chr_list:
+
+    gen_positions = positions(chr_share(n_coreset, chr), chr)
+
+    write_lines(os.path.join(outdir, ('ukb_gen_chr' + str(chr) + '.bim')),
+                ['%d\trs%d_%d\t0\t%d\tA\tG\n' % (chr, chr, p, p) for p in gen_positions])
+
+    ## a sparse bed file of the right size, see bolt.check_bed
+    with open(os.path.join(outdir, ('ukb_gen_chr' + str(chr) + '.bed')), 'wb') as fh:
+        fh.write(b'\x6c\x1b\x01')
+        fh.truncate(3 + len(gen_positions) * ((n_samples + 3) // 4))
+
+
+## == imputed variants: bim, mfi and (text) bgen files, fake bolt-lmm
+## output chunks ==
+
+header = ('SNP\tCHR\tBP\tGENPOS\tALLELE1\tALLELE0\tA1FREQ\tINFO\tCHISQ_LINREG\tP_LINREG\t' +
+          'BETA\tSE\tCHISQ_BOLT_LMM_INF\tP_BOLT_LMM_INF\n')
+
+n_chunks = 0
+
+for chr in chr_list:
+
+    imp_positions = positions(chr_share(n_variants, chr), chr)
+
+    maf = rng.uniform(0, 0.5, len(imp_positions))
+    info = rng.uniform(0, 1, len(imp_positions))
+
+    imp_base = os.path.join(outdir, ('ukb_imp_chr' + str(chr)))
+
+    write_lines(imp_base + '.bim',
+                ['%d\trs%d_%d\t0\t%d\tA\tG\n' % (chr, chr, p, p) for p in imp_positions])
+
+    write_lines(os.path.join(outdir, ('ukb_mfi_chr' + str(chr) + '_v3.txt')),
+                ['%d:%d_A_G\trs%d_%d\t%d\tA\tG\t%.4f\tG\t%.4f\n' % (chr, p, chr, p, p, m, i)
+                 for p, m, i in zip(imp_positions, maf, info)])
+
+    if args.bgen:
+
+        write_lines(imp_base + '.bgen', ['%d %d\n' % (chr, p) for p in imp_positions])
+
+        ## the bgen index, as read by bolt.read_snp_positions
+        if os.path.exists(imp_base + '.bgen.bgi'):
+            os.remove(imp_base + '.bgen.bgi')
+
+        connection = sqlite3.connect(imp_base + '.bgen.bgi')
+        connection.execute('CREATE TABLE Variant (chromosome TEXT, position INT, ' +
+                           'size_in_bytes INT)')
+        connection.executemany('INSERT INTO Variant VALUES (?, ?, ?)',
+                               ((str(chr).zfill(2), int(p), 1000) for p in imp_positions))
+        connection.commit()
+        connection.close()
+
+    ## bolt-lmm output chunks, as run-bolt.py writes them, overlapping
+    ## at the chunk boundaries as real chunks do
+    for chunk in bolt.snp_chunks(imp_positions, str(chr), args.chunksize):
+
+        selected = imp_positions[(imp_positions >= chunk[1][0]) & (imp_positions <= chunk[1][1])]
+
+        pvalues = rng.uniform(0, 1, len(selected))
+
+        n_chunks += 1
+
+        write_lines(os.path.join(chunk_dir, ('chunk_%05d.bolt' % n_chunks)),
+                    [header] +
+                    ['rs%d_%d\t%d\t%d\t0\tA\tG\t0.2500\t0.9000\t1.0000\t%.4g\t0.0100\t0.0100\t1.0000\t%.4g\n' %
+                     (chr, p, chr, p, pv, pv) for p, pv in zip(selected, pvalues)])
+
+
+## == summary of the generated data ==
+
+with open(os.path.join(outdir, 'benchmark.json'), 'w') as fh:
+    json.dump({'variants': n_variants, 'samples': n_samples, 'coreset-variants': n_coreset,
+               'chr-list': chr_list, 'chunksize': args.chunksize, 'chunks': n_chunks,
+               'bgen': args.bgen, 'time': str(datetime.now())}, fh, indent = 1)
+
+print('written ' + str(n_chunks) + ' bolt-lmm output chunk(s)')
@@ -0,0 +1,273 @@
+import os
+import os.path
+import argparse
+import sys
+import json
+import glob
+import shutil
+import socket
+import subprocess
+import tempfile
+import time
+from datetime import datetime
+
+## path to library files
+benchdir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(benchdir, "../../lib/"))
+
+import bolt
+
+
+## Benchmarks of the pipeline driver on synthetic data (see
+## generate-data.py), with the stand-in binaries in stubs/ in place of
+## qsub, qstat, plink, bolt and bgenix, so that performance
+## regressions of the python code show without a cluster.
+
+
+## == parsing arguments
+
+benchmarks = ['bim-parsing', 'chunk-planning', 'cost-planning', 'bim-staging',
+              'merge', 'monitor-latency', 'pipeline']
+
+parser = argparse.ArgumentParser(description = "benchmarking the bolt-lmm pipeline driver")
+
+requiredNamed = parser.add_argument_group('required named arguments')
+
+requiredNamed.add_argument('-d', '--data-dir', dest = 'data_dir', required = True,
+                           help = 'directory of the data generated by generate-data.py')
+
+parser.add_argument('-b', '--benchmarks', dest = 'benchmarks', nargs = '+',
+                    choices = benchmarks, default = benchmarks[:-1],
+                    help = 'benchmarks to run, all but pipeline by default')
+
+parser.add_argument('-r', '--repeat', dest = 'repeat', type = int, default = 3,
+                    help = 'number of repetitions, the best is reported')
+
+parser.add_argument('--chunksize', dest = 'chunksize', type = int, default = 200000,
+                    help = 'number of variants per chunk for chunk planning')
+
+parser.add_argument('--queue-time', dest = 'queue_time', type = float, default = 2,
+                    help = 'seconds a stand-in pbs subjob is queued (monitor-latency)')
+
+parser.add_argument('--run-time', dest = 'run_time', type = float, default = 3,
+                    help = 'seconds a stand-in pbs subjob runs (monitor-latency)')
+
+parser.add_argument('--tasks', dest = 'tasks', type = int, default = 1000,
+                    help = 'number of array subjobs (monitor-latency)')
+
+parser.add_argument('-o', '--output', dest = 'output',
+                    help = 'json file to write the results to, e.g. to compare runs')
+
+args = parser.parse_args()
+
+data_dir = os.path.abspath(args.data_dir)
+
+with open(os.path.join(data_dir, 'benchmark.json'), 'r') as fh:
+    data = json.load(fh)
+
+chr_list = data['chr-list']
+
+stub_dir = os.path.join(benchdir, 'stubs')
+
+## the stand-in binaries come first in the search path of this
+## process and the commands it runs
+os.environ['PATH'] = stub_dir + os.pathsep + os.environ['PATH']
+
+print('Host: ' + socket.gethostname())
+print('Start time: ' + str(datetime.now()))
+print('data: ' + str(data['variants']) + ' imputed variants, ' + str(data['samples']) +
+      ' samples, ' + str(data['chunks']) + ' output chunks in ' + data_dir)
+
+results = {}
+
+
+def benchmark(name, run, units = None):
+
+    """ Runs a benchmark args.repeat times and reports the best time.
+    run returns the number of units processed, e.g. variants """
+
+    times = []
+
+    for repetition in range(args.repeat):
+        start = time.perf_counter()
+        n_units = run()
+        times.append(time.perf_counter() - start)
+
+    best = min(times)
+
+    results[name] = {'seconds': best, 'times': times}
+
+    line = '%-16s %10.3f s' % (name, best)
+
+    if units is not None:
+        results[name][units] = n_units
+        line = line + '  %12.0f %s/s' % (n_units / best, units)
+
+    print(line)
+
+
+## == benchmarks ==
+
+def imp_file(chr, ext):
+    return(os.path.join(data_dir, ('ukb_imp_chr' + str(chr) + ext)))
+
+
+workdir = tempfile.mkdtemp(prefix = 'bolt-benchmark.')
+
+
+if 'bim-parsing' in args.benchmarks:
+
+    ## without a bgen index, positions are read from the bim file
+    def run():
+        return(sum(len(bolt.read_snp_positions(imp_file(chr, '.nobgen'), imp_file(chr, '.bim')))
+                   for chr in chr_list))
+
+    benchmark('bim-parsing', run, 'variants')
+
+
+if 'chunk-planning' in args.benchmarks:
+
+    positions = {chr: bolt.read_snp_positions(imp_file(chr, '.nobgen'), imp_file(chr, '.bim'))
+                 for chr in chr_list}
+
+    def run():
+        return(sum(len(bolt.snp_chunks(positions[chr], str(chr), args.chunksize))
+                   for chr in chr_list))
+
+    benchmark('chunk-planning', run, 'chunks')
+
+
+if 'cost-planning' in args.benchmarks:
+
+    cost_model = {'target': 24 * 3600, 'fixed': 3600, 'per-variant': 0.01,
+                  'min-maf': 0.01, 'min-info': 0.1}
+
+    def run():
+        n_chunks = 0
+        for chr in chr_list:
+            mfi_file = os.path.join(data_dir, ('ukb_mfi_chr' + str(chr) + '_v3.txt'))
+            positions, weights = bolt.read_variant_weights(mfi_file, cost_model)
+            n_chunks += len(bolt.cost_chunks(positions, weights, str(chr),
+                                             cost_model['target'], cost_model['fixed']))
+        return(n_chunks)
+
+    benchmark('cost-planning', run, 'chunks')
+
+
+if 'bim-staging' in args.benchmarks:
+
+    def run():
+        n_variants = 0
+        for chr in chr_list:
+            staged_bim = os.path.join(workdir, ('ukb_gen_chr' + str(chr) + '.bim'))
+            if os.path.exists(staged_bim):
+                os.remove(staged_bim)
+            n_variants += bolt.stage_bim(os.path.join(data_dir, ('ukb_gen_chr' + str(chr) + '.bim')),
+                                         staged_bim)
+        return(n_variants)
+
+    benchmark('bim-staging', run, 'variants')
+
+
+if 'merge' in args.benchmarks:
+
+    chunk_files = sorted(glob.glob(os.path.join(data_dir, 'bolt-chunks', '*.bolt')))
+
+    def run():
+        merge_stats = bolt.merge_bolt_chunks(chunk_files, os.path.join(workdir, 'merged.bolt.txt'))
+        return(merge_stats['bytes-read'] / 1024 ** 2)
+
+    benchmark('merge', run, 'MB')
+
+
+if 'monitor-latency' in args.benchmarks:
+
+    ## the time from the last subjob finishing until monitor_qsub
+    ## returns, with the stand-in pbs server
+    os.environ['BENCH_STATE_DIR'] = os.path.join(workdir, 'pbs')
+    os.environ['BENCH_QUEUE_TIME'] = str(args.queue_time)
+    os.environ['BENCH_RUN_TIME'] = str(args.run_time)
+
+    log_dir = os.path.join(workdir, 'logs')
+
+    latencies = []
+
+    def run():
+        submitted = time.time()
+        job_id = bolt.submit_qsub('true', 'benchmark', log_dir,
+                                  {'ncpus': 1, 'mem': 1, 'walltime': 1}, n_tasks = args.tasks)
+        bolt.monitor_qsub(job_id, min_interval = 1, max_interval = 10)
+        latencies.append(time.time() - (submitted + args.queue_time + args.run_time))
+        return(args.tasks)
+
+    ## monitor_qsub reports the subjob states
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+
+    try:
+        benchmark('monitor', run)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+    results['monitor']['latencies'] = latencies
+
+    print('%-16s %10.3f s' % ('monitor-latency', min(latencies)))
+
+
+if 'pipeline' in args.benchmarks:
+
+    ## a whole pipeline run with the local executor, i.e. the overhead
+    ## of the driver and the task scripts
+    if not data['bgen']:
+        sys.exit('the pipeline benchmark needs bgen files, see generate-data.py --bgen')
+
+    outdir = os.path.join(workdir, 'out')
+
+    config = {'pheno-file': os.path.join(data_dir, 'pheno.txt'),
+              'outdir': outdir,
+              'tempdir': os.path.join(workdir, 'tmp'),
+              'temp-delete': True,
+              'cov-1': 'Sex;Age,PC1',
+              'pheno-1': 'y1',
+              'remove-samples-list': None,
+              'sample-file': os.path.join(data_dir, 'ukb.sample'),
+              'fam-file': os.path.join(data_dir, 'ukb.fam'),
+              'data-dir': data_dir,
+              'gen-base': 'ukb_gen_chr',
+              'imp-base': 'ukb_imp_chr',
+              'ldscore-file': os.path.join(data_dir, 'ld.tab'),
+              'thr-maf': 0.05, 'thr-geno': 0.015, 'thr-hwe': '1e-6',
+              'min-maf': 0.01, 'min-info': 0.1,
+              'chunksize': args.chunksize,
+              'ncpus': 1,
+              'executor': 'local',
+              'chunk-cache-dir': os.path.join(workdir, 'chunk-plans'),
+              'resource-history': None,
+              'chr-list': ','.join(str(chr) for chr in chr_list),
+              'module-init': os.path.join(workdir, 'no-modules'),
+              'module-list': ''}
+
+    config_file = os.path.join(workdir, 'config.yml')
+
+    ## json is valid yaml
+    with open(config_file, 'w') as fh:
+        json.dump(config, fh, indent = 1)
+
+    main_log = os.path.join(workdir, 'main.log')
+
+    def run():
+        with open(main_log, 'w') as log_fh:
+            subprocess.run(['python3', os.path.join(benchdir, '../../bin/main.py'),
+                            '--config-file', config_file],
+                           stdout = log_fh, stderr = subprocess.STDOUT, check = True)
+        return(data['variants'])
+
+    benchmark('pipeline', run, 'variants')
+
+
+shutil.rmtree(workdir)
+
+if args.output:
+    with open(args.output, 'w') as fh:
+        json.dump({'data': data, 'time': str(datetime.now()), 'results': results}, fh, indent = 1)
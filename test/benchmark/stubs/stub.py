@@ -0,0 +1,42 @@
+import os
+import random
+import sys
+import time
+
+
+## Common behaviour of the stand-in binaries, configured with
+## environment variables:
+##
+## BENCH_LATENCY      seconds each call takes before doing anything (0)
+## BENCH_FAIL_RATE    probability of a call failing (0)
+## BENCH_QUEUE_TIME   seconds a pbs (sub)job is queued (qsub, qstat; 5)
+## BENCH_RUN_TIME     seconds a pbs (sub)job runs (qsub, qstat; 10)
+## BENCH_STATE_DIR    directory of the stand-in pbs server's job files
+##                    (qsub, qstat; /tmp/bolt-benchmark-pbs-$USER)
+
+
+def setting(name, default):
+
+    """ Returns the value of a BENCH_ environment variable as a float """
+
+    return(float(os.environ.get('BENCH_' + name, default)))
+
+
+def state_dir():
+
+    """ Returns the directory of the stand-in pbs server's job files """
+
+    return(os.environ.get('BENCH_STATE_DIR',
+                          '/tmp/bolt-benchmark-pbs-' + os.environ.get('USER', 'user')))
+
+
+def start():
+
+    """ Waits BENCH_LATENCY seconds, then fails with probability
+    BENCH_FAIL_RATE """
+
+    time.sleep(setting('LATENCY', 0))
+
+    if random.random() < setting('FAIL_RATE', 0):
+        sys.stderr.write(os.path.basename(sys.argv[0]) + ': failing as configured by BENCH_FAIL_RATE\n')
+        sys.exit(1)
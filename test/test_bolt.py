@@ -0,0 +1,1696 @@
+import os
+import os.path
+import sys
+import time
+import json
+import fcntl
+import statistics
+import subprocess
+import threading
+from pathlib import Path
+
+import pytest
+
+## path to library files
+testdir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(testdir, "../lib/"))
+
+import bolt
+
+
+## == bolt-lmm output ==
+
+columns = ['SNP', 'CHR', 'BP', 'GENPOS', 'ALLELE1', 'ALLELE0', 'A1FREQ', 'INFO',
+           'CHISQ_LINREG', 'P_LINREG', 'BETA', 'SE',
+           'CHISQ_BOLT_LMM_INF', 'P_BOLT_LMM_INF']
+
+
+def variant(chr, bp, snp = None, p = '0.5', freq = '0.3', info = '1'):
+
+    """ A line of bolt-lmm output """
+
+    snp = snp or ('rs' + str(chr) + '_' + str(bp))
+
+    return('\t'.join([snp, str(chr), str(bp), '0', 'A', 'G', freq, info,
+                      '0.4', p, '0.01', '0.02', '0.4', p]) + '\n')
+
+
+def write_output(path, lines, header = columns):
+
+    with open(path, 'w') as fh:
+        fh.write('\t'.join(header) + '\n')
+        fh.writelines(lines)
+
+    return(str(path))
+
+
+def read_output(path):
+
+    with open(path, 'r') as fh:
+        return(fh.readlines())
+
+
+def write_script(path, text):
+
+    """ Writes an executable script """
+
+    path.write_text(text)
+    path.chmod(0o755)
+
+    return(str(path))
+
+
+## == local executor ==
+
+## a task recording when it runs, in the file of its array index
+task_script = '''import os, sys, time
+start = time.time()
+time.sleep(0.3)
+with open(os.path.join(sys.argv[1], os.environ['PBS_ARRAY_INDEX']), 'w') as fh:
+    fh.write(str(start) + ' ' + str(time.time()))
+sys.exit(int(sys.argv[2]))
+'''
+
+
+def max_overlap(spans):
+
+    """ The largest number of spans running at the same time """
+
+    events = sorted([(start, 1) for start, end in spans] + [(end, -1) for start, end in spans])
+
+    running = 0
+    overlap = 0
+
+    for _, change in events:
+        running += change
+        overlap = max(overlap, running)
+
+    return(overlap)
+
+
+def run_task_script(tmp_path, n_tasks, resources, cores, mem, exit_status = 0):
+
+    script = write_script(tmp_path / 'task.py', task_script)
+    out_dir = tmp_path / 'out'
+    out_dir.mkdir()
+    log_dir = tmp_path / 'logs'
+    log_dir.mkdir()
+
+    results = bolt.run_local('python3 ' + script + ' ' + str(out_dir) + ' ' + str(exit_status),
+                             'test-job', str(log_dir), resources, n_tasks, cores, mem)
+
+    spans = [tuple(map(float, (out_dir / str(i)).read_text().split()))
+             for i in range(1, n_tasks + 1)]
+
+    return(results, spans)
+
+
+def test_run_local_slots_by_cores(tmp_path):
+
+    results, spans = run_task_script(tmp_path, 4, {'ncpus': 1, 'mem': 1}, cores = 2, mem = 100)
+
+    assert sorted(results) == [1, 2, 3, 4]
+    assert max_overlap(spans) <= 2
+
+
+def test_run_local_slots_by_memory(tmp_path):
+
+    ## 4 cores, but memory for only one task at a time
+    results, spans = run_task_script(tmp_path, 3, {'ncpus': 1, 'mem': 8}, cores = 4, mem = 10)
+
+    assert max_overlap(spans) == 1
+
+
+def test_run_local_oversized_task_runs(tmp_path):
+
+    results, spans = run_task_script(tmp_path, 2, {'ncpus': 8, 'mem': 100}, cores = 2, mem = 10)
+
+    assert len(spans) == 2
+    assert max_overlap(spans) == 1
+
+
+def test_run_local_jobs_share_cores(tmp_path):
+
+    ## two jobs at the same time, e.g. of concurrent stages, each with
+    ## enough slots for all its tasks
+    results = {}
+
+    def run_job(name):
+        job_dir = tmp_path / name
+        job_dir.mkdir()
+        results[name] = run_task_script(job_dir, 2, {'ncpus': 1, 'mem': 1}, cores = 2, mem = 100)
+
+    threads = [threading.Thread(target = run_job, args = (name,)) for name in ('a', 'b')]
+
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert max_overlap(results['a'][1] + results['b'][1]) <= 2
+    assert bolt._local_used == {'cores': 0, 'mem': 0}
+
+
+def test_process_pool():
+
+    with bolt.process_pool(2) as pool:
+        pids = {future.result() for future in [pool.submit(os.getpid) for i in range(20)]}
+
+    assert len(pids) <= 2
+    assert os.getpid() not in pids
+
+
+def test_plan_chunks(tmp_path):
+
+    for chr in ('1', '2'):
+        (tmp_path / ('chr' + chr + '.bim')).write_text(''.join(
+            chr + '\trs' + str(bp) + '\t0\t' + str(bp) + '\tA\tG\n' for bp in range(100, 600, 100)))
+
+    chunks = bolt.plan_chunks(['1', '2'], str(tmp_path), 'chr', 2, str(tmp_path / 'cache'), processes = 2)
+
+    assert [chunk[0] for chunk in chunks] == ['1'] * 3 + ['2'] * 3
+
+    ## from the cache, with a pool of the caller
+    with bolt.process_pool(1) as pool:
+        assert bolt.plan_chunks(['1', '2'], str(tmp_path), 'chr', 2, str(tmp_path / 'cache'),
+                                pool = pool) == chunks
+
+
+def test_run_local_exit_status(tmp_path):
+
+    results, spans = run_task_script(tmp_path, 2, {'ncpus': 1, 'mem': 1}, cores = 2, mem = 10,
+                                     exit_status = 3)
+
+    assert [results[i]['exit_status'] for i in (1, 2)] == [3, 3]
+    assert bolt.failed_subjobs(results) == [1, 2]
+
+    ## logs named like the pbs ones
+    assert os.path.basename(results[1]['stdout']).startswith('test-job.o')
+    assert os.path.exists(results[2]['stderr'])
+
+
+## == qstat monitoring ==
+
+qstat_full = '''Job Id: 1234[].pbs
+    Job_Name = run-bolt
+    job_state = B
+
+Job Id: 1234[1].pbs
+    Job_Name = run-bolt
+    job_state = F
+    Exit_status = 0
+    Variable_List = PBS_O_HOME=/home/user,PBS_O_PATH=/usr/bin:/bin,
+\tPBS_O_WORKDIR=/work
+
+Job Id: 1234[2].pbs
+    job_state = R
+'''
+
+
+def test_parse_qstat_full():
+
+    jobs = bolt.parse_qstat_full(qstat_full)
+
+    assert list(jobs) == ['1234[].pbs', '1234[1].pbs', '1234[2].pbs']
+    assert jobs['1234[1].pbs']['Exit_status'] == '0'
+    assert jobs['1234[1].pbs']['Variable_List'].endswith(',PBS_O_WORKDIR=/work')
+    assert jobs['1234[2].pbs'] == {'job_state': 'R'}
+
+
+def subjob(state, exit_status = None, start_time = None):
+
+    return({'state': state, 'exit_status': exit_status, 'start-time': start_time,
+            'walltime-used': None})
+
+
+def fake_qstat(monkeypatch, replies):
+
+    """ Replaces qstat by a list of replies, records the sleeps """
+
+    queried = []
+    sleeps = []
+
+    def qstat_subjobs(job_id):
+        queried.append(job_id)
+        return(replies.pop(0))
+
+    monkeypatch.setattr(bolt, 'qstat_subjobs', qstat_subjobs)
+    monkeypatch.setattr(bolt.time, 'sleep', sleeps.append)
+
+    return(queried, sleeps)
+
+
+def test_monitor_qsub_waits_for_all_subjobs(monkeypatch):
+
+    queried, sleeps = fake_qstat(monkeypatch, [
+        {1: subjob('Q'), 2: subjob('Q')},
+        None,
+        {1: subjob('R'), 2: subjob('Q')},
+        {1: subjob('X', 0), 2: subjob('F', 1)}])
+
+    subjobs = bolt.monitor_qsub('1234[]', min_interval = 10, max_interval = 300)
+
+    assert queried == ['1234[]'] * 4
+    assert subjobs[2]['exit_status'] == 1
+    assert bolt.failed_subjobs(subjobs) == [2]
+
+    ## qstat failing is asked again after the longest interval
+    assert sleeps[0] == 10
+    assert sleeps[2] == 300
+
+
+def test_monitor_qsub_interval(monkeypatch):
+
+    now = time.time()
+
+    queried, sleeps = fake_qstat(monkeypatch, [
+        {1: subjob('Q'), 2: subjob('Q')},
+        {1: subjob('R', start_time = now - 1000), 2: subjob('R', start_time = now - 10)},
+        {1: subjob('F', 0), 2: subjob('R', start_time = now - 10)},
+        {1: subjob('F', 0), 2: subjob('F', 0)}])
+
+    bolt.monitor_qsub('1234[]', min_interval = 10, max_interval = 300)
+
+    ## a tenth of the run time of the longest running subjob, within
+    ## the intervals
+    assert sleeps[1] == 10
+    assert 99 <= sleeps[2] <= 101
+    assert sleeps[3] == 10
+
+
+def test_monitor_qsub_on_finished(monkeypatch):
+
+    queried, sleeps = fake_qstat(monkeypatch, [
+        {1: subjob('F', 0), 2: subjob('R', start_time = time.time())},
+        {1: subjob('F', 0), 2: subjob('F', 0)}])
+
+    reported = []
+
+    bolt.monitor_qsub('1234[]', on_finished = lambda subjobs: reported.append(sorted(subjobs)))
+
+    assert reported == [[1], [2]]
+
+
+## == failures and retries ==
+
+@pytest.mark.parametrize('exit_status, failure', [
+    (0, None),
+    (1, 'error'),
+    (137, 'mem'),
+    (265, 'mem'),
+    (143, 'walltime'),
+    (271, 'walltime'),
+    (-9, 'mem'),
+    (-15, 'walltime'),
+    (-11, 'node'),
+    (None, 'node'),
+])
+def test_subjob_failure_exit_status(exit_status, failure):
+
+    assert bolt.subjob_failure({'exit_status': exit_status}) == failure
+
+
+@pytest.mark.parametrize('message, failure', [
+    ('=>> PBS: job killed: mem 8388608kb exceeded limit 4194304kb', 'mem'),
+    ('=>> PBS: job killed: vmem 8388608kb exceeded limit 4194304kb', 'mem'),
+    ("terminate called after throwing an instance of 'std::bad_alloc'", 'mem'),
+    ('=>> PBS: job killed: walltime 3620 exceeded limit 3600', 'walltime'),
+    ('ERROR: Phenotype file not found', 'error'),
+])
+def test_subjob_failure_log(tmp_path, message, failure):
+
+    stderr = tmp_path / 'job.err'
+    stderr.write_text(message + '\n')
+
+    result = {'exit_status': 1, 'stdout': str(tmp_path / 'job.out'), 'stderr': str(stderr)}
+
+    assert bolt.subjob_failure(result) == failure
+
+
+def test_subjob_failure_log_before_exit_status(tmp_path):
+
+    ## the message of pbs decides over the signal
+    stdout = tmp_path / 'job.out'
+    stdout.write_text('=>> PBS: job killed: walltime 3620 exceeded limit 3600\n')
+
+    assert bolt.subjob_failure({'exit_status': 137, 'stdout': str(stdout)}) == 'walltime'
+
+
+@pytest.mark.parametrize('signal_number, failure', [(9, 'mem'), (15, 'walltime')])
+def test_subjob_failure_local_signal(tmp_path, signal_number, failure):
+
+    ## a local task killed, e.g. by the OOM killer
+    script = write_script(tmp_path / 'kill.py', 'import os\nos.kill(os.getpid(), ' + str(signal_number) + ')\n')
+
+    results = bolt.run_local('python3 ' + script, 'test-job', str(tmp_path), {'ncpus': 1, 'mem': 1},
+                             cores = 1, mem = 1)
+
+    assert results[1]['exit_status'] == -signal_number
+    assert bolt.subjob_failure(results[1]) == failure
+
+
+## a task running out of memory the first time it runs, failing if
+## it is 'bad'
+retry_script = '''import os, sys
+task = sys.argv[2].split(',')[int(os.environ['PBS_ARRAY_INDEX']) - 1]
+marker = os.path.join(sys.argv[1], task)
+if task == 'bad':
+    sys.exit(1)
+if not os.path.exists(marker):
+    open(marker, 'w').close()
+    sys.stderr.write('std::bad_alloc\\n')
+    sys.exit(1)
+'''
+
+retry = {'max': 2, 'mem-factor': 2, 'walltime-factor': 2, 'mem-max': 3, 'walltime-max': 10}
+
+
+def run_retry_tasks(tmp_path, tasks):
+
+    script = write_script(tmp_path / 'task.py', retry_script)
+    log_dir = tmp_path / 'logs'
+    log_dir.mkdir()
+
+    def task_command(attempt_tasks, attempt):
+        return('python3 ' + script + ' ' + str(tmp_path) + ' ' + ','.join(attempt_tasks))
+
+    return(bolt.run_tasks('local', 'test-job', str(log_dir),
+                          {'ncpus': 1, 'mem': 1, 'walltime': 1}, tasks, task_command,
+                          retry, cores = 2, mem = 10))
+
+
+def test_run_tasks_escalates_memory(tmp_path):
+
+    results, attempts = run_retry_tasks(tmp_path, ['a', 'bad'])
+
+    assert [result['failure'] for result in results] == [None, 'error']
+
+    ## errors are not resubmitted, out of memory with twice the memory
+    assert [(a['task'], a['attempt'], a['resources']['mem'], a['failure']) for a in attempts] == \
+        [('a', 1, 1, 'mem'), ('bad', 1, 1, 'error'), ('a', 2, 2, None)]
+
+
+def test_run_tasks_stops_at_maximum(tmp_path):
+
+    ## always out of memory
+    script = write_script(tmp_path / 'task.py', 'import sys\nsys.stderr.write("Out of memory\\n")\nsys.exit(1)\n')
+    log_dir = tmp_path / 'logs'
+    log_dir.mkdir()
+
+    results, attempts = bolt.run_tasks('local', 'test-job', str(log_dir),
+                                       {'ncpus': 1, 'mem': 1, 'walltime': 1}, ['a'],
+                                       lambda tasks, attempt: 'python3 ' + script,
+                                       retry, cores = 2, mem = 10)
+
+    ## 1, 2 and the maximum of 3 gb
+    assert [a['resources']['mem'] for a in attempts] == [1, 2, 3]
+    assert results[0]['failure'] == 'mem'
+
+
+## == stages ==
+
+def test_run_stages_order():
+
+    started = []
+
+    def stage(name):
+        def run():
+            started.append(name)
+            ## the independent stages run at the same time
+            if name in ('b', 'c'):
+                time.sleep(0.2)
+            return(name.upper())
+        return(run)
+
+    results = bolt.run_stages({'d': (stage('d'), ['b', 'c']),
+                               'b': (stage('b'), ['a']),
+                               'c': (stage('c'), ['a']),
+                               'a': (stage('a'), [])})
+
+    assert results == {'a': 'A', 'b': 'B', 'c': 'C', 'd': 'D'}
+    assert started[0] == 'a'
+    assert started[-1] == 'd'
+
+
+def test_run_stages_concurrent():
+
+    start = time.time()
+
+    bolt.run_stages({'a': (lambda: time.sleep(0.5), []),
+                     'b': (lambda: time.sleep(0.5), [])})
+
+    assert time.time() - start < 0.9
+
+
+def test_run_stages_failure():
+
+    started = []
+
+    def fail():
+        time.sleep(0.1)
+        sys.exit('failed')
+
+    def slow():
+        time.sleep(0.3)
+        started.append('slow-done')
+
+    ## a stage failing skips those depending on it, waits for those
+    ## running and raises its exception
+    with pytest.raises(SystemExit):
+        bolt.run_stages({'fail': (fail, []),
+                         'slow': (slow, []),
+                         'after': (lambda: started.append('after'), ['fail', 'slow'])})
+
+    assert started == ['slow-done']
+
+
+@pytest.mark.parametrize('stages', [
+    {'a': (None, ['b']), 'b': (None, ['a'])},
+    {'a': (None, ['missing'])},
+])
+def test_run_stages_invalid(stages):
+
+    with pytest.raises(ValueError):
+        bolt.run_stages(stages)
+
+
+## == resource predictions ==
+
+limits = {'mem-max': 64, 'walltime-max': 72}
+
+
+def history_record(samples, mem_used, walltime_used, failure = None, ncpus = 1):
+
+    return({'job': 'run-plink', 'features': {'samples': samples, 'variants': 1000},
+            'resources': {'ncpus': ncpus, 'mem': 8, 'walltime': 4},
+            'failure': failure, 'mem-used': mem_used, 'walltime-used': walltime_used})
+
+
+def test_predict_resources_too_few_records():
+
+    history = [history_record(1000, 2, 1)]
+
+    predicted = bolt.predict_resources(history, 'run-plink', {'samples': 1000, 'variants': 1000},
+                                       {'ncpus': 1, 'mem': 8, 'walltime': 4}, 1.5, 2, limits)
+
+    assert predicted == {'ncpus': 1, 'mem': 8, 'walltime': 4}
+
+
+def test_predict_resources_scaled():
+
+    ## failed attempts and other ncpus are not used
+    history = [history_record(1000, 2, 1), history_record(2000, 3, 1),
+               history_record(1000, 50, 50, failure = 'mem'), history_record(1000, 50, 50, ncpus = 2)]
+
+    predicted = bolt.predict_resources(history, 'run-plink', {'samples': 4000, 'variants': 1000},
+                                       {'ncpus': 1, 'mem': 8, 'walltime': 4}, 1.5, 2, limits)
+
+    ## largest use per sample times 4000 samples times 1.5
+    assert predicted['mem'] >= 12
+    assert predicted['walltime'] >= 6
+    assert predicted['ncpus'] == 1
+
+
+def test_predict_resources_limits():
+
+    history = [history_record(10, 2, 1), history_record(10, 2, 1)]
+
+    predicted = bolt.predict_resources(history, 'run-plink', {'samples': 10000, 'variants': 1000},
+                                       {'ncpus': 1, 'mem': 8, 'walltime': 4}, 1.5, 2, limits)
+
+    assert predicted['mem'] == 64
+    assert predicted['walltime'] == 72
+
+
+def test_history_round_trip(tmp_path):
+
+    history_file = str(tmp_path / 'history' / 'resources.jsonl')
+
+    assert bolt.load_history(history_file) == []
+
+    bolt.append_history(history_file, [history_record(1000, 2, 1)])
+    bolt.append_history(history_file, [history_record(2000, 3, 1)])
+
+    ## a line cut short by a killed run
+    with open(history_file, 'a') as fh:
+        fh.write('{"job": "run-')
+
+    assert [record['features']['samples'] for record in bolt.load_history(history_file)] == [1000, 2000]
+
+
+@pytest.mark.parametrize('value, bucket', [
+    (0.2, 1), (1, 1), (1.1, 2), (2.5, 3), (3, 3), (3.5, 4), (5, 6), (7, 8), (9, 12),
+    (13, 16), (17, 24), (25, 32), (33, 48),
+])
+def test_resource_bucket(value, bucket):
+
+    assert bolt.resource_bucket(value) == bucket
+
+
+def test_predict_resources_bucketed():
+
+    history = [history_record(1000, 2, 1), history_record(1000, 2, 1)]
+
+    predicted = bolt.predict_resources(history, 'run-plink', {'samples': 1700, 'variants': 1000},
+                                       {'ncpus': 1, 'mem': 8, 'walltime': 4}, 1.5, 2, limits)
+
+    ## 2 gb per 1000 samples * 1.7 * 1.5 = 5.1 gb
+    assert predicted['mem'] == 6
+
+
+## == merging chunks ==
+
+def test_merge_removes_boundary_duplicates(tmp_path):
+
+    ## both bgenix ranges include the boundary position 200, which
+    ## has two variants
+    chunk_1 = write_output(tmp_path / 'chunk1', [variant(1, 100), variant(1, 200, 'rsA'),
+                                                 variant(1, 200, 'rsB')])
+    chunk_2 = write_output(tmp_path / 'chunk2', [variant(1, 200, 'rsA'), variant(1, 200, 'rsB'),
+                                                 variant(1, 300)])
+
+    stats = bolt.merge_bolt_chunks([chunk_1, chunk_2], str(tmp_path / 'merged'))
+
+    assert stats['variants'] == 4
+    assert stats['duplicates'] == 2
+    assert read_output(tmp_path / 'merged')[1:] == [variant(1, 100), variant(1, 200, 'rsA'),
+                                                    variant(1, 200, 'rsB'), variant(1, 300)]
+
+
+def test_merge_keeps_distinct_variants_at_boundary(tmp_path):
+
+    chunk_1 = write_output(tmp_path / 'chunk1', [variant(1, 200, 'rsA')])
+    chunk_2 = write_output(tmp_path / 'chunk2', [variant(1, 200, 'rsB')])
+
+    stats = bolt.merge_bolt_chunks([chunk_1, chunk_2], str(tmp_path / 'merged'))
+
+    assert stats['variants'] == 2
+    assert stats['duplicates'] == 0
+
+
+def test_merge_boundary_across_empty_chunk(tmp_path):
+
+    chunk_1 = write_output(tmp_path / 'chunk1', [variant(1, 200)])
+    chunk_2 = write_output(tmp_path / 'chunk2', [])
+    chunk_3 = write_output(tmp_path / 'chunk3', [variant(1, 200), variant(1, 300)])
+
+    stats = bolt.merge_bolt_chunks([chunk_1, chunk_2, chunk_3], str(tmp_path / 'merged'))
+
+    assert stats['variants'] == 2
+    assert stats['duplicates'] == 1
+
+
+def test_merge_same_position_on_other_chromosome(tmp_path):
+
+    chunk_1 = write_output(tmp_path / 'chunk1', [variant(1, 200, 'rsA')])
+    chunk_2 = write_output(tmp_path / 'chunk2', [variant(2, 200, 'rsA')])
+
+    stats = bolt.merge_bolt_chunks([chunk_1, chunk_2], str(tmp_path / 'merged'))
+
+    assert stats['variants'] == 2
+    assert stats['duplicates'] == 0
+
+
+def test_merge_fills_missing_columns(tmp_path):
+
+    chunk_1 = write_output(tmp_path / 'chunk1', [variant(1, 100)])
+
+    ## a chunk without the BOLT_LMM_INF statistic
+    header = columns[:-2]
+    chunk_2 = write_output(tmp_path / 'chunk2',
+                           ['\t'.join(variant(1, 300).rstrip('\n').split('\t')[:-2]) + '\n'],
+                           header)
+
+    stats = bolt.merge_bolt_chunks([chunk_1, chunk_2], str(tmp_path / 'merged'))
+
+    lines = read_output(tmp_path / 'merged')
+
+    assert stats['variants'] == 2
+    assert lines[0] == '\t'.join(columns) + '\n'
+    assert lines[2].rstrip('\n').split('\t')[-2:] == ['', '']
+
+
+## == splitting packed chunks ==
+
+def test_split_halves_boundary_variants(tmp_path):
+
+    chunks = [('1', (100, 200)), ('1', (200, 300))]
+    chunk_files = [str(tmp_path / 'chunk1'), str(tmp_path / 'chunk2')]
+
+    ## the boundary variants come twice in a row, once for each bgen
+    ## file
+    stats_file = write_output(tmp_path / 'stats', [variant(1, 100), variant(1, 200, 'rsA'),
+                                                   variant(1, 200, 'rsB'), variant(1, 200, 'rsA'),
+                                                   variant(1, 200, 'rsB'), variant(1, 300)])
+
+    counts = bolt.split_bolt_output(stats_file, chunks, chunk_files)
+
+    assert counts == [3, 3]
+    assert read_output(chunk_files[0])[1:] == [variant(1, 100), variant(1, 200, 'rsA'),
+                                               variant(1, 200, 'rsB')]
+    assert read_output(chunk_files[1])[1:] == [variant(1, 200, 'rsA'), variant(1, 200, 'rsB'),
+                                               variant(1, 300)]
+
+
+def test_split_boundary_variant_filtered_in_one_chunk(tmp_path):
+
+    ## an odd number of variants at the boundary stays in the current
+    ## chunk
+    chunks = [('1', (100, 200)), ('1', (200, 300))]
+    chunk_files = [str(tmp_path / 'chunk1'), str(tmp_path / 'chunk2')]
+
+    stats_file = write_output(tmp_path / 'stats', [variant(1, 100), variant(1, 200),
+                                                   variant(1, 250)])
+
+    counts = bolt.split_bolt_output(stats_file, chunks, chunk_files)
+
+    assert counts == [2, 1]
+
+
+def test_split_chunks_without_variants(tmp_path):
+
+    chunks = [('1', (100, 200)), ('1', (201, 300)), ('2', (100, 200)), ('2', (201, 300))]
+    chunk_files = [str(tmp_path / ('chunk' + str(i))) for i in range(len(chunks))]
+
+    stats_file = write_output(tmp_path / 'stats', [variant(1, 150), variant(2, 150)])
+
+    counts = bolt.split_bolt_output(stats_file, chunks, chunk_files)
+
+    assert counts == [1, 0, 1, 0]
+    assert read_output(chunk_files[1]) == ['\t'.join(columns) + '\n']
+    assert read_output(chunk_files[3]) == ['\t'.join(columns) + '\n']
+
+
+def test_split_variant_outside_chunks(tmp_path):
+
+    chunks = [('1', (100, 200))]
+    chunk_files = [str(tmp_path / 'chunk1')]
+
+    stats_file = write_output(tmp_path / 'stats', [variant(1, 150), variant(1, 250)])
+
+    with pytest.raises(ValueError):
+        bolt.split_bolt_output(stats_file, chunks, chunk_files)
+
+    ## no partial chunk file
+    assert not os.path.exists(chunk_files[0])
+
+
+## == top hits ==
+
+hit_filters = {'p-column': 'P_BOLT_LMM', 'max-p': 0.01, 'min-maf': 0.01, 'min-info': 0.8}
+
+
+def test_merge_collects_hits(tmp_path):
+
+    chunk_1 = write_output(tmp_path / 'chunk1', [variant(1, 100, p = '1e-8'),
+                                                 variant(1, 200, p = '0.5'),
+                                                 variant(1, 300, p = '1e-9', freq = '0.001'),
+                                                 variant(1, 400, p = '1e-10', info = '0.5')])
+    chunk_2 = write_output(tmp_path / 'chunk2', [variant(2, 100, p = '1e-6'),
+                                                 variant(2, 200, p = '1e-7'),
+                                                 variant(2, 300, p = '2e-8')])
+
+    ## without P_BOLT_LMM in the output, P_BOLT_LMM_INF is used
+    hits = bolt.hit_table(hit_filters, 3)
+
+    bolt.merge_bolt_chunks([chunk_1, chunk_2], str(tmp_path / 'merged'), hits = hits)
+
+    assert hits['passed'] == 4
+    assert bolt.write_hits(hits, str(tmp_path / 'hits')) == 3
+    assert read_output(tmp_path / 'hits') == ['\t'.join(columns) + '\n', variant(1, 100, p = '1e-8'),
+                                              variant(2, 300, p = '2e-8'), variant(2, 200, p = '1e-7')]
+
+
+def test_hits_ties_keep_earlier_variant():
+
+    hits = bolt.hit_table(hit_filters, 1)
+    bolt.hit_columns(hits, columns)
+
+    for bp in (100, 200):
+        line = variant(1, bp, p = '1e-8')
+        bolt.add_hit(hits, line.rstrip('\n').split('\t'), line)
+
+    assert [entry[2] for entry in hits['heap']] == [variant(1, 100, p = '1e-8')]
+
+
+@pytest.mark.parametrize('freq, info, passed', [
+    ('0.3', '1', True),
+    ('NA', '1', False),
+    ('', '1', False),
+    ('0.3', 'NA', True),
+    ('0.3', '', True),
+    ('0.3', 'x', False),
+])
+def test_add_hit_missing_values(freq, info, passed):
+
+    hits = bolt.hit_table(hit_filters, 10)
+    bolt.hit_columns(hits, columns)
+
+    line = variant(1, 100, p = '1e-8', freq = freq, info = info)
+
+    assert bolt.add_hit(hits, line.rstrip('\n').split('\t'), line) == passed
+
+
+## == diagnostics ==
+
+def test_genomic_inflation_null():
+
+    ## uniform p-values, as bolt-lmm writes them with two significant
+    ## digits
+    diagnostics = bolt.diagnostics_table()
+    bolt.diagnostic_columns(diagnostics, columns)
+
+    n = 999
+
+    for i in range(n):
+        p = '%.2g' % ((i + 0.5) / n)
+        bolt.add_diagnostics(diagnostics, variant(1, i + 1, p = p).rstrip('\n').split('\t'))
+
+    inflation = bolt.genomic_inflation(diagnostics)
+
+    assert diagnostics['variants'] == n
+    assert diagnostics['chromosomes'] == {'1': n}
+    assert set(inflation) == {'P_LINREG', 'P_BOLT_LMM_INF'}
+    assert inflation['P_LINREG'] == pytest.approx(1, abs = 0.02)
+
+
+def test_genomic_inflation_inflated():
+
+    diagnostics = bolt.diagnostics_table()
+    bolt.diagnostic_columns(diagnostics, columns)
+
+    for i in range(100):
+        bolt.add_diagnostics(diagnostics, variant(1, i + 1, p = '0.01').rstrip('\n').split('\t'))
+
+    normal = statistics.NormalDist()
+    expected = normal.inv_cdf(0.005) ** 2 / normal.inv_cdf(0.75) ** 2
+
+    inflation = bolt.genomic_inflation(diagnostics)
+
+    assert inflation['P_BOLT_LMM_INF'] == pytest.approx(expected, rel = 0.01)
+
+
+def test_genomic_inflation_without_p_values():
+
+    diagnostics = bolt.diagnostics_table()
+    bolt.diagnostic_columns(diagnostics, columns)
+
+    assert bolt.genomic_inflation(diagnostics) == {'P_LINREG': None, 'P_BOLT_LMM_INF': None}
+
+
+def test_merge_fills_diagnostics(tmp_path):
+
+    chunk_1 = write_output(tmp_path / 'chunk1', [variant(1, 100, p = '0.01'), variant(1, 200, p = '0.01')])
+    chunk_2 = write_output(tmp_path / 'chunk2', [variant(1, 200, p = '0.01'), variant(2, 100, p = '0.01')])
+
+    diagnostics = bolt.diagnostics_table()
+
+    bolt.merge_bolt_chunks([chunk_1, chunk_2], str(tmp_path / 'merged'), diagnostics = diagnostics)
+
+    ## the duplicate is counted once
+    assert diagnostics['variants'] == 3
+    assert diagnostics['chromosomes'] == {'1': 2, '2': 1}
+    assert diagnostics['sketches']['P_LINREG']['n'] == 3
+
+
+## == Parquet ==
+
+def test_write_parquet(tmp_path):
+
+    pq = pytest.importorskip('pyarrow.parquet')
+
+    merged = write_output(tmp_path / 'merged', [variant(1, 100), variant(1, 200, p = 'NA'),
+                                                variant(2, 100), variant('X', 100)])
+
+    ## small blocks, a chromosome spans several of them
+    outdir = bolt.write_parquet(merged, str(tmp_path / 'parquet'), block_size = 1)
+
+    assert sorted(os.listdir(outdir)) == ['CHR=1', 'CHR=2', 'CHR=X']
+
+    table = pq.read_table(os.path.join(outdir, 'CHR=1'))
+
+    assert table['BP'].to_pylist() == [100, 200]
+    assert table['P_LINREG'].to_pylist() == [0.5, None]
+    assert 'CHR' not in table.column_names
+
+
+def test_write_parquet_again(tmp_path):
+
+    pa = pytest.importorskip('pyarrow')
+    pq = pytest.importorskip('pyarrow.parquet')
+
+    ## more than a block of 1 mb
+    block = [variant(1, bp) for bp in range(1, 25001)]
+
+    ## not sorted, chromosome 1 appears again in a later block
+    merged = write_output(tmp_path / 'merged', block + [variant(2, bp) for bp in range(1, 25001)] +
+                          [variant(1, 30000)])
+    outdir = str(tmp_path / 'parquet')
+
+    assert bolt.write_parquet(merged, outdir, block_size = 1) == outdir
+
+    assert len(os.listdir(os.path.join(outdir, 'CHR=1'))) == 2
+    assert pq.read_table(os.path.join(outdir, 'CHR=1')).num_rows == 25001
+
+    ## written again, replacing the dataset
+    merged = write_output(tmp_path / 'merged', [variant(1, 100), variant(2, 200)])
+    bolt.write_parquet(merged, outdir, block_size = 1)
+
+    assert pq.read_table(os.path.join(outdir, 'CHR=1'))['BP'].to_pylist() == [100]
+    assert pq.read_table(os.path.join(outdir, 'CHR=2'))['BP'].to_pylist() == [200]
+    assert sorted(os.listdir(tmp_path)) == ['merged', 'parquet']
+
+    ## a conversion failing after the first block keeps the previous
+    ## dataset
+    broken = write_output(tmp_path / 'broken', block + [variant(1, 'x')])
+
+    with pytest.raises(pa.ArrowInvalid):
+        bolt.write_parquet(broken, outdir, block_size = 1)
+
+    assert pq.read_table(os.path.join(outdir, 'CHR=2'))['BP'].to_pylist() == [200]
+    assert sorted(os.listdir(tmp_path)) == ['broken', 'merged', 'parquet']
+
+
+## == chunks ==
+
+def test_cost_chunks_even_cost():
+
+    positions = list(range(1, 101))
+    weights = [1] * 100
+
+    chunks = bolt.cost_chunks(positions, weights, '1', target_cost = 30, fixed_cost = 5)
+
+    ## 100 / (30 - 5) gives 4 chunks of 25 variants
+    assert chunks == [('1', (1, 25)), ('1', (26, 50)), ('1', (51, 75)), ('1', (76, 100))]
+
+
+def test_cost_chunks_weights():
+
+    ## the variants of the first half cost nothing, e.g. removed by
+    ## the MAF filter
+    positions = list(range(1, 101))
+    weights = [0] * 50 + [1] * 50
+
+    chunks = bolt.cost_chunks(positions, weights, '1', target_cost = 30, fixed_cost = 5)
+
+    assert len(chunks) == 2
+    assert chunks[0] == ('1', (1, 75))
+    assert chunks[1] == ('1', (76, 100))
+
+
+def test_cost_chunks_same_position_not_split():
+
+    positions = [1, 2, 3, 3, 3, 4]
+    weights = [1] * 6
+
+    chunks = bolt.cost_chunks(positions, weights, '1', target_cost = 3, fixed_cost = 0)
+
+    for (_, (start, end)), (_, (next_start, _)) in zip(chunks, chunks[1:]):
+        assert end < next_start
+
+    assert chunks[0][1][0] == 1
+    assert chunks[-1][1][1] == 4
+
+
+def test_cost_chunks_fixed_cost_too_high():
+
+    with pytest.raises(ValueError):
+        bolt.cost_chunks([1, 2], [1, 1], '1', target_cost = 5, fixed_cost = 5)
+
+
+def test_chunks_without_variants():
+
+    assert bolt.cost_chunks([], [], '1', target_cost = 30, fixed_cost = 5) == []
+    assert bolt.snp_chunks([], '1', 100) == []
+
+
+## == bgen chunks ==
+
+## bgenix writing the range as text, indexing by creating the index
+## file; each call is logged
+bgenix_script = '''#!/usr/bin/env python3
+import os, sys
+args = sys.argv[1:]
+with open(os.environ['BGENIX_LOG'], 'a') as fh:
+    fh.write(' '.join(args) + '\\n')
+if os.environ.get('BGENIX_FAIL'):
+    sys.exit(int(os.environ['BGENIX_FAIL']))
+if '-index' in args:
+    open(args[args.index('-g') + 1] + '.bgi', 'w').close()
+else:
+    for i in range(int(os.environ.get('BGENIX_LINES', '1'))):
+        sys.stdout.write(args[args.index('-incl-range') + 1] + '\\n')
+        sys.stdout.flush()
+'''
+
+
+@pytest.fixture
+def bgenix(tmp_path, monkeypatch):
+
+    """ A stand-in bgenix in the search path, returns its log """
+
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    write_script(bin_dir / 'bgenix', bgenix_script)
+
+    log = tmp_path / 'bgenix.log'
+    log.touch()
+
+    monkeypatch.setenv('PATH', str(bin_dir) + os.pathsep + os.environ['PATH'])
+    monkeypatch.setenv('BGENIX_LOG', str(log))
+
+    return(log)
+
+
+def test_bgen_cache_chunk(tmp_path, bgenix):
+
+    bgen_file = tmp_path / 'chr1.bgen'
+    bgen_file.write_text('bgen')
+    cache_dir = str(tmp_path / 'cache')
+
+    with bolt.bgen_cache_chunk(cache_dir, str(bgen_file), '01:1-100', 10) as chunkfile:
+        assert open(chunkfile).read() == '01:1-100\n'
+        assert os.path.exists(chunkfile + '.bgi')
+
+    ## extracted once, then a cache hit
+    with bolt.bgen_cache_chunk(cache_dir, str(bgen_file), '01:1-100', 10) as chunkfile_hit:
+        assert chunkfile_hit == chunkfile
+
+    assert len(bgenix.read_text().splitlines()) == 2
+
+    ## another range or a changed bgen file is another chunk
+    assert bolt.bgen_cache_key(str(bgen_file), '01:1-100') != bolt.bgen_cache_key(str(bgen_file), '01:1-101')
+
+
+def test_bgen_cache_chunk_failure(tmp_path, bgenix, monkeypatch):
+
+    bgen_file = tmp_path / 'chr1.bgen'
+    bgen_file.write_text('bgen')
+    cache_dir = tmp_path / 'cache'
+
+    monkeypatch.setenv('BGENIX_FAIL', '1')
+
+    with pytest.raises(subprocess.CalledProcessError):
+        with bolt.bgen_cache_chunk(str(cache_dir), str(bgen_file), '01:1-100', 10):
+            pass
+
+    ## no chunk that looks complete
+    assert not [path for path in cache_dir.glob('*/*.bgen') if len(path.stem) == 40]
+
+
+def cache_entry(cache_dir, key, size, age):
+
+    """ A chunk of the given size in bytes, last used age seconds ago """
+
+    entry_dir = cache_dir / key[:2]
+    entry_dir.mkdir(parents = True, exist_ok = True)
+
+    chunkfile = entry_dir / (key + '.bgen')
+    chunkfile.write_bytes(b'0' * size)
+    (entry_dir / (key + '.bgen.bgi')).touch()
+
+    mtime = time.time() - age
+    os.utime(chunkfile, (mtime, mtime))
+
+    return(chunkfile)
+
+
+def test_evict_bgen_cache_least_recently_used(tmp_path):
+
+    cache_dir = tmp_path / 'cache'
+
+    old = cache_entry(cache_dir, 'a' * 40, 1000, 3000)
+    used = cache_entry(cache_dir, 'b' * 40, 1000, 2000)
+    recent = cache_entry(cache_dir, 'c' * 40, 1000, 10)
+
+    ## room for two chunks
+    removed = bolt.evict_bgen_cache(str(cache_dir), 2500 / 1024 ** 3)
+
+    assert removed == 1000
+    assert not old.exists()
+    assert used.exists()
+    assert recent.exists()
+
+
+def test_evict_bgen_cache_skips_locked_and_recent(tmp_path):
+
+    cache_dir = tmp_path / 'cache'
+
+    locked = cache_entry(cache_dir, 'a' * 40, 1000, 3000)
+    recent = cache_entry(cache_dir, 'b' * 40, 1000, 10)
+
+    with open(str(locked) + '.lock', 'a') as lock_fh:
+        fcntl.flock(lock_fh, fcntl.LOCK_SH)
+        removed = bolt.evict_bgen_cache(str(cache_dir), 0)
+
+    assert removed == 0
+    assert locked.exists()
+    assert recent.exists()
+
+
+def test_evict_bgen_cache_skips_chunks_it_cannot_remove(tmp_path, monkeypatch):
+
+    cache_dir = tmp_path / 'cache'
+
+    other = cache_entry(cache_dir, 'a' * 40, 1000, 3000)
+    own = cache_entry(cache_dir, 'b' * 40, 1000, 2000)
+
+    remove = os.remove
+
+    ## the chunk of another user in a directory that is not
+    ## group-writable
+    def remove_owned(path):
+        if path == str(other):
+            raise PermissionError(13, 'Permission denied', path)
+        remove(path)
+
+    monkeypatch.setattr(bolt.os, 'remove', remove_owned)
+
+    removed = bolt.evict_bgen_cache(str(cache_dir), 0)
+
+    assert removed == 1000
+    assert other.exists()
+    assert not own.exists()
+
+
+class Users:
+
+    """ Runs python code as two users of one group, in a shared
+    directory outside the test directory of root """
+
+    group = 60000
+    uids = {'a': 60001, 'b': 60002}
+
+    def __init__(self, shared_dir):
+
+        import shutil
+
+        self.shared_dir = shared_dir
+
+        os.chmod(shared_dir, 0o755)
+        os.chown(shared_dir, self.uids['a'], self.group)
+
+        self.lib_dir = os.path.join(shared_dir, 'lib')
+        os.mkdir(self.lib_dir)
+        shutil.copy(os.path.join(testdir, '../lib/bolt.py'), self.lib_dir)
+
+        ## a python the users may run, e.g. not in the home of root
+        self.python = None
+
+        for python in (sys.executable, '/usr/bin/python3'):
+            try:
+                subprocess.run([python, '-c', ''], preexec_fn = self.demote('a'), check = True)
+            except (OSError, subprocess.CalledProcessError):
+                continue
+            self.python = python
+            break
+
+    def demote(self, user):
+
+        def preexec():
+            os.setgroups([self.group])
+            os.setgid(self.group)
+            os.setuid(self.uids[user])
+            os.umask(0o022)
+
+        return(preexec)
+
+    def run(self, user, code, env = None):
+
+        """ Runs code with bolt imported, returns its last line of
+        output """
+
+        code = 'import sys\nsys.path.insert(0, ' + repr(self.lib_dir) + ')\nimport bolt\n' + code
+
+        process = subprocess.run([self.python, '-c', code], preexec_fn = self.demote(user),
+                                 capture_output = True, text = True, check = True,
+                                 cwd = self.shared_dir, env = dict(os.environ, **(env or {})))
+
+        return(process.stdout.splitlines()[-1])
+
+
+@pytest.fixture
+def users():
+
+    """ Two users of one group, see Users """
+
+    import shutil
+    import tempfile
+
+    if os.geteuid() != 0:
+        pytest.skip('needs root to run code as other users')
+
+    shared_dir = tempfile.mkdtemp(prefix = 'bolt-test-')
+
+    try:
+        users = Users(shared_dir)
+        if users.python is None:
+            pytest.skip('no python that other users may run')
+        yield users
+    finally:
+        shutil.rmtree(shared_dir)
+
+
+def test_bgen_cache_shared_by_users(users):
+
+    bin_dir = os.path.join(users.shared_dir, 'bin')
+    os.mkdir(bin_dir)
+    write_script(Path(bin_dir) / 'bgenix', bgenix_script)
+
+    log = os.path.join(users.shared_dir, 'bgenix.log')
+    open(log, 'w').close()
+    os.chmod(log, 0o666)
+
+    bgen_file = os.path.join(users.shared_dir, 'chr1.bgen')
+    with open(bgen_file, 'w') as fh:
+        fh.write('bgen')
+
+    cache_dir = os.path.join(users.shared_dir, 'cache')
+
+    env = {'BGENIX_LOG': log, 'PATH': bin_dir + os.pathsep + os.environ['PATH']}
+
+    use = ('with bolt.bgen_cache_chunk(' + repr(cache_dir) + ', ' + repr(bgen_file) +
+           ", '01:1-100', 10) as chunkfile:\n    print(chunkfile)\n")
+
+    ## extracted by one user, used by the other
+    chunkfile = users.run('a', use, env)
+
+    assert os.stat(chunkfile).st_uid == users.uids['a']
+
+    os.utime(chunkfile, (0, 0))
+
+    assert users.run('b', use, env) == chunkfile
+
+    ## a cache hit, recorded as a use of the chunk
+    assert len(open(log).read().splitlines()) == 2
+    assert os.stat(chunkfile).st_mtime > time.time() - 600
+
+    ## evicted by the other user
+    os.utime(chunkfile, (0, 0))
+
+    assert int(users.run('b', 'print(bolt.evict_bgen_cache(' + repr(cache_dir) + ', 0, min_age = 0))')) > 0
+    assert not os.path.exists(chunkfile)
+
+
+def read_pipe(bgen_file, lines = None):
+
+    """ Reads the stream of a bgen range, all of it or some lines """
+
+    with bolt.bgen_pipe(str(bgen_file), '01:1-100') as stream:
+        fh = open(stream['pipe'], 'r')
+        if lines is None:
+            text = fh.read()
+        else:
+            ## a reader failing with the pipe still open
+            text = ''.join(fh.readline() for i in range(lines))
+            stream['reader-failed'] = True
+
+    fh.close()
+
+    assert not os.path.exists(os.path.dirname(stream['pipe']))
+
+    return(text, stream)
+
+
+def test_bgen_pipe(tmp_path, bgenix):
+
+    bgen_file = tmp_path / 'chr1.bgen'
+    bgen_file.write_text('bgen')
+
+    text, stream = read_pipe(bgen_file)
+
+    assert text == '01:1-100\n'
+    assert not stream['killed']
+
+
+def test_bgen_pipe_bgenix_fails(tmp_path, bgenix, monkeypatch):
+
+    bgen_file = tmp_path / 'chr1.bgen'
+    bgen_file.write_text('bgen')
+
+    monkeypatch.setenv('BGENIX_FAIL', '2')
+
+    ## the reader sees a short (here empty) range, bgenix failing fails
+    ## the stream
+    with pytest.raises(subprocess.CalledProcessError):
+        read_pipe(bgen_file)
+
+
+def test_bgen_pipe_reader_fails(tmp_path, bgenix, monkeypatch):
+
+    bgen_file = tmp_path / 'chr1.bgen'
+    bgen_file.write_text('bgen')
+
+    ## more than the pipe buffer, bgenix blocks when the reader stops
+    monkeypatch.setenv('BGENIX_LINES', '100000')
+
+    text, stream = read_pipe(bgen_file, lines = 2)
+
+    assert text == '01:1-100\n' * 2
+    assert stream['killed']
+
+
+def test_bgen_pipe_reader_does_not_open(tmp_path, bgenix):
+
+    bgen_file = tmp_path / 'chr1.bgen'
+    bgen_file.write_text('bgen')
+
+    ## the shell blocked in opening the pipe is let through, bgenix
+    ## then fails writing to a pipe without reader
+    with pytest.raises(subprocess.CalledProcessError):
+        with bolt.bgen_pipe(str(bgen_file), '01:1-100') as stream:
+            pass
+
+    assert not os.path.exists(os.path.dirname(stream['pipe']))
+
+
+def read_all(pipe):
+
+    """ A reader failing after it has read the stream """
+
+    with open(pipe, 'r') as fh:
+        fh.read()
+
+    return(1)
+
+
+def read_line(pipe):
+
+    """ A reader failing before it has read the stream, e.g. bolt-lmm
+    not reading the bgen file in one pass, with the pipe kept open """
+
+    fh = open(pipe, 'r')
+    fh.readline()
+
+    return(1)
+
+
+def exit_early(pipe):
+
+    """ A reader failing before it has read the stream, closing the
+    pipe as it exits """
+
+    with open(pipe, 'r') as fh:
+        fh.readline()
+
+    return(1)
+
+
+@pytest.mark.parametrize('bgenix_fail, reader, extracted', [
+    ## the reader fails on a complete stream, not run again
+    (None, read_all, False),
+    ## bgenix fails, also if the reader finished
+    ('2', lambda pipe: read_all(pipe) - 1, True),
+    ## bgenix killed
+    (None, read_line, True),
+    ## bgenix fails writing to a closed pipe
+    (None, exit_early, True)])
+def test_run_bgen_streamed(tmp_path, bgenix, monkeypatch, bgenix_fail, reader, extracted):
+
+    bgen_file = tmp_path / 'chr1.bgen'
+    bgen_file.write_text('bgen')
+
+    if bgenix_fail:
+        monkeypatch.setenv('BGENIX_FAIL', bgenix_fail)
+    if reader is not read_all:
+        ## more than the pipe buffer
+        monkeypatch.setenv('BGENIX_LINES', '100000')
+
+    def run_extracted():
+        return(0)
+
+    returncode, streamed = bolt.run_bgen_streamed(str(bgen_file), '01:1-100', reader, run_extracted)
+
+    assert streamed != extracted
+    assert returncode == (0 if extracted else 1)
+
+
+def test_run_bgen_streamed_success(tmp_path, bgenix):
+
+    bgen_file = tmp_path / 'chr1.bgen'
+    bgen_file.write_text('bgen')
+
+    def run_extracted():
+        raise AssertionError('extracted')
+
+    assert bolt.run_bgen_streamed(str(bgen_file), '01:1-100', lambda pipe: read_all(pipe) - 1,
+                                  run_extracted) == (0, True)
+
+
+@pytest.mark.parametrize('n_rows, n_variants, filtered, valid', [
+    (10, 10, False, True),
+    (9, 10, False, False),
+    (0, 10, False, False),
+    (11, 10, False, False),
+    ## all variants removed by the filters
+    (0, 10, True, True),
+    (9, 10, True, True),
+    (11, 10, True, False)])
+def test_chunk_rows_valid(n_rows, n_variants, filtered, valid):
+
+    assert bolt.chunk_rows_valid(n_rows, n_variants, filtered) == valid
+
+
+
+## == manifest ==
+
+def test_output_valid(tmp_path):
+
+    output = tmp_path / 'output.txt'
+    output.write_text('SNP\tP\nrs1\t0.5\n')
+
+    record = bolt.record_output([str(output)])
+
+    assert record['state'] == 'done'
+    assert bolt.output_valid(record)
+
+    ## touched but unchanged
+    os.utime(output, (0, 0))
+    assert bolt.output_valid(record)
+
+    ## changed, same size
+    output.write_text('SNP\tP\nrs1\t0.6\n')
+    assert not bolt.output_valid(record)
+
+    output.unlink()
+    assert not bolt.output_valid(record)
+
+
+def test_output_valid_not_done():
+
+    assert not bolt.output_valid(None)
+    assert not bolt.output_valid({'state': 'running', 'files': {}})
+
+
+def test_manifest_round_trip(tmp_path):
+
+    manifest_file = str(tmp_path / 'manifest.json')
+
+    assert bolt.load_manifest(manifest_file) == {'stages': {}, 'chunks': {}}
+
+    output = tmp_path / 'output.txt'
+    output.write_text('rs1\n')
+
+    manifest = {'stages': {'samples': bolt.record_output([str(output)])}, 'chunks': {}}
+    bolt.save_manifest(manifest, manifest_file)
+
+    loaded = bolt.load_manifest(manifest_file)
+
+    assert loaded == manifest
+    assert bolt.output_valid(loaded['stages']['samples'])
+
+    ## no temporary file left
+    assert sorted(os.listdir(tmp_path)) == ['manifest.json', 'output.txt']
+
+
+## == core SNP set cache ==
+
+def write_coreset(path, text):
+
+    for ext in ('.bed', '.bim', '.fam'):
+        (path.parent / (path.name + ext)).write_text(text + ext)
+
+
+def test_coreset_cache(tmp_path):
+
+    cache_dir = str(tmp_path / 'cache')
+    inputs = {'fam': 'abc', 'thresholds': {'thr-maf': '0.01'}}
+    key = bolt.coreset_cache_key(inputs)
+
+    assert key != bolt.coreset_cache_key(dict(inputs, fam = 'abd'))
+
+    assert not bolt.fetch_coreset(cache_dir, key, str(tmp_path / 'fetched'))
+
+    write_coreset(tmp_path / 'coreset', 'first')
+    entry_dir = bolt.store_coreset(cache_dir, key, str(tmp_path / 'coreset'), inputs)
+
+    ## an entry stored in the meantime is kept
+    write_coreset(tmp_path / 'other', 'second')
+    assert bolt.store_coreset(cache_dir, key, str(tmp_path / 'other'), inputs) == entry_dir
+
+    assert bolt.fetch_coreset(cache_dir, key, str(tmp_path / 'fetched'))
+    assert (tmp_path / 'fetched.bim').read_text() == 'first.bim'
+    assert json.load(open(os.path.join(entry_dir, 'inputs.json'))) == inputs
+    assert sorted(os.listdir(cache_dir)) == [key]
+
+
+def test_coreset_cache_damaged_and_partial_entries(tmp_path):
+
+    cache_dir = tmp_path / 'cache'
+    inputs = {'fam': 'abc'}
+    key = bolt.coreset_cache_key(inputs)
+
+    write_coreset(tmp_path / 'coreset', 'first')
+    entry_dir = bolt.store_coreset(str(cache_dir), key, str(tmp_path / 'coreset'), inputs)
+
+    assert os.stat(cache_dir).st_mode & 0o7777 == 0o2775
+    assert os.stat(entry_dir).st_mode & 0o7777 == 0o2775
+
+    ## a damaged entry is removed when fetched, and stored again
+    os.remove(os.path.join(entry_dir, 'coreset.bim'))
+
+    assert not bolt.fetch_coreset(str(cache_dir), key, str(tmp_path / 'fetched'))
+    assert not os.path.exists(entry_dir)
+
+    ## the partial entry of a killed run is removed once it is old
+    partial_dir = cache_dir / (key + '.killed')
+    partial_dir.mkdir()
+    (partial_dir / 'coreset.bed').write_text('partial')
+    recent_dir = cache_dir / (key + '.running')
+    recent_dir.mkdir()
+    os.utime(partial_dir, (0, 0))
+
+    write_coreset(tmp_path / 'second', 'second')
+    assert bolt.store_coreset(str(cache_dir), key, str(tmp_path / 'second'), inputs) == entry_dir
+    assert sorted(os.listdir(cache_dir)) == sorted([key, key + '.running'])
+
+    ## a damaged entry is replaced when stored
+    os.remove(os.path.join(entry_dir, 'inputs.json'))
+
+    write_coreset(tmp_path / 'third', 'third')
+    assert bolt.store_coreset(str(cache_dir), key, str(tmp_path / 'third'), inputs) == entry_dir
+    assert bolt.fetch_coreset(str(cache_dir), key, str(tmp_path / 'fetched'))
+    assert (tmp_path / 'fetched.bim').read_text() == 'third.bim'
+
+
+def test_coreset_cache_not_writable(tmp_path, monkeypatch):
+
+    cache_dir = str(tmp_path / 'cache')
+    inputs = {'fam': 'abc'}
+    key = bolt.coreset_cache_key(inputs)
+    write_coreset(tmp_path / 'coreset', 'first')
+
+    def mkdtemp(*args, **kwargs):
+        raise PermissionError('not writable')
+
+    monkeypatch.setattr(bolt.tempfile, 'mkdtemp', mkdtemp)
+
+    ## not stored, the run goes on with its own core SNP set
+    assert bolt.store_coreset(cache_dir, key, str(tmp_path / 'coreset'), inputs) is None
+    assert os.listdir(cache_dir) == []
+    assert not bolt.fetch_coreset(cache_dir, key, str(tmp_path / 'fetched'))
+
+
+def test_coreset_cache_shared_by_users(users):
+
+    cache_dir = os.path.join(users.shared_dir, 'cache')
+    coreset = os.path.join(users.shared_dir, 'coreset')
+
+    for ext in ('.bed', '.bim', '.fam'):
+        with open(coreset + ext, 'w') as fh:
+            fh.write('first' + ext)
+
+    store = ('print(bolt.store_coreset(' + repr(cache_dir) + ", 'key', " + repr(coreset) +
+             ", {'fam': 'abc'}, partial_age = 0))")
+
+    ## stored by one user, a partial entry of the same user left behind
+    entry_dir = users.run('a', store)
+    partial_dir = os.path.join(cache_dir, 'key.killed')
+    users.run('a', 'import os\nos.mkdir(' + repr(partial_dir) + ')\nos.chmod(' + repr(partial_dir) + ', 0o2775)\n'
+              'open(' + repr(os.path.join(partial_dir, 'coreset.bed')) + ", 'w').close()\nprint()")
+
+    ## damaged, then replaced by the other user, who also removes
+    ## the partial entry
+    os.remove(os.path.join(entry_dir, 'coreset.fam'))
+    os.chmod(os.path.join(entry_dir, 'coreset.bed'), 0o444)
+
+    assert users.run('b', store) == entry_dir
+    assert os.stat(os.path.join(entry_dir, 'coreset.bim')).st_uid == users.uids['b']
+    assert sorted(os.listdir(cache_dir)) == ['key']
+
+
+## == genotype inputs ==
+
+def test_stage_bim(tmp_path):
+
+    input_bim = tmp_path / 'chr1.bim'
+    input_bim.write_text('1\trs1\t0\t100\tA\tG\n1\t.\t0\t200\tC\tT\n')
+    staged_bim = str(tmp_path / 'staged.bim')
+
+    assert bolt.stage_bim(str(input_bim), staged_bim) == 2
+    assert read_output(staged_bim) == ['1\t1_100_A_G_1\t0\t100\tA\tG\n',
+                                       '1\t1_200_C_T_1\t0\t200\tC\tT\n']
+    assert os.stat(staged_bim).st_mtime == os.stat(input_bim).st_mtime
+
+    ## staged already
+    assert bolt.stage_bim(str(input_bim), staged_bim) is None
+
+
+def test_stage_bim_invalid(tmp_path):
+
+    input_bim = tmp_path / 'chr1.bim'
+    input_bim.write_text('1\trs1\t0\t100\tA\tG\n1\trs2\t0\t200\tC\n')
+
+    with pytest.raises(ValueError, match = 'line 2'):
+        bolt.stage_bim(str(input_bim), str(tmp_path / 'staged.bim'))
+
+    assert os.listdir(tmp_path) == ['chr1.bim']
+
+
+def test_check_bed(tmp_path):
+
+    bed_file = tmp_path / 'chr1.bed'
+
+    ## 2 variants of 5 samples, 2 bytes each
+    bed_file.write_bytes(b'\x6c\x1b\x01' + b'\x00' * 4)
+    bolt.check_bed(str(bed_file), 2, 5)
+
+    with pytest.raises(ValueError, match = 'expected 9'):
+        bolt.check_bed(str(bed_file), 3, 5)
+
+    bed_file.write_bytes(b'\x6c\x1b\x00' + b'\x00' * 4)
+
+    with pytest.raises(ValueError, match = 'variant-major'):
+        bolt.check_bed(str(bed_file), 2, 5)
+
+
+def test_stage_bim_keeps_error(tmp_path):
+
+    ## a bim file that cannot be read, the staged copy is never created
+    input_bim = tmp_path / 'chr1.bim'
+    input_bim.mkdir()
+
+    with pytest.raises(IsADirectoryError):
+        bolt.stage_bim(str(input_bim), str(tmp_path / 'staged.bim'))
+
+
+## == preflight checks ==
+
+pheno_text = '''FID IID Sex Age height bmi
+1 1 M 50 170.5 22
+2 2 F NA 160 -9
+3 3 F 40 tall 25
+4 4 M 30 180 NA
+'''
+
+
+def sample_files(tmp_path):
+
+    fam_file = tmp_path / 'data.fam'
+    fam_file.write_text(''.join(str(i) + ' ' + str(i) + ' 0 0 1 -9\n' for i in range(1, 6)))
+
+    ## the imputed data misses sample 4
+    sample_file = tmp_path / 'data.sample'
+    sample_file.write_text('ID_1 ID_2 missing sex\n0 0 0 D\n' +
+                           ''.join(str(i) + ' ' + str(i) + ' 0 1\n' for i in (1, 2, 3, 5, 6)))
+
+    pheno_file = tmp_path / 'pheno.txt'
+    pheno_file.write_text(pheno_text)
+
+    return(str(fam_file), str(sample_file), str(pheno_file))
+
+
+def test_check_model_columns(tmp_path):
+
+    fam_file, sample_file, pheno_file = sample_files(tmp_path)
+
+    models = [{'name': 'model_1', 'pheno': 'bmi', 'cov': 'Sex;Age'},
+              {'name': 'model_2', 'pheno': 'height', 'cov': ';'},
+              {'name': 'model_3', 'pheno': 'weight', 'cov': 'Sex,Batch;'}]
+
+    problems = bolt.check_model_columns(pheno_file, models)
+
+    assert len(problems) == 3
+    assert any('no column weight' in problem for problem in problems)
+    assert any('no column Batch' in problem for problem in problems)
+    assert any("column height has 1 non-numeric value(s), e.g. 'tall'" in problem
+               for problem in problems)
+
+    assert bolt.check_model_columns(pheno_file, models[:1]) == []
+
+
+def test_sample_overlap(tmp_path):
+
+    fam_file, sample_file, pheno_file = sample_files(tmp_path)
+
+    remove_file = tmp_path / 'remove.txt'
+    remove_file.write_text('3 3\n')
+
+    overlap = bolt.sample_overlap(fam_file, sample_file, pheno_file, str(remove_file))
+
+    assert overlap['fam'] == 5
+    assert overlap['sample'] == 5
+    assert overlap['pheno'] == 4
+    assert overlap['fam-sample'] == 4
+    assert overlap['fam-pheno'] == 4
+    assert list(overlap['missing']) == ['4\t4']
+    assert overlap['analysis'] == 2
+
+
+def test_missing_inputs(tmp_path):
+
+    fam_file, sample_file, pheno_file = sample_files(tmp_path)
+
+    (tmp_path / 'ldscores.gz').touch()
+
+    for name in ('gen1.bed', 'gen1.bim', 'imp1.bgen', 'imp1.bgen.bgi',
+                 'gen2.bed', 'gen2.bim', 'imp2.bgen'):
+        (tmp_path / name).touch()
+
+    cfg = {'fam-file': fam_file, 'sample-file': sample_file, 'pheno-file': pheno_file,
+           'ldscore-file': str(tmp_path / 'ldscores.gz'), 'remove-samples-list': None,
+           'data-dir': str(tmp_path), 'gen-base': 'gen', 'imp-base': 'imp'}
+
+    assert bolt.missing_inputs(cfg, [1]) == []
+
+    missing = bolt.missing_inputs(cfg, [1, 2, 3])
+
+    assert str(tmp_path / 'gen3.bed') in missing
+    assert any(path.startswith(str(tmp_path / 'imp2.bgen.bgi')) for path in missing)
+    assert len(missing) == 5
+
+
+def test_sample_overlap_samples(tmp_path):
+
+    fam_file, sample_file, pheno_file = sample_files(tmp_path)
+
+    overlap = bolt.sample_overlap(fam_file, sample_file, pheno_file)
+
+    ## the samples of the core SNP set in the imputed data
+    assert list(overlap['samples']) == ['1\t1', '2\t2', '3\t3']
+
+
+def test_write_model_samples(tmp_path):
+
+    fam_file, sample_file, pheno_file = sample_files(tmp_path)
+
+    import pandas as pd
+
+    models = [{'name': 'model_1', 'pheno': 'bmi', 'cov': 'Sex;Age'},
+              {'name': 'model_2', 'pheno': 'height', 'cov': 'Sex;'}]
+
+    samples = pd.Index(['1\t1', '2\t2', '4\t4'], dtype = object)
+
+    model_samples = bolt.write_model_samples(pheno_file, models, samples, str(tmp_path / 'samples'))
+
+    ## complete cases of any model
+    assert read_output(model_samples['keep']) == ['1\t1\n', '2\t2\n', '4\t4\n']
+
+    ## bmi and Age missing for 2, bmi for 4
+    assert model_samples['model_1']['samples'] == 1
+    assert read_output(model_samples['model_1']['remove-file']) == ['2\t2\n', '4\t4\n']
+    assert read_output(model_samples['model_1']['pheno-file']) == ['FID\tIID\tbmi\tSex\tAge\n',
+                                                                   '1\t1\t22\tM\t50\n']
+
+    assert model_samples['model_2']['samples'] == 3
+    assert model_samples['model_2']['remove-file'] is None